@@ -47,38 +47,39 @@ static void handler(FSEventStreamRef stream,
   
     PyGILState_STATE state = PyGILState_Ensure();
 
-    /* convert event data to Python objects */
-    PyObject *eventPathList = PyList_New(numEvents);
-    PyObject *eventMaskList = PyList_New(numEvents);
-    PyObject *eventIDList = PyList_New(numEvents);
-    if ((!eventPathList) || (!eventMaskList) || (!eventIDList))
+    /* pack event data into three buffers: the NUL-terminated paths,
+       the 32-bit masks and the 64-bit event IDs */
+    Py_ssize_t size = 0;
+    int i;
+    for (i = 0; i < numEvents; i++)
+        size += strlen(eventPaths[i]) + 1;
+
+    PyObject *eventPathData = PyBytes_FromStringAndSize(NULL, size);
+    PyObject *eventMaskData = PyBytes_FromStringAndSize(
+        (const char *) eventMasks, numEvents * sizeof(FSEventStreamEventFlags));
+    PyObject *eventIDData = PyBytes_FromStringAndSize(
+        (const char *) eventIDs, numEvents * sizeof(uint64_t));
+    if ((!eventPathData) || (!eventMaskData) || (!eventIDData)) {
+        Py_XDECREF(eventPathData);
+        Py_XDECREF(eventMaskData);
+        Py_XDECREF(eventIDData);
+        PyGILState_Release(state);
         return;
+    }
 
-    int i;
+    char *buffer = PyBytes_AS_STRING(eventPathData);
     for (i = 0; i < numEvents; i++) {
-        PyObject *str = PyBytes_FromString(eventPaths[i]);
-
-        #if PY_MAJOR_VERSION >= 3
-            PyObject *num = PyLong_FromLong(eventMasks[i]);
-            PyObject *id = PyLong_FromLong(eventIDs[i]);
-        #else
-            PyObject *num = PyInt_FromLong(eventMasks[i]);
-            PyObject *id = PyInt_FromLong(eventIDs[i]);
-        #endif
-
-        if ((!num) || (!str) || (!id)) {
-            Py_DECREF(eventPathList);
-            Py_DECREF(eventMaskList);
-            Py_DECREF(eventIDList);
-            return;
-        }
-        PyList_SET_ITEM(eventPathList, i, str);
-        PyList_SET_ITEM(eventMaskList, i, num);
-        PyList_SET_ITEM(eventIDList, i, id);
+        size_t length = strlen(eventPaths[i]) + 1;
+        memcpy(buffer, eventPaths[i], length);
+        buffer += length;
     }
 
-    if (PyObject_CallFunction(info->callback, "OOO", eventPathList,
-                              eventMaskList, eventIDList) == NULL) {
+    PyObject *result = PyObject_CallFunction(
+        info->callback, "OOO", eventPathData, eventMaskData, eventIDData);
+    Py_DECREF(eventPathData);
+    Py_DECREF(eventMaskData);
+    Py_DECREF(eventIDData);
+    if (result == NULL) {
         /* may can return NULL if an exception is raised */
         if (!PyErr_Occurred())
             PyErr_SetString(PyExc_ValueError, callback_error_msg);
@@ -86,7 +87,8 @@ static void handler(FSEventStreamRef stream,
         /* stop listening */
         CFRunLoopStop(info->loop);
     }
-    
+    Py_XDECREF(result);
+
     PyGILState_Release(state);
 }
 
@@ -241,11 +243,16 @@ static PyObject* pyfsevents_stop(PyObject* self, PyObject* thread) {
     return Py_None;
 }
 
+static PyObject* pyfsevents_current_event_id(PyObject* self, PyObject* args) {
+    return PyLong_FromUnsignedLongLong(FSEventsGetCurrentEventId());
+}
+
 static PyMethodDef methods[] = {
     {"loop", pyfsevents_loop, METH_VARARGS, NULL},
     {"stop", pyfsevents_stop, METH_O, NULL},
     {"schedule", pyfsevents_schedule, METH_VARARGS, NULL},
     {"unschedule", pyfsevents_unschedule, METH_O, NULL},
+    {"current_event_id", pyfsevents_current_event_id, METH_NOARGS, NULL},
     {NULL},
 };
 
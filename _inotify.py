@@ -0,0 +1,506 @@
+"""Low-level inotify interface.
+
+Implements the functions and constants of the ``_fsevents`` extension
+on top of the Linux ``inotify`` API, so that :mod:`fsevents` works
+unchanged where ``FSEvents`` is not available. Each stream has its own
+inotify instance with a watch on every directory below its paths;
+watches are added and moved along as directories are created and
+renamed. Events are translated to their ``FSEvents`` flags and
+delivered in batches, once ``latency`` seconds have passed since the
+first event of a batch.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import selectors
+import struct
+import threading
+import time
+from array import array
+
+FS_FLAGNONE = 0x00000000
+FS_FLAGMUSTSCANSUBDIRS = 0x00000001
+FS_FLAGUSERDROPPED = 0x00000002
+FS_FLAGKERNELDROPPED = 0x00000004
+FS_FLAGEVENTIDSWRAPPED = 0x00000008
+FS_FLAGHISTORYDONE = 0x00000010
+FS_FLAGROOTCHANGED = 0x00000020
+FS_FLAGMOUNT = 0x00000040
+FS_FLAGUNMOUNT = 0x00000080
+FS_ITEMCREATED = 0x00000100
+FS_ITEMREMOVED = 0x00000200
+FS_ITEMINODEMETAMOD = 0x00000400
+FS_ITEMRENAMED = 0x00000800
+FS_ITEMMODIFIED = 0x00001000
+FS_ITEMFINDERINFOMOD = 0x00002000
+FS_ITEMCHANGEOWNER = 0x00004000
+FS_ITEMXATTRMOD = 0x00008000
+FS_ITEMISFILE = 0x00010000
+FS_ITEMISDIR = 0x00020000
+FS_ITEMISSYMLINK = 0x00040000
+
+FS_CFLAGNONE = 0x00000000
+FS_CFLAGUSECFTYPES = 0x00000001
+FS_CFLAGNODEFER = 0x00000002
+FS_CFLAGWATCHROOT = 0x00000004
+FS_CFLAGIGNORESELF = 0x00000008
+FS_CFLAGFILEEVENTS = 0x00000010
+FS_IGNORESELF = FS_CFLAGIGNORESELF
+FS_FILEEVENTS = FS_CFLAGFILEEVENTS
+
+FS_EVENTIDSINCENOW = -1
+
+CF_POLLIN = 1
+CF_POLLOUT = 2
+
+# From <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = os.O_CLOEXEC
+IN_NONBLOCK = os.O_NONBLOCK
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+    | IN_EXCL_UNLINK
+)
+
+ITEM_FLAGS = (
+    (IN_CREATE, FS_ITEMCREATED),
+    (IN_DELETE, FS_ITEMREMOVED),
+    (IN_MODIFY, FS_ITEMMODIFIED),
+    (IN_ATTRIB, FS_ITEMINODEMETAMOD),
+    (IN_MOVED_FROM, FS_ITEMRENAMED),
+    (IN_MOVED_TO, FS_ITEMRENAMED),
+)
+
+_event = struct.Struct("iIII")
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_libc.inotify_init1.argtypes = [ctypes.c_int]
+_libc.inotify_add_watch.argtypes = [
+    ctypes.c_int,
+    ctypes.c_char_p,
+    ctypes.c_uint32,
+]
+_libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+loops = {}
+streams = {}
+lock = threading.Lock()
+
+_last_event_id = 0
+
+
+def _error():
+    code = ctypes.get_errno()
+    return OSError(code, os.strerror(code))
+
+
+def current_event_id():
+    """Return the ID of the most recent event.
+
+    Event IDs are microseconds since the epoch, made strictly
+    increasing within the process, so that an ID saved by a previous
+    run can be passed as ``since``.
+    """
+
+    global _last_event_id
+    with lock:
+        _last_event_id = max(_last_event_id, time.time_ns() // 1000)
+        return _last_event_id
+
+
+def _next_event_id():
+    global _last_event_id
+    with lock:
+        _last_event_id = max(_last_event_id + 1, time.time_ns() // 1000)
+        return _last_event_id
+
+
+def event_time(event_id):
+    """Return the time of an event, in seconds since the epoch."""
+
+    return event_id / 1000000.0
+
+
+class Watcher(object):
+    """The inotify instance of a stream."""
+
+    def __init__(self, callback, paths, since, latency, cflags):
+        self.callback = callback
+        self.roots = [
+            os.path.realpath(path).rstrip(b"/") or b"/" for path in paths
+        ]
+        self.latency = latency
+        self.cflags = cflags
+        self.wds = {}
+        self.paths = {}
+        self.pending = {}
+        self.deadline = None
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise _error()
+        try:
+            for root in self.roots:
+                self.watch(root, strict=True)
+        except OSError:
+            os.close(self.fd)
+            raise
+        if since != FS_EVENTIDSINCENOW:
+            self.replay(since)
+
+    def close(self):
+        os.close(self.fd)
+
+    def watch(self, path, strict=False, created=None):
+        """Add watches on ``path`` and the directories below it.
+
+        If ``created`` is a list, the entries found are appended to it
+        as ``(path, is_dir)`` tuples; they may have been created before
+        the watch was in place.
+        """
+
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            wd = _libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+            if wd < 0:
+                error = _error()
+                if error.errno == errno.ENOSPC:
+                    # Out of watches; the directory can't be observed.
+                    self.add(
+                        path,
+                        FS_FLAGMUSTSCANSUBDIRS | FS_FLAGUSERDROPPED,
+                        directory=True,
+                    )
+                    if strict:
+                        raise error
+                    continue
+                if strict and path in self.roots:
+                    raise error
+                # The directory went away, or was never one.
+                continue
+            self.wds[wd] = path
+            self.paths[path] = wd
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                continue
+            for entry in entries:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if created is not None:
+                    created.append((os.path.join(path, entry.name), is_dir))
+                if is_dir:
+                    stack.append(os.path.join(path, entry.name))
+
+    def forget(self, path):
+        """Remove the watches on ``path`` and the directories below it."""
+
+        prefix = path + b"/"
+        for name in list(self.paths):
+            if name == path or name.startswith(prefix):
+                wd = self.paths.pop(name)
+                del self.wds[wd]
+                _libc.inotify_rm_watch(self.fd, wd)
+
+    def move(self, source, target):
+        """Update the paths of the watches below a renamed directory."""
+
+        prefix = source + b"/"
+        for name in list(self.paths):
+            if name == source or name.startswith(prefix):
+                wd = self.paths.pop(name)
+                name = target + name[len(source):]
+                self.wds[wd] = name
+                self.paths[name] = wd
+
+    def replay(self, since):
+        """Report the directories changed after the event ID ``since``.
+
+        There is no event history on Linux; instead, a directory is
+        reported if it or one of its entries has a change time later
+        than ``since`` (as event IDs are timestamps). A single event
+        with ``FS_FLAGHISTORYDONE`` follows.
+        """
+
+        # File system timestamps come from a coarse clock which can lag
+        # behind by a tick; err on the side of reporting too much.
+        since = since * 1000 - 10000000
+        for path in sorted(self.paths):
+            try:
+                changed = os.lstat(path).st_ctime_ns > since
+                if not changed:
+                    with os.scandir(path) as it:
+                        for entry in it:
+                            stat = entry.stat(follow_symlinks=False)
+                            if stat.st_ctime_ns > since:
+                                changed = True
+                                break
+            except OSError:
+                continue
+            if changed:
+                self.add(path, FS_ITEMISDIR, directory=True)
+        self.add(self.roots[0], FS_FLAGHISTORYDONE, history=True)
+
+    def add(self, path, flags, directory=False, history=False):
+        """Record an event; the flags of events on the same path within
+        a batch are combined."""
+
+        if history:
+            key = path
+        elif self.cflags & FS_CFLAGFILEEVENTS:
+            key = path
+        else:
+            # Without file events, the directory is reported.
+            if not directory:
+                path = os.path.dirname(path)
+            key = path.rstrip(b"/") + b"/"
+        if key in self.pending:
+            mask, event_id = self.pending.pop(key)
+            flags |= mask
+        self.pending[key] = flags, _next_event_id()
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.latency
+
+    def read(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        moves = {}
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event.unpack_from(data, offset)
+            offset += _event.size
+            name = data[offset:offset + length].split(b"\0", 1)[0]
+            offset += length
+            self.translate(wd, mask, cookie, name, moves)
+
+        # A directory moved out of the observed tree.
+        for path in moves.values():
+            self.forget(path)
+
+    def translate(self, wd, mask, cookie, name, moves):
+        if mask & IN_Q_OVERFLOW:
+            for root in self.roots:
+                self.add(
+                    root,
+                    FS_FLAGMUSTSCANSUBDIRS | FS_FLAGKERNELDROPPED,
+                    directory=True,
+                )
+            return
+        directory = self.wds.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self.wds[wd]
+            if self.paths.get(directory) == wd:
+                del self.paths[directory]
+            return
+        if not name:
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_UNMOUNT):
+                if (
+                    directory in self.roots
+                    and self.cflags & FS_CFLAGWATCHROOT
+                ):
+                    self.add(directory, FS_FLAGROOTCHANGED, history=True)
+                return
+            self.add(directory, FS_ITEMINODEMETAMOD | FS_ITEMISDIR, True)
+            return
+
+        path = os.path.join(directory, name)
+        is_dir = mask & IN_ISDIR
+        flags = FS_ITEMISDIR if is_dir else FS_ITEMISFILE
+        for in_flag, fs_flag in ITEM_FLAGS:
+            if mask & in_flag:
+                flags |= fs_flag
+        self.add(path, flags)
+
+        if not is_dir:
+            return
+        if mask & IN_MOVED_FROM:
+            moves[cookie] = path
+        elif mask & IN_MOVED_TO and cookie in moves:
+            self.move(moves.pop(cookie), path)
+        elif mask & (IN_CREATE | IN_MOVED_TO):
+            created = []
+            self.watch(path, created=created)
+            for entry, entry_is_dir in created:
+                self.add(
+                    entry,
+                    FS_ITEMCREATED
+                    | (FS_ITEMISDIR if entry_is_dir else FS_ITEMISFILE),
+                )
+        elif mask & IN_DELETE:
+            self.forget(path)
+
+    def flush(self):
+        """Pass the pending events to the callback as the buffers of the
+        ``_fsevents`` contract."""
+
+        pending = self.pending
+        self.pending = {}
+        self.deadline = None
+        paths = b"".join(path + b"\0" for path in pending)
+        masks = array("I")
+        ids = array("Q")
+        for mask, event_id in pending.values():
+            masks.append(mask)
+            ids.append(event_id)
+        self.callback(paths, masks.tobytes(), ids.tobytes())
+
+
+class RunLoop(object):
+    """Selects on the inotify instances of the streams scheduled on a
+    thread and on a pipe used to wake it up."""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.wakeup, self.waker = os.pipe()
+        os.set_blocking(self.wakeup, False)
+        os.set_blocking(self.waker, False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        self.watchers = set()
+        self.stopped = False
+        self.finished = False
+
+    def add(self, watcher):
+        with self.lock:
+            self.watchers.add(watcher)
+            self.selector.register(
+                watcher.fd, selectors.EVENT_READ, watcher
+            )
+            self.wake()
+
+    def remove(self, watcher):
+        with self.lock:
+            self.watchers.discard(watcher)
+            self.selector.unregister(watcher.fd)
+            watcher.close()
+            if self.finished:
+                self.close()
+            else:
+                self.wake()
+
+    def wake(self):
+        # The caller holds the lock.
+        try:
+            os.write(self.waker, b"\0")
+        except BlockingIOError:
+            # The loop has yet to read the previous wakeups.
+            pass
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            if not self.finished:
+                self.wake()
+
+    def run(self):
+        while not self.stopped:
+            with self.lock:
+                deadlines = [
+                    watcher.deadline
+                    for watcher in self.watchers
+                    if watcher.deadline is not None
+                ]
+            timeout = None
+            if deadlines:
+                timeout = max(0, min(deadlines) - time.monotonic())
+            ready = self.selector.select(timeout)
+            due = []
+            with self.lock:
+                for key, events in ready:
+                    if key.fd == self.wakeup:
+                        try:
+                            os.read(self.wakeup, 4096)
+                        except BlockingIOError:
+                            pass
+                    elif key.data in self.watchers:
+                        key.data.read()
+                now = time.monotonic()
+                for watcher in self.watchers:
+                    deadline = watcher.deadline
+                    if deadline is not None and deadline <= now:
+                        due.append(watcher)
+            for watcher in due:
+                if watcher in self.watchers:
+                    watcher.flush()
+
+    def finish(self):
+        with self.lock:
+            self.finished = True
+            self.close()
+
+    def close(self):
+        # Streams may be unscheduled after the loop has finished.
+        if self.finished and not self.watchers:
+            self.selector.close()
+            os.close(self.wakeup)
+            os.close(self.waker)
+
+
+def _runloop(thread):
+    with lock:
+        runloop = loops.get(thread)
+        if runloop is None:
+            runloop = loops[thread] = RunLoop()
+        return runloop
+
+
+def loop(thread):
+    """Run the loop of ``thread`` until it is stopped."""
+
+    runloop = _runloop(thread)
+    try:
+        runloop.run()
+    finally:
+        with lock:
+            del loops[thread]
+        runloop.finish()
+
+
+def stop(thread):
+    _runloop(thread).stop()
+
+
+def schedule(thread, stream, callback, paths, since, latency, cflags):
+    if stream in streams:
+        raise ValueError("Stream already scheduled.")
+    watcher = Watcher(callback, paths, since, latency, cflags)
+    runloop = _runloop(thread)
+    streams[stream] = runloop, watcher
+    runloop.add(watcher)
+
+
+def unschedule(stream):
+    item = streams.pop(stream, None)
+    if item is not None:
+        runloop, watcher = item
+        runloop.remove(watcher)
@@ -0,0 +1,448 @@
+"""Low-level polling interface.
+
+Implements the ``schedule``/``unschedule``/``loop``/``stop`` contract
+of the ``_fsevents`` extension by periodically stat'ing the observed
+trees, for file systems without change notifications (network mounts,
+some containers). Use it with ``Observer(backend="polling")``, or pass
+a :class:`PollingBackend` to tune it.
+
+Each directory is polled on its own schedule: after a change it is
+polled again after ``interval`` seconds, and every poll that finds
+nothing doubles the wait, up to ``max_interval``. If the modification
+time of a directory is unchanged, its entries are not listed again
+and only the files are stat'ed. All the streams of a backend share a
+budget of ``budget`` file system calls per second; when it is spent,
+polls are postponed rather than the mount being saturated. The trees
+are walked and polled outside the lock of the loop, so scheduling
+doesn't wait for a slow mount.
+"""
+
+import heapq
+import os
+import stat as _stat
+import threading
+import time
+from array import array
+
+from fsevents import (
+    FS_CFLAGFILEEVENTS,
+    FS_EVENTIDSINCENOW,
+    FS_FLAGHISTORYDONE,
+    FS_ITEMCREATED,
+    FS_ITEMINODEMETAMOD,
+    FS_ITEMISDIR,
+    FS_ITEMISFILE,
+    FS_ITEMMODIFIED,
+    FS_ITEMREMOVED,
+    FileEventCallback,
+    SnapshotStore
+)
+
+# A directory modified this close to the time it was listed may change
+# again without its modification time changing (timestamps on network
+# file systems can have a granularity of a second or two).
+RACY_NS = 2000000000
+
+lock = threading.Lock()
+_last_event_id = 0
+
+
+def current_event_id():
+    """Return the ID of the most recent event; event IDs are
+    microseconds since the epoch, as with the inotify backend."""
+
+    global _last_event_id
+    with lock:
+        _last_event_id = max(_last_event_id, time.time_ns() // 1000)
+        return _last_event_id
+
+
+def _next_event_id():
+    global _last_event_id
+    with lock:
+        _last_event_id = max(_last_event_id + 1, time.time_ns() // 1000)
+        return _last_event_id
+
+
+def event_time(event_id):
+    """Return the time of an event, in seconds since the epoch."""
+
+    return event_id / 1000000.0
+
+
+class Directory(object):
+    __slots__ = "mtime_ns", "racy", "interval"
+
+    def __init__(self, mtime_ns, racy, interval):
+        self.mtime_ns = mtime_ns
+        self.racy = racy
+        self.interval = interval
+
+
+class Poller(object):
+    """The polling state of a stream."""
+
+    def __init__(
+        self, backend, runloop, callback, paths, since, latency, cflags
+    ):
+        self.backend = backend
+        self.runloop = runloop
+        self.callback = callback
+        self.roots = [
+            os.path.realpath(path).rstrip(b"/") or b"/" for path in paths
+        ]
+        self.latency = latency
+        self.cflags = cflags
+        self.snapshots = SnapshotStore()
+        self.directories = {}
+        self.pending = {}
+        self.deadline = None
+        self.calls = 0
+        # The directories walked since, with when to poll them; the
+        # loop queues them.
+        self.queued = []
+
+        since = None if since == FS_EVENTIDSINCENOW else since * 1000
+        for root in self.roots:
+            self.walk(root, since=since)
+        if since is not None:
+            self.add(self.roots[0], FS_FLAGHISTORYDONE, history=True)
+
+    def walk(self, path, created=False, since=None):
+        """Take the snapshot of ``path`` and the directories below it.
+
+        With ``created``, the entries are reported as created; with
+        ``since`` (in nanoseconds), the directories with a change at or
+        after that time are reported.
+        """
+
+        now = time.monotonic()
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            try:
+                stat = os.lstat(path)
+                entries, directories = FileEventCallback.scan(path)
+            except OSError:
+                continue
+            self.calls += 2 + len(entries)
+            self.snapshots.update(path, entries)
+            self.directories[path] = Directory(
+                stat.st_mtime_ns,
+                stat.st_mtime_ns >= time.time_ns() - RACY_NS,
+                self.backend.interval,
+            )
+            self.queued.append((now + self.backend.interval, path))
+            if created:
+                for name, entry in entries:
+                    self.add(os.path.join(path, name), self.flags(entry))
+            elif since is not None:
+                if stat.st_ctime_ns >= since or any(
+                    entry.st_ctime_ns >= since for name, entry in entries
+                ):
+                    self.add(path, FS_ITEMISDIR, directory=True)
+            stack.extend(directories)
+
+    def forget(self, path):
+        prefix = path + b"/"
+        for name in list(self.directories):
+            if name == path or name.startswith(prefix):
+                del self.directories[name]
+        self.snapshots.detach(path)
+
+    @staticmethod
+    def flags(stat, flags=FS_ITEMCREATED):
+        if _stat.S_ISDIR(stat.st_mode):
+            return flags | FS_ITEMISDIR
+        return flags | FS_ITEMISFILE
+
+    def poll(self, path):
+        """Poll a directory; return true if anything changed."""
+
+        directory = self.directories.get(path)
+        if directory is None:
+            return False
+        try:
+            stat = os.lstat(path)
+        except OSError:
+            # Reported as removed by its parent.
+            self.forget(path)
+            return True
+        self.calls += 1
+        snapshot = self.snapshots[path]
+        previous = dict(snapshot.items())
+
+        if stat.st_mtime_ns == directory.mtime_ns and not directory.racy:
+            # Same entries; only the files can have changed.
+            entries = []
+            for name, record in previous.items():
+                if _stat.S_ISDIR(record.st_mode):
+                    entries.append((name, record))
+                    continue
+                try:
+                    entries.append(
+                        (name, os.lstat(os.path.join(path, name)))
+                    )
+                except OSError:
+                    # Removed since; the directory will have changed.
+                    entries.append((name, record))
+                self.calls += 1
+        else:
+            try:
+                entries = FileEventCallback.scan(path)[0]
+            except OSError:
+                self.forget(path)
+                return True
+            self.calls += 1 + len(entries)
+        directory.mtime_ns = stat.st_mtime_ns
+        directory.racy = stat.st_mtime_ns >= time.time_ns() - RACY_NS
+
+        changed = False
+        current = {}
+        for name, entry in entries:
+            current[name] = entry
+            record = previous.get(name)
+            filename = os.path.join(path, name)
+            if record is None:
+                self.add(filename, self.flags(entry))
+                if _stat.S_ISDIR(entry.st_mode):
+                    self.walk(filename, created=True)
+            elif record.st_ino != entry.st_ino:
+                # Replaced.
+                flags = FS_ITEMREMOVED | FS_ITEMCREATED
+                self.add(filename, self.flags(entry, flags))
+                if _stat.S_ISDIR(record.st_mode):
+                    self.forget(filename)
+                if _stat.S_ISDIR(entry.st_mode):
+                    self.walk(filename, created=True)
+            elif _stat.S_ISDIR(entry.st_mode):
+                # Changes below are found by polling the directory.
+                continue
+            elif (
+                record.st_mtime_ns != entry.st_mtime_ns
+                or record.st_size != entry.st_size
+            ):
+                self.add(filename, self.flags(entry, FS_ITEMMODIFIED))
+            elif record.st_ctime_ns != entry.st_ctime_ns:
+                self.add(filename, self.flags(entry, FS_ITEMINODEMETAMOD))
+            else:
+                continue
+            changed = True
+        for name, record in previous.items():
+            if name not in current:
+                filename = os.path.join(path, name)
+                self.add(filename, self.flags(record, FS_ITEMREMOVED))
+                if _stat.S_ISDIR(record.st_mode):
+                    self.forget(filename)
+                changed = True
+        if changed:
+            self.snapshots.update(path, entries)
+        return changed
+
+    def add(self, path, flags, directory=False, history=False):
+        """Record an event; the flags of events on the same path within
+        a batch are combined."""
+
+        if not history and not self.cflags & FS_CFLAGFILEEVENTS:
+            # Without file events, the directory is reported.
+            if not directory:
+                path = os.path.dirname(path)
+            path = path.rstrip(b"/") + b"/"
+        if path in self.pending:
+            mask, event_id = self.pending.pop(path)
+            flags |= mask
+        self.pending[path] = flags, _next_event_id()
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.latency
+
+    def flush(self):
+        """Pass the pending events to the callback as the buffers of the
+        ``_fsevents`` contract."""
+
+        pending = self.pending
+        self.pending = {}
+        self.deadline = None
+        paths = b"".join(path + b"\0" for path in pending)
+        masks = array("I")
+        ids = array("Q")
+        for mask, event_id in pending.values():
+            masks.append(mask)
+            ids.append(event_id)
+        self.callback(paths, masks.tobytes(), ids.tobytes())
+
+
+class RunLoop(object):
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queue = []
+        self.pollers = set()
+        self.stopped = False
+        self.counter = 0
+
+
+class PollingBackend(object):
+    """Polls the directories of the streams scheduled on each thread.
+
+    A directory is polled ``interval`` seconds after it last changed,
+    backing off to ``max_interval`` while it doesn't; ``budget`` is
+    the number of ``stat`` and directory listing calls per second
+    across all streams, on all threads.
+    """
+
+    def __init__(self, interval=0.5, max_interval=30.0, budget=10000):
+        self.interval = interval
+        self.max_interval = max_interval
+        self.budget = budget
+        self.loops = {}
+        self.streams = {}
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.refilled = time.monotonic()
+
+    current_event_id = staticmethod(current_event_id)
+    event_time = staticmethod(event_time)
+
+    def _runloop(self, thread):
+        with self.lock:
+            runloop = self.loops.get(thread)
+            if runloop is None:
+                runloop = self.loops[thread] = RunLoop()
+            return runloop
+
+    def refill(self):
+        """Return the calls left in the budget."""
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.budget, self.tokens + (now - self.refilled) * self.budget
+            )
+            self.refilled = now
+            return self.tokens
+
+    def charge(self, calls):
+        with self.lock:
+            self.tokens -= calls
+
+    def enqueue(self, poller, path, due):
+        # Must be called with the condition of the loop of ``poller`` held.
+        runloop = poller.runloop
+        runloop.counter += 1
+        heapq.heappush(runloop.queue, (due, runloop.counter, poller, path))
+
+    def enqueue_walked(self, poller):
+        # Must be called with the condition of the loop of ``poller`` held.
+        queued = poller.queued
+        poller.queued = []
+        for due, path in queued:
+            self.enqueue(poller, path, due)
+
+    def schedule(
+        self, thread, stream, callback, paths, since, latency, cflags
+    ):
+        if stream in self.streams:
+            raise ValueError("Stream already scheduled.")
+        runloop = self._runloop(thread)
+        poller = Poller(self, runloop, callback, paths, since, latency, cflags)
+        self.charge(poller.calls)
+        with runloop.condition:
+            self.streams[stream] = runloop, poller
+            runloop.pollers.add(poller)
+            self.enqueue_walked(poller)
+            runloop.condition.notify()
+
+    def unschedule(self, stream):
+        item = self.streams.pop(stream, None)
+        if item is not None:
+            runloop, poller = item
+            with runloop.condition:
+                runloop.pollers.discard(poller)
+                runloop.condition.notify()
+
+    def stop(self, thread):
+        runloop = self._runloop(thread)
+        with runloop.condition:
+            runloop.stopped = True
+            runloop.condition.notify()
+
+    def loop(self, thread):
+        runloop = self._runloop(thread)
+        try:
+            self._run(runloop)
+        finally:
+            with self.lock:
+                del self.loops[thread]
+
+    def _run(self, runloop):
+        queue = runloop.queue
+        condition = runloop.condition
+        while True:
+            with condition:
+                if runloop.stopped:
+                    return
+                now = time.monotonic()
+                tokens = self.refill()
+
+                # Drop the directories of unscheduled streams.
+                while queue and queue[0][2] not in runloop.pollers:
+                    heapq.heappop(queue)
+
+                item = None
+                if queue and queue[0][0] <= now and tokens > 0:
+                    item = heapq.heappop(queue)
+
+                due = []
+                for poller in runloop.pollers:
+                    deadline = poller.deadline
+                    if deadline is not None and deadline <= now:
+                        due.append(poller)
+
+                if item is None and not due:
+                    timeouts = [
+                        poller.deadline - now
+                        for poller in runloop.pollers
+                        if poller.deadline is not None
+                    ]
+                    if queue:
+                        if tokens > 0:
+                            timeouts.append(queue[0][0] - now)
+                        else:
+                            # Wait for the budget to allow a call again.
+                            timeouts.append(-tokens / self.budget)
+                    timeout = min(timeouts) if timeouts else None
+                    if timeout is None or timeout > 0:
+                        condition.wait(timeout)
+                    continue
+            if item is not None:
+                self._poll(runloop, item[2], item[3])
+            for poller in due:
+                if poller in runloop.pollers:
+                    poller.flush()
+
+    def _poll(self, runloop, poller, path):
+        # Only the loop thread polls, so the state of the poller needs
+        # no lock; the condition is taken again to queue the next poll.
+        calls = poller.calls
+        changed = poller.poll(path)
+        self.charge(poller.calls - calls)
+        now = time.monotonic()
+        with runloop.condition:
+            if poller not in runloop.pollers:
+                return
+            self.enqueue_walked(poller)
+            directory = poller.directories.get(path)
+            if directory is not None:
+                if changed:
+                    directory.interval = self.interval
+                else:
+                    directory.interval = min(
+                        directory.interval * 2, self.max_interval
+                    )
+                self.enqueue(poller, path, now + directory.interval)
+
+
+_backend = PollingBackend()
+schedule = _backend.schedule
+unschedule = _backend.unschedule
+loop = _backend.loop
+stop = _backend.stop
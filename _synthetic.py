@@ -0,0 +1,53 @@
+"""Synthetic observer backend.
+
+Implements the ``schedule``/``unschedule``/``loop``/``stop`` contract
+of the ``_fsevents`` extension without observing anything: batches are
+fed to it, which makes it possible to exercise the Python parts of
+:mod:`fsevents` on any platform. Used by the tests and benchmarks.
+"""
+
+import threading
+from array import array
+
+
+class SyntheticBackend(object):
+    """Observer backend which delivers the batches it is fed.
+
+    ``feed`` hands a batch to the scheduled streams on the calling
+    thread, as the run loop of a real backend would.
+    """
+
+    def __init__(self):
+        self.callbacks = {}
+        self.stopped = threading.Event()
+        self.event_id = 0
+
+    def schedule(self, thread, stream, callback, *args):
+        self.callbacks[stream] = callback
+
+    def unschedule(self, stream):
+        self.callbacks.pop(stream, None)
+
+    def loop(self, thread):
+        self.stopped.wait()
+
+    def stop(self, thread):
+        self.stopped.set()
+
+    def current_event_id(self):
+        return self.event_id
+
+    def pack(self, paths, masks):
+        """Return the buffers of a batch, with new event IDs."""
+
+        start = self.event_id + 1
+        self.event_id += len(paths)
+        return (
+            b"".join(path + b"\0" for path in paths),
+            array("I", masks).tobytes(),
+            array("Q", range(start, self.event_id + 1)).tobytes(),
+        )
+
+    def feed(self, buffers):
+        for callback in list(self.callbacks.values()):
+            callback(*buffers)
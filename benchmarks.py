@@ -0,0 +1,589 @@
+"""Benchmarks for the pure-Python parts of :mod:`fsevents`.
+
+Run with ``python benchmarks.py --help``. The ``pipeline`` and
+``file_events`` benchmarks feed synthetic batches to an observer
+through :class:`_synthetic.SyntheticBackend`, so they measure the
+Python code only and run on any platform.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+def make_tree(path, depth=3, fanout=4, files=16):
+    """Create a synthetic tree; return the number of entries made."""
+
+    count = 0
+    for i in range(files):
+        with open(os.path.join(path, "file%d" % i), "w") as f:
+            f.write("x" * i)
+        count += 1
+    if depth > 0:
+        for i in range(fanout):
+            directory = os.path.join(path, "dir%d" % i)
+            os.mkdir(directory)
+            count += 1 + make_tree(directory, depth - 1, fanout, files)
+    return count
+
+
+class _CountingEntry(object):
+    __slots__ = "entry", "counter", "stats"
+
+    def __init__(self, entry, counter):
+        self.entry = entry
+        self.counter = counter
+        self.stats = set()
+
+    def __getattr__(self, name):
+        return getattr(self.entry, name)
+
+    def stat(self, follow_symlinks=True):
+        # The entry caches its stat result per ``follow_symlinks``.
+        if follow_symlinks not in self.stats:
+            self.stats.add(follow_symlinks)
+            self.counter.counts["stat"] += 1
+        return self.entry.stat(follow_symlinks=follow_symlinks)
+
+
+class _CountingScandir(object):
+    def __init__(self, iterator, counter):
+        self.iterator = iterator
+        self.counter = counter
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.iterator.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return _CountingEntry(next(self.iterator), self.counter)
+
+    def close(self):
+        self.iterator.close()
+
+
+class CallCounter(object):
+    """Count the file system calls made through the :mod:`os` module.
+
+    A directory listing (``listdir`` or ``scandir``) is an
+    ``open``/``getdents``/``close`` sequence; a ``stat`` is a single
+    ``stat`` or ``lstat`` system call, including the first ``stat()``
+    on a ``DirEntry``. File types known from the directory listing are
+    free.
+    """
+
+    def __enter__(self):
+        self.counts = {"listdir": 0, "stat": 0}
+        self.saved = os.listdir, os.scandir, os.stat, os.lstat
+        listdir, scandir, stat, lstat = self.saved
+
+        def counting(name, func):
+            def wrapper(*args, **kwargs):
+                self.counts[name] += 1
+                return func(*args, **kwargs)
+
+            return wrapper
+
+        os.listdir = counting("listdir", listdir)
+        os.stat = counting("stat", stat)
+        os.lstat = counting("stat", lstat)
+
+        def counting_scandir(*args):
+            self.counts["listdir"] += 1
+            return _CountingScandir(scandir(*args), self)
+
+        os.scandir = counting_scandir
+        return self
+
+    def __exit__(self, *args):
+        os.listdir, os.scandir, os.stat, os.lstat = self.saved
+
+
+def legacy_snapshot(path):
+    # The ``os.walk`` and ``os.lstat`` snapshot used up to 0.8.
+    snapshots = {}
+    for root, dirs, files in os.walk(os.path.realpath(path)):
+        entry = snapshots[root] = {}
+        for obj in files + dirs:
+            try:
+                entry[obj] = os.lstat(os.path.join(root, obj))
+            except OSError:
+                continue
+    return snapshots
+
+
+def legacy_rescan(path, snapshot):
+    # The per-directory listing used up to 0.8; each new entry got an
+    # ``isdir`` check.
+    current = {}
+    for name in os.listdir(path):
+        try:
+            current[name] = os.lstat(os.path.join(path, name))
+        except OSError:
+            pass
+    for name in set(current) - set(snapshot):
+        os.path.isdir(os.path.join(path, name))
+    return current
+
+
+def bench_syscalls(args):
+    from fsevents import FileEventCallback
+
+    root = os.path.realpath(tempfile.mkdtemp())
+    try:
+        entries = make_tree(root, args.depth, args.fanout, args.files)
+        print(
+            "tree: %d entries (depth=%d, fanout=%d, files=%d)"
+            % (entries, args.depth, args.fanout, args.files)
+        )
+        print("%-24s %10s %10s %10s" % ("", "listings", "stats", "seconds"))
+
+        def report(label, func):
+            with CallCounter() as counter:
+                start = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - start
+            print(
+                "%-24s %10d %10d %10.4f"
+                % (
+                    label,
+                    counter.counts["listdir"],
+                    counter.counts["stat"],
+                    elapsed,
+                )
+            )
+
+        snapshots = legacy_snapshot(root)
+        callback = FileEventCallback(lambda event: None, [root])
+        report("snapshot (before)", lambda: legacy_snapshot(root))
+        report(
+            "snapshot (after)",
+            lambda: FileEventCallback(lambda event: None, [root]),
+        )
+
+        # Rescan of the root directory after adding as many new files.
+        for i in range(args.files):
+            open(os.path.join(root, "new%d" % i), "w").close()
+        report("rescan (before)", lambda: legacy_rescan(root, snapshots[root]))
+        report(
+            "rescan (after)",
+            lambda: callback([root.encode("utf-8")], [0], [0]),
+        )
+    finally:
+        shutil.rmtree(root)
+
+
+def bench_batch(args):
+    from array import array
+
+    from fsevents import FS_ITEMCREATED, FS_ITEMREMOVED, EventBatch
+
+    count = args.events
+    paths = [
+        ("/Users/test/project/dir%d/file%d" % (i % 64, i)).encode("utf-8")
+        for i in range(count)
+    ]
+    masks = [FS_ITEMCREATED if i % 3 else FS_ITEMREMOVED for i in range(count)]
+    ids = list(range(count))
+
+    # What the backend hands over since 0.9: a buffer per column.
+    data = b"".join(path + b"\0" for path in paths)
+    mask_data = array("I", masks).tobytes()
+    id_data = array("Q", ids).tobytes()
+
+    def lists():
+        # Up to 0.8, the backend boxed every path, mask and ID and the
+        # observer decoded the paths one at a time.
+        paths = data.split(b"\0")[:-1]
+        masks = array("I", mask_data).tolist()
+        ids = array("Q", id_data).tolist()
+        decoded = [path.decode("utf-8") for path in paths]
+        events = list(zip(decoded, masks, ids))
+        removed = [i for i, mask in enumerate(masks) if mask & FS_ITEMREMOVED]
+        return events, removed
+
+    def columns():
+        batch = EventBatch.from_buffers(data, mask_data, id_data)
+        events = list(zip(batch.decode(), batch.masks, batch.ids))
+        removed = batch.where(FS_ITEMREMOVED)
+        return events, removed
+
+    assert lists()[0] == columns()[0]
+    print("batch: %d events, best of %d rounds" % (count, args.rounds))
+    print("%-24s %10s" % ("", "seconds"))
+    benchmarks = ("lists (before)", lists), ("columns (after)", columns)
+    for label, func in benchmarks:
+        elapsed = []
+        for i in range(args.rounds):
+            start = time.perf_counter()
+            func()
+            elapsed.append(time.perf_counter() - start)
+        print("%-24s %10.4f" % (label, min(elapsed)))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report_batches(label, events, latencies):
+    total = sum(latencies)
+    print(
+        "%-24s %12.0f %10.3f %10.3f %10.3f %10.3f"
+        % (
+            label,
+            events / total,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.9) * 1000,
+            percentile(latencies, 0.99) * 1000,
+            max(latencies) * 1000,
+        )
+    )
+
+
+def walk_tree(root):
+    directories = []
+    files = []
+    for path, dirs, names in os.walk(root):
+        directories.append(path.encode("utf-8"))
+        files.extend(
+            os.path.join(path, name).encode("utf-8") for name in names
+        )
+    return directories, files
+
+
+def run_batches(args, root, stream_options, paths, masks):
+    from _synthetic import SyntheticBackend
+    from fsevents import Observer, Stream
+
+    backend = SyntheticBackend()
+    batches = [
+        backend.pack(paths[i:i + args.batch], masks[i:i + args.batch])
+        for i in range(0, len(paths), args.batch)
+    ]
+    delivered = []
+    stream = Stream(delivered.append, root, batch=True, **stream_options)
+    observer = Observer(backend=backend)
+    observer.schedule(stream)
+    observer.start()
+    latencies = []
+    try:
+        for round in range(args.rounds):
+            for buffers in batches:
+                start = time.perf_counter()
+                backend.feed(buffers)
+                latencies.append(time.perf_counter() - start)
+            del delivered[:]
+    finally:
+        observer.stop()
+        observer.unschedule(stream)
+        observer.join()
+    return len(paths) * args.rounds, latencies
+
+
+def batch_header(args, entries):
+    print(
+        "tree: %d entries (depth=%d, fanout=%d, files=%d), "
+        "batches of %d, %d rounds"
+        % (entries, args.depth, args.fanout, args.files, args.batch,
+           args.rounds)
+    )
+    print(
+        "%-24s %12s %10s %10s %10s %10s"
+        % ("", "events/s", "p50 ms", "p90 ms", "p99 ms", "max ms")
+    )
+
+
+def bench_pipeline(args):
+    from fsevents import (
+        FS_CFLAGFILEEVENTS,
+        FS_ITEMISFILE,
+        FS_ITEMMODIFIED,
+        ShardedDispatcher
+    )
+
+    root = os.path.realpath(tempfile.mkdtemp())
+    try:
+        entries = make_tree(root, args.depth, args.fanout, args.files)
+        batch_header(args, entries)
+        files = walk_tree(root)[1]
+        masks = [FS_ITEMMODIFIED | FS_ITEMISFILE] * len(files)
+        variants = [
+            ("path events", {"flags": FS_CFLAGFILEEVENTS}),
+            ("path events, ids", {"flags": FS_CFLAGFILEEVENTS, "ids": True}),
+            ("path events, filter", {
+                "flags": FS_CFLAGFILEEVENTS, "exclude": ["dir0", "*.o"]
+            }),
+        ]
+        for label, options in variants:
+            report_batches(
+                label, *run_batches(args, root, options, files, masks)
+            )
+
+        # Through a dispatcher, the feed only measures the handoff.
+        dispatcher = ShardedDispatcher(workers=4, maxsize=1 << 20)
+        options = {"flags": FS_CFLAGFILEEVENTS, "dispatcher": dispatcher}
+        report_batches(
+            "path events, dispatcher",
+            *run_batches(args, root, options, files, masks)
+        )
+    finally:
+        shutil.rmtree(root)
+
+
+def bench_file_events(args):
+    root = os.path.realpath(tempfile.mkdtemp())
+    try:
+        entries = make_tree(root, args.depth, args.fanout, args.files)
+        batch_header(args, entries)
+        directories = walk_tree(root)[0]
+        paths = [path + b"/" for path in directories]
+        masks = [0] * len(paths)
+        for compare in ("mtime", "fingerprint"):
+            options = {"file_events": True, "compare": compare}
+            report_batches(
+                "rescans (%s)" % compare,
+                *run_batches(args, root, options, paths, masks)
+            )
+    finally:
+        shutil.rmtree(root)
+
+
+def bench_stages(args):
+    from fsevents import StageProfiler
+
+    root = os.path.realpath(tempfile.mkdtemp())
+    try:
+        entries = make_tree(root, args.depth, args.fanout, args.files)
+        batch_header(args, entries)
+        directories = walk_tree(root)[0]
+        paths = [path + b"/" for path in directories]
+        masks = [0] * len(paths)
+        profiler = StageProfiler()
+        for label, tracer in (("untraced", None), ("traced", profiler)):
+            options = {"file_events": True, "tracer": tracer}
+            report_batches(
+                "rescans (%s)" % label,
+                *run_batches(args, root, options, paths, masks)
+            )
+        print()
+        print("%-24s %10s %12s %10s" % ("", "calls", "items", "seconds"))
+        for stage, totals in sorted(profiler.counters().items()):
+            print(
+                "%-24s %10d %12d %10.4f"
+                % (stage, totals["calls"], totals["count"], totals["seconds"])
+            )
+    finally:
+        shutil.rmtree(root)
+
+
+def bench_event_log(args):
+    from fsevents import IN_MODIFY, EventLog, EventLogReader, FileEvent
+
+    count = args.events
+    events = [
+        FileEvent(
+            IN_MODIFY, None, "/Users/test/project/dir%d/file%d" % (i % 64, i)
+        )
+        for i in range(count)
+    ]
+    batches = [
+        events[i:i + args.batch] for i in range(0, count, args.batch)
+    ]
+    print(
+        "event_log: %d events in batches of %d, best of %d rounds"
+        % (count, args.batch, args.rounds)
+    )
+    print("%-24s %10s %12s" % ("", "seconds", "events/s"))
+    timings = {"write": [], "read": []}
+    for i in range(args.rounds):
+        directory = tempfile.mkdtemp()
+        try:
+            log = EventLog(directory, segment_size=4 << 20)
+            start = time.perf_counter()
+            for batch in batches:
+                log(batch)
+            timings["write"].append(time.perf_counter() - start)
+            log.close()
+            start = time.perf_counter()
+            with EventLogReader(directory) as reader:
+                assert len(reader.read()) == count
+            timings["read"].append(time.perf_counter() - start)
+        finally:
+            shutil.rmtree(directory)
+    for label in ("write", "read"):
+        elapsed = min(timings[label])
+        print("%-24s %10.4f %12.0f" % (label, elapsed, count / elapsed))
+
+
+def _drain_ring(name, consumer, queue):
+    from fsevents import SharedRingReader
+
+    with SharedRingReader(name, consumer) as reader:
+        queue.put(None)
+        queue.put(sum(1 for event in reader))
+
+
+def _drain_queue(source, queue):
+    queue.put(None)
+    count = 0
+    while True:
+        events = source.get()
+        if events is None:
+            break
+        count += len(events)
+    queue.put(count)
+
+
+def bench_shared_ring(args, workers=4):
+    import multiprocessing
+
+    from fsevents import IN_MODIFY, FileEvent, SharedRing
+
+    count = args.events
+    events = [
+        FileEvent(
+            IN_MODIFY, None, "/Users/test/project/dir%d/file%d" % (i % 64, i)
+        )
+        for i in range(count)
+    ]
+    batches = [
+        events[i:i + args.batch] for i in range(0, count, args.batch)
+    ]
+
+    def run(target, args, put, close):
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=target, args=args(i) + (results,))
+            for i in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            results.get()
+        start = time.perf_counter()
+        for batch in batches:
+            put(batch)
+        close()
+        counts = [results.get() for process in processes]
+        elapsed = time.perf_counter() - start
+        assert counts == [count] * workers, counts
+        for process in processes:
+            process.join()
+        return elapsed
+
+    def queue():
+        # Each delivery is pickled once per worker.
+        sources = [multiprocessing.Queue() for i in range(workers)]
+
+        def put(batch):
+            for source in sources:
+                source.put(batch)
+
+        def close():
+            put(None)
+
+        return run(_drain_queue, lambda i: (sources[i],), put, close)
+
+    def ring():
+        # Each delivery is written once for all workers.
+        ring = SharedRing(capacity=4096, consumers=workers, block=True)
+        return run(_drain_ring, lambda i: (ring.name, i), ring, ring.close)
+
+    print(
+        "shared_ring: %d events to each of %d worker processes, "
+        "best of %d rounds" % (count, workers, args.rounds)
+    )
+    print("%-24s %10s %12s" % ("", "seconds", "events/s"))
+    for label, func in ("pickled queues", queue), ("shared ring", ring):
+        elapsed = min(func() for i in range(args.rounds))
+        print("%-24s %10.4f %12.0f" % (label, elapsed, count / elapsed))
+
+
+def bench_snapshot(args):
+    from fsevents import FileEventCallback
+
+    root = os.path.realpath(tempfile.mkdtemp())
+    try:
+        entries = make_tree(root, args.depth, args.fanout, args.files)
+        print(
+            "tree: %d entries (depth=%d, fanout=%d, files=%d)"
+            % (entries, args.depth, args.fanout, args.files)
+        )
+        print(
+            "%-24s %10s %12s %12s"
+            % ("", "seconds", "peak bytes", "store bytes")
+        )
+        for workers in (1, 4):
+            for compare in ("mtime", "fingerprint"):
+                tracemalloc.start()
+                start = time.perf_counter()
+                callback = FileEventCallback(
+                    lambda event: None,
+                    [root],
+                    workers=workers,
+                    compare=compare,
+                )
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                usage = callback.snapshots.memory_usage()
+                print(
+                    "%-24s %10.4f %12d %12d"
+                    % (
+                        "%s, %d worker(s)" % (compare, workers),
+                        elapsed,
+                        peak,
+                        usage["total_bytes"],
+                    )
+                )
+    finally:
+        shutil.rmtree(root)
+
+
+benchmarks = {
+    "syscalls": bench_syscalls,
+    "batch": bench_batch,
+    "pipeline": bench_pipeline,
+    "file_events": bench_file_events,
+    "snapshot": bench_snapshot,
+    "stages": bench_stages,
+    "event_log": bench_event_log,
+    "shared_ring": bench_shared_ring,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--files", type=int, default=16)
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--batch", type=int, default=256)
+    parser.add_argument(
+        "benchmark",
+        nargs="*",
+        default=["syscalls"],
+        choices=sorted(benchmarks) + ["all"],
+    )
+    args = parser.parse_args(argv)
+    names = args.benchmark
+    if "all" in names:
+        names = sorted(benchmarks)
+    for name in names:
+        print("== %s" % name)
+        benchmarks[name](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,36 +1,78 @@
+import asyncio
+import hashlib
+import importlib
+import json
+import mmap
 import os
+import re
+import stat as _stat
+import struct
 import sys
 import threading
+import time
 import unicodedata
+import zlib
+from array import array
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import compress
+from multiprocessing import shared_memory
 
-from _fsevents import (
-    FS_CFLAGFILEEVENTS,
-    FS_CFLAGNONE,
-    FS_EVENTIDSINCENOW,
-    FS_FLAGEVENTIDSWRAPPED,
-    FS_FLAGHISTORYDONE,
-    FS_FLAGKERNELDROPPED,
-    FS_FLAGMOUNT,
-    FS_FLAGMUSTSCANSUBDIRS,
-    FS_FLAGROOTCHANGED,
-    FS_FLAGUNMOUNT,
-    FS_FLAGUSERDROPPED,
-    FS_ITEMCHANGEOWNER,
-    FS_ITEMCREATED,
-    FS_ITEMFINDERINFOMOD,
-    FS_ITEMINODEMETAMOD,
-    FS_ITEMISDIR,
-    FS_ITEMISFILE,
-    FS_ITEMISSYMLINK,
-    FS_ITEMMODIFIED,
-    FS_ITEMREMOVED,
-    FS_ITEMRENAMED,
-    FS_ITEMXATTRMOD,
-    loop,
-    schedule,
-    stop,
-    unschedule
-)
+try:
+    import _fsevents as default_backend
+    from _fsevents import (
+        FS_CFLAGFILEEVENTS,
+        FS_CFLAGNONE,
+        FS_EVENTIDSINCENOW,
+        FS_FLAGEVENTIDSWRAPPED,
+        FS_FLAGHISTORYDONE,
+        FS_FLAGKERNELDROPPED,
+        FS_FLAGMOUNT,
+        FS_FLAGMUSTSCANSUBDIRS,
+        FS_FLAGROOTCHANGED,
+        FS_FLAGUNMOUNT,
+        FS_FLAGUSERDROPPED,
+        FS_ITEMCHANGEOWNER,
+        FS_ITEMCREATED,
+        FS_ITEMFINDERINFOMOD,
+        FS_ITEMINODEMETAMOD,
+        FS_ITEMISDIR,
+        FS_ITEMISFILE,
+        FS_ITEMISSYMLINK,
+        FS_ITEMMODIFIED,
+        FS_ITEMREMOVED,
+        FS_ITEMRENAMED,
+        FS_ITEMXATTRMOD,
+        current_event_id
+    )
+except ImportError:
+    # Not on Mac OS X; use the inotify implementation.
+    import _inotify as default_backend
+    from _inotify import (
+        FS_CFLAGFILEEVENTS,
+        FS_CFLAGNONE,
+        FS_EVENTIDSINCENOW,
+        FS_FLAGEVENTIDSWRAPPED,
+        FS_FLAGHISTORYDONE,
+        FS_FLAGKERNELDROPPED,
+        FS_FLAGMOUNT,
+        FS_FLAGMUSTSCANSUBDIRS,
+        FS_FLAGROOTCHANGED,
+        FS_FLAGUNMOUNT,
+        FS_FLAGUSERDROPPED,
+        FS_ITEMCHANGEOWNER,
+        FS_ITEMCREATED,
+        FS_ITEMFINDERINFOMOD,
+        FS_ITEMINODEMETAMOD,
+        FS_ITEMISDIR,
+        FS_ITEMISFILE,
+        FS_ITEMISSYMLINK,
+        FS_ITEMMODIFIED,
+        FS_ITEMREMOVED,
+        FS_ITEMRENAMED,
+        FS_ITEMXATTRMOD,
+        current_event_id
+    )
 
 
 class Mask(int):
@@ -79,6 +121,12 @@ IN_DELETE = 0x00000200
 IN_MOVED_FROM = 0x00000040
 IN_MOVED_TO = 0x00000080
 
+IN_Q_OVERFLOW = 0x00004000
+
+# Reported for a directory that changed before the background snapshot
+# got to it; its contents before the change are unknown.
+IN_INITIAL = 0x00001000
+
 if sys.version_info[0] >= 3:
     unicode = str
 
@@ -91,22 +139,82 @@ def check_path_string_type(*paths):
             )
 
 
+# Backends which can be selected by name.
+backends = {
+    "fsevents": "_fsevents",
+    "inotify": "_inotify",
+    "polling": "_polling",
+}
+
+
+def _merge_stats(streams):
+    result = {
+        "events": 0,
+        "batches": 0,
+        "batch_sizes": {},
+        "deliveries": 0,
+        "delivered_events": 0,
+        "busy": 0.0,
+        "rescans": 0,
+        "listdir": 0,
+        "lstat": 0,
+        "snapshot_entries": 0,
+        "snapshot_bytes": 0,
+        "handling_time": 0.0,
+        "lag": None,
+        "age": 0.0,
+        "streams": [],
+    }
+    for stream in streams:
+        stats = stream.stats()
+        for key, value in stats.items():
+            if key == "lag":
+                if value is not None:
+                    result[key] = max(result[key] or 0.0, value["max"])
+            elif key in ("handling_time", "age"):
+                if isinstance(value, dict):
+                    value = value["max"]
+                result[key] = max(result[key], value)
+            elif key == "batch_sizes":
+                sizes = result[key]
+                for size, count in value.items():
+                    sizes[size] = sizes.get(size, 0) + count
+            elif key in result and key != "streams":
+                result[key] += value
+        result["streams"].append(stats)
+    return result
+
+
 class Observer(threading.Thread):
     event = None
     runloop = None
 
-    def __init__(self):
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = default_backend
+        elif isinstance(backend, str):
+            backend = importlib.import_module(backends[backend])
+        self.backend = backend
         self.streams = set()
         self.schedulings = {}
         self.lock = threading.Lock()
+        self.started = threading.Event()
         threading.Thread.__init__(self)
 
+    def start(self):
+        threading.Thread.start(self)
+
+        # streams registered up front are scheduled when we return
+        self.started.wait()
+
     def run(self):
         # wait until we have streams registered
         while not self.streams:
             self.event = threading.Event()
+            self.started.set()
             self.event.wait()
             if self.event is None:
+                self.started.set()
                 return
             self.event = None
 
@@ -120,37 +228,213 @@ class Observer(threading.Thread):
             self.streams = None
         finally:
             self.lock.release()
+            self.started.set()
 
         # start run-loop
-        loop(self)
+        self.backend.loop(self)
 
     def _schedule(self, stream):
         if not stream.paths:
             raise ValueError("No paths to observe.")
+        since = stream.since
+        checkpoint = stream.checkpoint
+        if (
+            checkpoint is not None
+            and since == FS_EVENTIDSINCENOW
+            and stream.snapshot_cache is None
+        ):
+            since = checkpoint.get(stream.checkpoint_key, since)
+        stages = []
+        deliver = stream.deliver
+        if stream.dispatcher is not None:
+            deliver = stream.dispatcher
+            deliver.start(stream.deliver, stream.overflow_events)
+            stages.append(deliver)
+        if stream.coalesce is not None:
+            deliver = Coalescer(deliver, stream.coalesce)
+            stages.append(deliver)
+
         if stream.file_events:
-            callback = FileEventCallback(stream.callback, stream.raw_paths)
+            callback = FileEventCallback(
+                deliver,
+                stream.raw_paths,
+                workers=stream.snapshot_workers,
+                background=stream.background_snapshot,
+                cache=stream.snapshot_cache,
+                compare=stream.compare,
+                batch=True,
+                filter=stream.filter,
+                event_id=self.backend.current_event_id(),
+                tracer=stream.tracer,
+                move_window=stream.move_window,
+                rescan_budget=stream.rescan_budget,
+            )
+
+            # Resume from where the cached snapshot left off.
+            if (
+                stream.snapshot_cache is not None
+                and since == FS_EVENTIDSINCENOW
+            ):
+                since = callback.event_id
+
+            stream.file_event_callback = callback
+
+            def handle(batch):
+                callback(batch.paths(), batch.masks, batch.ids)
+
         else:
 
-            def callback(paths, masks, ids):
-                for path, mask, id in zip(paths, masks, ids):
-                    if sys.version_info[0] >= 3:
-                        path = path.decode("utf-8")
-                    if stream.ids is False:
-                        stream.callback(path, mask)
-                    elif stream.ids is True:
-                        stream.callback(path, mask, id)
+            def handle(batch):
+                tracer = stream.tracer
+                if stream.filter is not None:
+                    if tracer is not None:
+                        span = tracer.start("filter")
+                    includes = stream.filter.includes
+                    # Include patterns apply to the paths of files.
+                    files = FS_ITEMISFILE | FS_ITEMISSYMLINK
+                    batch = batch.select(
+                        [
+                            i
+                            for i, (path, mask) in enumerate(
+                                zip(batch.paths(), batch.masks)
+                            )
+                            if includes(path, not mask & files)
+                        ]
+                    )
+                    if tracer is not None:
+                        tracer.end("filter", span, len(batch))
+                    if not batch:
+                        return
+                if tracer is not None:
+                    span = tracer.start("decode")
+                if sys.version_info[0] >= 3:
+                    paths = batch.decode()
+                else:
+                    paths = batch.paths()
+                if stream.ids:
+                    events = list(zip(paths, batch.masks, batch.ids))
+                else:
+                    events = list(zip(paths, batch.masks))
+                if tracer is not None:
+                    tracer.end("decode", span, len(events))
+                    span = tracer.start("callback")
+                deliver(events)
+                if tracer is not None:
+                    tracer.end("callback", span, len(events))
+
+            callback = handle
+
+        statistics = stream.statistics
+        # Backends whose event IDs are timestamps tell the time of an
+        # event, from which the lag of its delivery follows.
+        event_time = getattr(self.backend, "event_time", None)
+
+        # An event ID is checkpointed once the events up to it have
+        # made it through every stage.
+        idle = [stage.idle for stage in stages]
+        if stream.file_events:
+            idle.append(callback.idle)
+        handed = [0]
+
+        def commit():
+            if checkpoint is not None and handed[0]:
+                checkpoint.advance(stream.checkpoint_key, handed[0])
+
+        def settle():
+            # Read the ID first: its events were handed on before it
+            # was recorded, so they are seen by the idle checks.
+            event_id = handed[0]
+            if event_id and all(stage() for stage in idle):
+                checkpoint.advance(stream.checkpoint_key, event_id)
+
+        if checkpoint is not None:
+            # The last batch may still be held when it is handled.
+            for stage in stages:
+                stage.drained = settle
+            if stream.file_events:
+                callback.drained = settle
 
-        schedule(
+        # Held while a batch is handled, so that a stream moved to
+        # another observer is not handled on two threads at once.
+        delivering = threading.Lock()
+        # The last event ID handled before the stream was moved.
+        floor = [0]
+
+        def handler(paths, masks, ids):
+            with delivering:
+                tracer = stream.tracer
+                if tracer is not None:
+                    span = tracer.start("batch")
+                batch = EventBatch.from_buffers(paths, masks, ids)
+                if floor[0]:
+                    # Not asked for; the stream was moved.
+                    batch = batch.select(
+                        [
+                            i
+                            for i, (mask, event_id) in enumerate(
+                                zip(batch.masks, batch.ids)
+                            )
+                            if event_id > floor[0]
+                            and not mask & FS_FLAGHISTORYDONE
+                        ]
+                    )
+                if tracer is not None:
+                    tracer.end("batch", span, len(batch))
+                event_id = max(batch.ids) if batch else 0
+                oldest = None
+                if event_time is not None and batch:
+                    oldest = event_time(min(batch.ids))
+                start = statistics.received(len(batch), event_id)
+                try:
+                    handle(batch)
+                finally:
+                    statistics.handled(start, event_id, oldest)
+                if checkpoint is not None:
+                    handed[0] = max(handed[0], event_id)
+                    settle()
+
+        scheduling = callback, stages, commit, handler, delivering, floor
+        self._attach(stream, scheduling, since)
+
+    def _attach(self, stream, scheduling, since):
+        # Called with the lock held.
+        self.schedulings[stream] = scheduling
+        self.backend.schedule(
             self,
             stream,
-            callback,
+            scheduling[3],
             stream.paths,
-            stream.since,
+            since,
             stream.latency,
             stream.cflags,
         )
 
+    def _detach(self, stream):
+        """Stop observing ``stream`` without closing it; return its
+        scheduling and the last event ID handled."""
+
+        with self.lock:
+            since = self.backend.current_event_id()
+            self.backend.unschedule(stream)
+            scheduling = self.schedulings.pop(stream)
+        # Wait for a batch being handled.
+        with scheduling[4]:
+            pass
+        return scheduling, stream.statistics.event_id or since
+
+    def _adopt(self, stream, scheduling, since):
+        """Observe a stream detached from another running observer,
+        from now on; events up to ``since`` are dropped."""
+
+        # Replaying the history from ``since`` would report changes
+        # again, and the backends other than FSEvents can only report
+        # the directories changed since then.
+        scheduling[5][0] = max(scheduling[5][0], since)
+        with self.lock:
+            self._attach(stream, scheduling, FS_EVENTIDSINCENOW)
+
     def schedule(self, stream):
+        waiting = False
         self.lock.acquire()
         try:
             if self.streams is None:
@@ -160,29 +444,237 @@ class Observer(threading.Thread):
             else:
                 self.streams.add(stream)
                 if self.event is not None:
+                    self.started.clear()
                     self.event.set()
+                    waiting = True
         finally:
             self.lock.release()
 
+        # the observer thread schedules the stream
+        if waiting:
+            self.started.wait()
+
     def unschedule(self, stream):
         self.lock.acquire()
         try:
             if self.streams is None:
-                unschedule(stream)
+                self.backend.unschedule(stream)
+                callback, stages, commit = self.schedulings.pop(stream)[:3]
+                if stream.file_events:
+                    callback.close()
+                # Later stages deliver into earlier ones.
+                for stage in reversed(stages):
+                    stage.close()
+                stream.close()
+                if stream.checkpoint is not None:
+                    commit()
+                    stream.checkpoint.flush()
+                if stream.file_events and stream.snapshot_cache is not None:
+                    callback.save(stream.snapshot_cache)
             else:
                 self.streams.remove(stream)
         finally:
             self.lock.release()
 
+    def stats(self):
+        """Return the counters of the scheduled streams, summed up, with
+        the largest ``handling_time``, ``lag`` and ``age`` of any
+        stream and the counters of each stream in ``streams``; see
+        :meth:`Stream.stats`."""
+
+        with self.lock:
+            if self.streams is None:
+                streams = list(self.schedulings)
+            else:
+                streams = list(self.streams)
+        return _merge_stats(streams)
+
     def stop(self):
         if self.event is None:
-            stop(self)
+            self.backend.stop(self)
         else:
             event = self.event
             self.event = None
             event.set()
 
 
+class ObserverPool(object):
+    """Spread streams over ``threads`` observers, each with its own
+    thread and run loop.
+
+    A stream is scheduled on the observer with the least load: the
+    share of time its thread is busy handling batches (see ``busy``
+    in :meth:`Stream.stats`), with each stream counting for at least
+    ``tolerance``. After a stream is scheduled or unscheduled, streams
+    are moved from the busiest observer to the least busy one as long
+    as that narrows the gap between them. A moved stream keeps its
+    state and sinks, and is scheduled again from the current event
+    without replaying history; events it has already handled are
+    dropped. The only stream of an observer is not moved.
+    """
+
+    def __init__(self, threads=4, backend=None, tolerance=0.01):
+        self.backend = backend
+        self.tolerance = tolerance
+        self.observers = [Observer(backend=backend) for i in range(threads)]
+        self.placement = {}
+        self.samples = {}
+        self.lock = threading.Lock()
+        self.started = False
+        self.moves = 0
+
+    def start(self):
+        with self.lock:
+            self.started = True
+            for observer in self.observers:
+                observer.start()
+
+    def _weights(self):
+        # The load of a stream is measured over the time since it was
+        # last measured, if at least a tenth of a second ago.
+        now = time.monotonic()
+        weights = {}
+        for stream in self.placement:
+            busy = stream.statistics.busy
+            then, spent, load = self.samples.get(stream, (now, busy, 0.0))
+            if now - then >= 0.1:
+                load = (busy - spent) / (now - then)
+                then, spent = now, busy
+            self.samples[stream] = then, spent, load
+            weights[stream] = max(load, self.tolerance)
+        return weights
+
+    def _totals(self, weights):
+        totals = dict((observer, 0.0) for observer in self.observers)
+        for stream, observer in self.placement.items():
+            totals[observer] += weights[stream]
+        return totals
+
+    def _movable(self, observer):
+        if not self.started:
+            return True
+        return observer.streams is None and observer.is_alive()
+
+    def schedule(self, stream):
+        with self.lock:
+            if stream in self.placement:
+                raise ValueError("Stream already scheduled.")
+            if self.started:
+                # On Mac OS X, the run loop of an observer returns once
+                # its last stream is unscheduled.
+                for i, observer in enumerate(self.observers):
+                    if observer.streams is None and not observer.is_alive():
+                        self.observers[i] = Observer(backend=self.backend)
+                        self.observers[i].start()
+            totals = self._totals(self._weights())
+            observer = min(self.observers, key=totals.get)
+            observer.schedule(stream)
+            self.placement[stream] = observer
+            self._rebalance()
+
+    def unschedule(self, stream):
+        with self.lock:
+            observer = self.placement.pop(stream)
+            self.samples.pop(stream, None)
+            observer.unschedule(stream)
+            self._rebalance()
+
+    def rebalance(self):
+        """Move streams between observers to even out their load."""
+
+        with self.lock:
+            self._rebalance()
+
+    def _rebalance(self):
+        weights = self._weights()
+        totals = self._totals(weights)
+        for i in range(len(self.placement)):
+            observers = [
+                observer
+                for observer in self.observers
+                if self._movable(observer)
+            ]
+            if len(observers) < 2:
+                return
+            source = max(observers, key=totals.get)
+            target = min(observers, key=totals.get)
+            gap = totals[source] - totals[target]
+            streams = [
+                stream
+                for stream, observer in self.placement.items()
+                if observer is source
+            ]
+            candidates = [
+                stream
+                for stream in streams
+                if weights[stream] < gap - self.tolerance / 2
+            ]
+            if len(streams) < 2 or not candidates:
+                return
+            stream = min(
+                candidates, key=lambda stream: abs(weights[stream] - gap / 2)
+            )
+            self._move(stream, source, target)
+            totals[source] -= weights[stream]
+            totals[target] += weights[stream]
+
+    def _move(self, stream, source, target):
+        if self.started:
+            scheduling, since = source._detach(stream)
+            target._adopt(stream, scheduling, since)
+        else:
+            source.unschedule(stream)
+            target.schedule(stream)
+        self.placement[stream] = target
+        self.moves += 1
+
+    def stats(self):
+        """Return the counters of all streams, summed up as with
+        :meth:`Observer.stats`, with the number of ``moves`` and the
+        number of ``streams`` and ``load`` of each of the
+        ``observers``."""
+
+        with self.lock:
+            streams = list(self.placement)
+            totals = self._totals(self._weights())
+            observers = [
+                {
+                    "streams": sum(
+                        1 for placed in self.placement.values()
+                        if placed is observer
+                    ),
+                    "load": totals[observer],
+                }
+                for observer in self.observers
+            ]
+            moves = self.moves
+        result = _merge_stats(streams)
+        result["observers"] = observers
+        result["moves"] = moves
+        return result
+
+    def stop(self):
+        """Stop the observers."""
+
+        with self.lock:
+            if not self.started:
+                return
+            for observer in self.observers:
+                observer.stop()
+
+    def join(self, timeout=None):
+        """Wait for the observers to stop."""
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for observer in list(self.observers):
+            if observer.ident is None:
+                continue
+            if deadline is None:
+                observer.join()
+            else:
+                observer.join(max(0, deadline - time.monotonic()))
+
+
 class Stream(object):
     def __init__(self, callback, *paths, **options):
         file_events = options.pop("file_events", False)
@@ -190,10 +682,28 @@ class Stream(object):
         cflags = options.pop("flags", FS_CFLAGNONE)
         latency = options.pop("latency", 0.01)
         ids = options.pop("ids", False)
+        snapshot_workers = options.pop("snapshot_workers", 1)
+        background_snapshot = options.pop("background_snapshot", False)
+        snapshot_cache = options.pop("snapshot_cache", None)
+        compare = options.pop("compare", "mtime")
+        batch = options.pop("batch", False)
+        coalesce = options.pop("coalesce", None)
+        dispatcher = options.pop("dispatcher", None)
+        include = options.pop("include", ())
+        exclude = options.pop("exclude", ())
+        tracer = options.pop("tracer", None)
+        move_window = options.pop("move_window", None)
+        rescan_budget = options.pop("rescan_budget", 10000)
+        checkpoint = options.pop("checkpoint", None)
+        checkpoint_key = options.pop("checkpoint_key", None)
         assert len(options) == 0, "Invalid option(s): %s" % repr(
             options.keys()
         )
         check_path_string_type(*paths)
+        if coalesce is not None and not file_events:
+            raise ValueError("Coalescing requires file events.")
+        if move_window is not None and not file_events:
+            raise ValueError("Move correlation requires file events.")
 
         self.callback = callback
         self.raw_paths = paths
@@ -209,6 +719,443 @@ class Stream(object):
         self.cflags = cflags
         self.latency = latency
         self.ids = ids
+        self.snapshot_workers = snapshot_workers
+        self.background_snapshot = background_snapshot
+        self.snapshot_cache = snapshot_cache
+        self.compare = compare
+        self.batch = batch
+        self.coalesce = coalesce
+        self.dispatcher = dispatcher
+        self.filter = None
+        if include or exclude:
+            self.filter = PathFilter(include, exclude)
+        self.sinks = []
+        self.statistics = Statistics()
+        self.file_event_callback = None
+        self.tracer = tracer
+        self.move_window = move_window
+        self.rescan_budget = rescan_budget
+        if checkpoint is not None and not isinstance(
+            checkpoint, CheckpointStore
+        ):
+            # Streams sharing a file must share the store writing it.
+            raise TypeError(
+                "Checkpoint must be a CheckpointStore, not '%s'."
+                % type(checkpoint).__name__
+            )
+        self.checkpoint = checkpoint
+        if checkpoint_key is None:
+            checkpoint_key = "\n".join(
+                os.path.realpath(path) for path in paths
+            )
+        self.checkpoint_key = checkpoint_key
+
+    def deliver(self, events):
+        """Pass a list of events on to the callback and sinks."""
+
+        start = time.perf_counter()
+        if self.callback is None:
+            pass
+        elif self.batch:
+            self.callback(events)
+        elif self.file_events:
+            for event in events:
+                self.callback(event)
+        else:
+            for event in events:
+                self.callback(*event)
+
+        for sink in self.sinks:
+            sink(events)
+        self.statistics.delivered(len(events), time.perf_counter() - start)
+
+    def stats(self):
+        """Return a snapshot of the counters of the stream; see
+        :meth:`Statistics.snapshot`.
+
+        With file events, the directories rescanned, the ``listdir``
+        and ``lstat`` calls made and the number of entries and
+        approximate memory of the snapshot are included; with a
+        dispatcher, its counters under ``dispatcher``.
+        """
+
+        stats = self.statistics.snapshot()
+        callback = self.file_event_callback
+        if callback is not None:
+            stats.update(callback.counters())
+        if self.dispatcher is not None:
+            stats["dispatcher"] = self.dispatcher.counters()
+        return stats
+
+    def trace(self, tracer):
+        """Attach a :class:`Tracer` to the stream, or detach it with
+        ``None``; takes effect from the next batch."""
+
+        self.tracer = tracer
+        if self.file_event_callback is not None:
+            self.file_event_callback.tracer = tracer
+
+    def overflow_events(self):
+        """Return the events that tell the callback to rescan the
+        stream's paths, for when events had to be dropped."""
+
+        if self.file_events:
+            return [
+                FileEvent(IN_Q_OVERFLOW, None, os.path.realpath(path))
+                for path in self.raw_paths
+            ]
+        mask = FS_FLAGMUSTSCANSUBDIRS | FS_FLAGUSERDROPPED
+        if self.ids:
+            return [(path, mask, 0) for path in self.raw_paths]
+        return [(path, mask) for path in self.raw_paths]
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def aiter(self, maxsize=1024, batch=False, loop=None):
+        """Return an asynchronous iterator over the events of the
+        stream; see :class:`AsyncEventIterator`."""
+
+        iterator = AsyncEventIterator(maxsize, batch, loop)
+        self.sinks.append(iterator)
+        return iterator
+
+    def event_log(self, directory, **options):
+        """Write the events of the stream to the log in ``directory``
+        and return it; see :class:`EventLog`."""
+
+        log = EventLog(directory, **options)
+        self.sinks.append(log)
+        return log
+
+    def shared_ring(self, **options):
+        """Pass the events of the stream to worker processes through a
+        ring in shared memory and return it; see :class:`SharedRing`."""
+
+        ring = SharedRing(**options)
+        self.sinks.append(ring)
+        return ring
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {"p50": 0.0, "p90": 0.0, "p99": 0.0, "max": 0.0}
+    count = len(values)
+    return {
+        "p50": values[count // 2],
+        "p90": values[min(count - 1, count * 9 // 10)],
+        "p99": values[min(count - 1, count * 99 // 100)],
+        "max": values[-1],
+    }
+
+
+class Statistics(object):
+    """Runtime counters of a stream.
+
+    Updated once per batch by the observer thread and once per
+    delivery by the thread calling the callback; :meth:`snapshot` may
+    be called from any thread. Durations are kept for the last
+    ``window`` batches and deliveries.
+    """
+
+    def __init__(self, window=1024):
+        self.lock = threading.Lock()
+        self.events = 0
+        self.batches = 0
+        self.batch_sizes = [0] * 33
+        self.event_id = 0
+        self.delivered_id = 0
+        self.deliveries = 0
+        self.delivered_events = 0
+        self.received_at = None
+        self.current = None
+        self.busy = 0.0
+        self.handling_times = deque(maxlen=window)
+        self.lags = deque(maxlen=window)
+        self.callback_times = deque(maxlen=window)
+
+    def received(self, count, event_id):
+        """Record a batch from the backend; returns its start time, to
+        be passed to :meth:`handled`."""
+
+        now = time.monotonic()
+        with self.lock:
+            self.events += count
+            self.batches += 1
+            if count:
+                self.batch_sizes[min(32, (count - 1).bit_length())] += 1
+            self.event_id = max(self.event_id, event_id)
+            self.received_at = self.current = now
+        return now
+
+    def handled(self, start, event_id, oldest=None):
+        """Record that the batch received at ``start`` has been
+        delivered, or handed on to a dispatcher or coalescer;
+        ``oldest`` is the time of its first event in seconds since the
+        epoch, if the backend tells."""
+
+        now = time.monotonic()
+        lag = None if oldest is None else time.time() - oldest
+        with self.lock:
+            self.handling_times.append(now - start)
+            if lag is not None:
+                self.lags.append(lag)
+            self.busy += now - start
+            self.delivered_id = max(self.delivered_id, event_id)
+            self.current = None
+
+    def delivered(self, count, elapsed):
+        with self.lock:
+            self.deliveries += 1
+            self.delivered_events += count
+            self.callback_times.append(elapsed)
+
+    def snapshot(self):
+        """Return the counters as a dictionary:
+
+        ``events``, ``batches``
+           Events and batches received from the backend.
+
+        ``batch_sizes``
+           Histogram of the sizes of non-empty batches; maps a power of
+           two to the number of batches of up to that many events (and
+           more than half of it).
+
+        ``deliveries``, ``delivered_events``
+           Calls to the callback and the events passed to it.
+
+        ``callback_time``
+           Percentiles (``p50``, ``p90``, ``p99``, ``max``) of the
+           time spent in the callback and sinks per delivery, in
+           seconds.
+
+        ``handling_time``
+           Percentiles of the time from a batch being received to it
+           being delivered (or handed on, with a dispatcher or
+           coalescer), in seconds.
+
+        ``lag``
+           Percentiles of the time from the oldest event of a batch
+           happening to the batch being delivered (or handed on), in
+           seconds. Only the inotify and polling backends, whose event
+           IDs are timestamps, tell the time of an event; ``None``
+           with FSEvents, or until a batch is handled.
+
+        ``event_id``, ``delivered_id``
+           The highest event ID received and delivered.
+
+        ``busy``
+           Seconds spent handling batches on the observer thread.
+
+        ``age``
+           How long the batch being processed has been waiting, in
+           seconds; zero when idle.
+
+        ``idle``
+           Seconds since the last batch was received, or ``None``.
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            stats = {
+                "events": self.events,
+                "batches": self.batches,
+                "batch_sizes": dict(
+                    (1 << i, count)
+                    for i, count in enumerate(self.batch_sizes)
+                    if count
+                ),
+                "deliveries": self.deliveries,
+                "delivered_events": self.delivered_events,
+                "event_id": self.event_id,
+                "delivered_id": self.delivered_id,
+                "busy": self.busy,
+                "age": 0.0 if self.current is None else now - self.current,
+                "idle": (
+                    None if self.received_at is None
+                    else now - self.received_at
+                ),
+            }
+            handling_times = list(self.handling_times)
+            lags = list(self.lags)
+            callback_times = list(self.callback_times)
+        stats["handling_time"] = _percentiles(handling_times)
+        stats["lag"] = _percentiles(lags) if lags else None
+        stats["callback_time"] = _percentiles(callback_times)
+        return stats
+
+
+class CheckpointStore(object):
+    """Durable record of the highest event ID delivered, per stream.
+
+    Pass it as the ``checkpoint`` option of the streams to resume;
+    each stream has its own key (``checkpoint_key``, by default its
+    paths). Advancing an ID only updates it in memory. A background
+    thread writes out all changed IDs in a single file, synced to
+    disk, at most every ``interval`` seconds (group commit); with an
+    ``interval`` of zero, every advance is written right away. The
+    file is replaced atomically, so it holds either the old or the
+    new IDs after a crash.
+    """
+
+    def __init__(self, filename, interval=1.0):
+        self.filename = filename
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.writing = threading.Lock()
+        self.ids = self.read(filename)
+        self.dirty = False
+        self.closed = False
+        self.thread = None
+        self.advances = 0
+        self.commits = 0
+
+    @staticmethod
+    def read(filename):
+        try:
+            with open(filename) as f:
+                ids = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(ids, dict):
+            return {}
+        return dict(
+            (key, value) for key, value in ids.items()
+            if isinstance(value, int)
+        )
+
+    def get(self, key, default=None):
+        with self.condition:
+            return self.ids.get(key, default)
+
+    def advance(self, key, event_id):
+        """Record that the events up to ``event_id`` of the stream with
+        ``key`` have been delivered."""
+
+        with self.condition:
+            if event_id <= self.ids.get(key, -1):
+                return
+            self.ids[key] = event_id
+            self.advances += 1
+            self.dirty = True
+            if self.interval:
+                if self.thread is None and not self.closed:
+                    self.thread = threading.Thread(target=self.run)
+                    self.thread.daemon = True
+                    self.thread.start()
+                return
+        self.flush()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait(self.interval)
+                if self.closed:
+                    return
+            self.flush()
+
+    def flush(self):
+        """Write the IDs out now, if any have changed."""
+
+        with self.writing:
+            with self.condition:
+                if not self.dirty:
+                    return
+                ids = dict(self.ids)
+                self.dirty = False
+            tmp = self.filename + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(ids, f, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.filename)
+            directory = os.open(
+                os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY
+            )
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+            self.commits += 1
+
+    def close(self):
+        """Write out the IDs and stop the background thread."""
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+
+class Tracer(object):
+    """Receives the spans of the stages of event processing.
+
+    The stages are ``batch`` (wrapping the buffers from the backend),
+    ``filter``, ``decode`` and ``callback`` for path events and, for
+    file events, ``filter``, ``normalize`` (of the paths to NFD),
+    ``listdir``, ``lstat``, ``prepare`` (by the comparator), ``diff``
+    and ``callback``. :meth:`start` is called when a stage begins and
+    its result passed back to :meth:`end` along with the number of
+    items (paths, entries or events) handled. Spans of the snapshot
+    walk may be reported from worker threads.
+
+    By default, the span is timed with ``time.perf_counter_ns`` and
+    passed to :meth:`span`; override that to collect the timings, or
+    :meth:`start` and :meth:`end` to hook up a tracing library. When
+    no tracer is attached, the stages are not timed at all.
+    """
+
+    def start(self, stage):
+        return time.perf_counter_ns()
+
+    def end(self, stage, start, count):
+        self.span(stage, start, time.perf_counter_ns(), count)
+
+    def span(self, stage, start, end, count):
+        pass
+
+
+class StageProfiler(Tracer):
+    """Tracer which sums up the calls, items and time per stage."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def span(self, stage, start, end, count):
+        with self.lock:
+            totals = self.stages.get(stage)
+            if totals is None:
+                totals = self.stages[stage] = [0, 0, 0]
+            totals[0] += 1
+            totals[1] += count
+            totals[2] += end - start
+
+    def counters(self):
+        """Return the ``calls``, ``count`` and ``seconds`` of each
+        stage."""
+
+        with self.lock:
+            return dict(
+                (
+                    stage,
+                    {
+                        "calls": calls,
+                        "count": count,
+                        "seconds": elapsed / 1e9,
+                    },
+                )
+                for stage, (calls, count, elapsed) in self.stages.items()
+            )
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
 
 
 class FileEvent(object):
@@ -223,104 +1170,3142 @@ class FileEvent(object):
         return repr((self.mask, self.cookie, self.name))
 
 
-class FileEventCallback(object):
-    def __init__(self, callback, paths):
-        self.snapshots = {}
-        for path in paths:
-            check_path_string_type(path)
-            self.snapshot(path)
-        self.callback = callback
-        self.cookie = 0
+class EventBatch(object):
+    """Columnar events of one delivery from the backend.
 
-    def __call__(self, paths, masks, ids):
-        events = []
-        deleted = {}
-        created = {}
+    The paths are kept in a single buffer, each terminated by a NUL
+    byte, and the masks and event IDs in ``array('I')`` and
+    ``array('Q')`` columns exposed as memoryviews. This is what the
+    backend hands to the observer: converting to Python objects
+    happens once per batch rather than once per event.
+    """
 
-        for path in sorted(paths):
-            # supports UTF-8-MAC(NFD)
-            if not isinstance(path, unicode):
-                path = path.decode("utf-8")
-            path = unicodedata.normalize("NFD", path).encode("utf-8")
+    __slots__ = "data", "_masks", "_ids", "_offsets"
 
-            if sys.version_info[0] >= 3:
-                path = path.decode("utf-8")
+    def __init__(self, data, masks, ids):
+        self.data = bytes(data)
+        self._masks = masks if isinstance(masks, array) else array("I", masks)
+        self._ids = ids if isinstance(ids, array) else array("Q", ids)
+        self._offsets = None
 
-            path = path.rstrip("/")
-            snapshot = self.snapshots[path]
-            current = {}
-            try:
-                for name in os.listdir(path):
-                    try:
-                        current[name] = os.lstat(os.path.join(path, name))
-                    except OSError:
-                        pass
-            except OSError:
-                # recursive delete causes problems with path being non-existent
-                pass
-            observed = set(current)
+    @classmethod
+    def from_buffers(cls, paths, masks, ids):
+        """Return a batch for the raw buffers of a backend: the
+        NUL-terminated paths, and the native 32-bit masks and 64-bit
+        IDs."""
 
-            for name, snap_stat in snapshot.items():
-                filename = os.path.join(path, name)
-                if name in observed:
-                    stat = current[name]
-                    if stat.st_mtime > snap_stat.st_mtime:
-                        events.append(FileEvent(IN_MODIFY, None, filename))
-                    elif stat.st_ctime > snap_stat.st_ctime:
-                        events.append(FileEvent(IN_ATTRIB, None, filename))
-                    observed.discard(name)
-                else:
-                    event = created.get(snap_stat.st_ino)
-                    if event is not None:
-                        self.cookie += 1
-                        event.mask = IN_MOVED_FROM
-                        event.cookie = self.cookie
-                        tmp_filename = event.name
-                        event.name = filename
-                        events.append(
-                            FileEvent(IN_MOVED_TO, self.cookie, tmp_filename)
-                        )
-                    else:
-                        event = FileEvent(IN_DELETE, None, filename)
-                        deleted[snap_stat.st_ino] = event
-                        events.append(event)
+        batch = cls(paths, array("I"), array("Q"))
+        batch._masks.frombytes(masks)
+        batch._ids.frombytes(ids)
+        return batch
 
-            for name in observed:
-                stat = current[name]
-                filename = os.path.join(path, name)
+    @classmethod
+    def from_lists(cls, paths, masks, ids):
+        data = b"".join(path + b"\0" for path in paths)
+        return cls(data, masks, ids)
 
-                event = deleted.get(stat.st_ino)
-                if event is not None:
-                    self.cookie += 1
-                    event.mask = IN_MOVED_FROM
-                    event.cookie = self.cookie
-                    event = FileEvent(IN_MOVED_TO, self.cookie, filename)
-                else:
-                    event = FileEvent(IN_CREATE, None, filename)
-                    created[stat.st_ino] = event
+    def __len__(self):
+        return len(self._masks)
 
-                if os.path.isdir(filename):
-                    self.snapshot(filename)
-                events.append(event)
+    def __iter__(self):
+        return zip(self.paths(), self._masks, self._ids)
 
-            snapshot.clear()
-            snapshot.update(current)
+    @property
+    def masks(self):
+        return memoryview(self._masks)
 
-        for event in events:
-            self.callback(event)
+    @property
+    def ids(self):
+        return memoryview(self._ids)
 
-    def snapshot(self, path):
-        path = os.path.realpath(path)
-        refs = self.snapshots
+    @property
+    def offsets(self):
+        """Start of each path in ``data``; the last item is the size."""
 
-        for root, dirs, files in os.walk(path):
-            refs[root] = {}
-            entry = refs[root]
-            for obj in files + dirs:
-                try:
-                    entry[obj] = os.lstat(os.path.join(root, obj))
-                except OSError:
-                    continue
+        if self._offsets is None:
+            self._offsets = offsets = array("I", [0])
+            for path in self.paths():
+                offsets.append(offsets[-1] + len(path) + 1)
+        return memoryview(self._offsets)
+
+    def path(self, index):
+        start = self.offsets[index]
+        stop = self.offsets[index + 1] - 1
+        return self.data[start:stop]
+
+    def paths(self):
+        """Return the paths as a list of bytes."""
+
+        return self.data.split(b"\0")[:-1]
+
+    def decode(self, encoding="utf-8"):
+        """Return the paths as a list of strings, decoded at once."""
+
+        return self.data.decode(encoding).split("\0")[:-1]
+
+    def where(self, flags):
+        """Return the indices of the events with any of ``flags`` set."""
+
+        masks = self._masks
+        selected = compress(range(len(masks)), map(flags.__and__, masks))
+        return array("I", selected)
+
+    def select(self, indices):
+        """Return a new batch with the events at ``indices``."""
+
+        paths = self.paths()
+        masks = self._masks
+        ids = self._ids
+        return EventBatch.from_lists(
+            [paths[i] for i in indices],
+            array("I", [masks[i] for i in indices]),
+            array("Q", [ids[i] for i in indices]),
+        )
+
+
+class StatRecord(object):
+    """Snapshot entry with the ``os.stat_result`` attribute names."""
+
+    __slots__ = (
+        "st_ino",
+        "st_mtime_ns",
+        "st_ctime_ns",
+        "st_size",
+        "st_mode",
+        "st_fingerprint",
+    )
+
+    def __init__(
+        self,
+        st_ino,
+        st_mtime_ns,
+        st_ctime_ns,
+        st_size,
+        st_mode,
+        st_fingerprint=0,
+    ):
+        self.st_ino = st_ino
+        self.st_mtime_ns = st_mtime_ns
+        self.st_ctime_ns = st_ctime_ns
+        self.st_size = st_size
+        self.st_mode = st_mode
+        self.st_fingerprint = st_fingerprint
+
+    def __repr__(self):
+        return "StatRecord(%s)" % ", ".join(
+            "%s=%r" % (name, getattr(self, name)) for name in self.__slots__
+        )
+
+
+def _signed(value):
+    # Inode numbers are unsigned 64-bit; the record array is signed.
+    return value - 0x10000000000000000 if value > 0x7FFFFFFFFFFFFFFF else value
+
+
+def _unsigned(value):
+    return value + 0x10000000000000000 if value < 0 else value
+
+
+class DirectorySnapshot(object):
+    """Entries of a single directory.
+
+    Names are kept in a tuple (interned through the owning store) and
+    the stat fields in one flat ``array`` with ``width`` slots per
+    entry: five, or six when a content fingerprint is recorded.
+    """
+
+    __slots__ = "names", "records", "width"
+
+    def __init__(self, names=(), records=None, width=5):
+        self.names = names
+        self.records = records if records is not None else array("q")
+        self.width = width
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def record(self, index):
+        offset = index * self.width
+        values = self.records[offset:offset + self.width]
+        return StatRecord(_unsigned(values[0]), *values[1:])
+
+    def items(self):
+        for index, name in enumerate(self.names):
+            yield name, self.record(index)
+
+
+def _sizeof(snapshot):
+    getsizeof = sys.getsizeof
+    return (
+        getsizeof(snapshot)
+        + getsizeof(snapshot.names)
+        + getsizeof(snapshot.records)
+    )
+
+
+def _pack_strings(strings):
+    offsets = array("Q", [0])
+    chunks = []
+    for string in strings:
+        data = string.encode("utf-8", "surrogateescape")
+        chunks.append(data)
+        offsets.append(offsets[-1] + len(data))
+    return offsets, b"".join(chunks)
+
+
+def _unpack_strings(offsets, blob):
+    data = blob.tobytes()
+    return [
+        data[start:end].decode("utf-8", "surrogateescape")
+        for start, end in zip(offsets, offsets[1:])
+    ]
+
+
+class SnapshotNode(object):
+    """Directory of a :class:`SnapshotStore`.
+
+    Holds the :class:`DirectorySnapshot` of the directory, if it has
+    been taken, and the nodes of its subdirectories by name, along
+    with the number of directories and entries and the approximate
+    memory (in bytes) of the whole subtree.
+    """
+
+    __slots__ = (
+        "name",
+        "parent",
+        "children",
+        "snapshot",
+        "directories",
+        "count",
+        "nbytes",
+    )
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.children = None
+        self.snapshot = None
+        self.directories = 0
+        self.count = 0
+        self.nbytes = sys.getsizeof(self)
+
+    def walk(self, path):
+        """Yield the path and node of this node and every node below
+        it, parents before children."""
+
+        sep = path[:0] + ("/" if isinstance(path, str) else b"/")
+        stack = [(path, self)]
+        while stack:
+            path, node = stack.pop()
+            yield path, node
+            if node.children:
+                prefix = path.rstrip(sep) + sep
+                for name, child in node.children.items():
+                    stack.append((prefix + name, child))
+
+
+class SnapshotStore(object):
+    """Compact mapping of directory path to :class:`DirectorySnapshot`.
+
+    Only the inode, modification and change times (in nanoseconds),
+    size and mode of each entry are retained, and with a ``width`` of
+    six, the ``st_fingerprint`` of a :class:`StatRecord`.
+
+    The directories are kept in a tree of :class:`SnapshotNode` objects
+    with a node per path component, so a component is stored once (and
+    interned along with the entry names) however many directories are
+    below it, and a subtree can be detached or moved as a whole. A name
+    is released once no entry or node uses it any more. The
+    number of entries and an estimate of the memory held are kept up to
+    date along the way, so they can be read at any time (see
+    :attr:`count` and :attr:`nbytes`).
+    """
+
+    def __init__(self, width=5):
+        if width not in (5, 6):
+            raise ValueError("Record width must be 5 or 6.")
+        self.root = SnapshotNode(None)
+        self.names = {}
+        self.refs = {}
+        self.width = width
+        self._nbytes = 0
+
+    @staticmethod
+    def _split(path):
+        sep = "/" if isinstance(path, str) else b"/"
+        return [name for name in path.split(sep) if name]
+
+    def _top(self):
+        # The path of the root, of the type of the paths stored.
+        root = self.root
+        if root.children:
+            name = next(iter(root.children))
+        elif root.snapshot is not None and root.snapshot.names:
+            name = root.snapshot.names[0]
+        else:
+            return "/"
+        return "/" if isinstance(name, str) else b"/"
+
+    def _find(self, names):
+        node = self.root
+        for name in names:
+            if node.children is None:
+                return None
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+    def _make(self, names):
+        node = self.root
+        for name in names:
+            child = None
+            if node.children is not None:
+                child = node.children.get(name)
+            if child is None:
+                child = SnapshotNode(self.intern(name))
+                self._link(node, child)
+            node = child
+        return node
+
+    def _adjust(self, node, directories, count, nbytes):
+        while node is not None:
+            node.directories += directories
+            node.count += count
+            node.nbytes += nbytes
+            node = node.parent
+
+    def _link(self, parent, child):
+        getsizeof = sys.getsizeof
+        children = parent.children
+        if children is None:
+            children = parent.children = {}
+            before = 0
+        else:
+            before = getsizeof(children)
+        children[child.name] = child
+        child.parent = parent
+        self._adjust(
+            parent,
+            child.directories,
+            child.count,
+            child.nbytes + getsizeof(children) - before,
+        )
+
+    def _unlink(self, child):
+        getsizeof = sys.getsizeof
+        parent = child.parent
+        children = parent.children
+        before = getsizeof(children)
+        del children[child.name]
+        after = getsizeof(children)
+        if not children:
+            parent.children = None
+            after = 0
+        child.parent = None
+        self._adjust(
+            parent,
+            -child.directories,
+            -child.count,
+            after - before - child.nbytes,
+        )
+
+    def _prune(self, node):
+        # Drop the nodes left with neither a snapshot nor children.
+        while (
+            node.parent is not None
+            and node.snapshot is None
+            and node.children is None
+        ):
+            parent = node.parent
+            self._unlink(node)
+            self.release(node.name)
+            node = parent
+
+    @staticmethod
+    def _subtree(node):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield node
+            if node.children:
+                stack.extend(node.children.values())
+
+    def _acquire(self, node):
+        # Intern the names below a node put back into the store.
+        intern = self.intern
+        for child in self._subtree(node):
+            if child is not node:
+                child.name = intern(child.name)
+            if child.snapshot is not None:
+                for name in child.snapshot.names:
+                    intern(name)
+
+    def _release(self, node):
+        # Release the names of a node taken out of the store and of
+        # everything below it.
+        release = self.release
+        for child in self._subtree(node):
+            release(child.name)
+            if child.snapshot is not None:
+                for name in child.snapshot.names:
+                    release(name)
+
+    def __contains__(self, path):
+        node = self._find(self._split(path))
+        return node is not None and node.snapshot is not None
+
+    def __getitem__(self, path):
+        node = self._find(self._split(path))
+        if node is None or node.snapshot is None:
+            raise KeyError(path)
+        return node.snapshot
+
+    def get(self, path, default=None):
+        node = self._find(self._split(path))
+        if node is None or node.snapshot is None:
+            return default
+        return node.snapshot
+
+    def __iter__(self):
+        for path, snapshot in self.items():
+            yield path
+
+    def __len__(self):
+        return self.root.directories
+
+    def items(self):
+        """Yield the path and snapshot of each directory."""
+
+        for path, node in self.root.walk(self._top()):
+            if node.snapshot is not None:
+                yield path, node.snapshot
+
+    @property
+    def count(self):
+        """Number of entries in the store."""
+
+        return self.root.count
+
+    @property
+    def nbytes(self):
+        """Approximate memory held by the store, in bytes."""
+
+        getsizeof = sys.getsizeof
+        return (
+            self.root.nbytes
+            + getsizeof(self.names)
+            + getsizeof(self.refs)
+            + self._nbytes
+        )
+
+    def intern(self, name):
+        """Return the interned copy of ``name``, taking a reference to
+        it until :meth:`release` is called."""
+
+        interned = self.names.get(name)
+        if interned is None:
+            interned = self.names[name] = name
+            self.refs[name] = 1
+            self._nbytes += sys.getsizeof(name)
+        else:
+            self.refs[name] += 1
+        return interned
+
+    def release(self, name):
+        refs = self.refs[name] - 1
+        if refs:
+            self.refs[name] = refs
+        else:
+            del self.refs[name]
+            del self.names[name]
+            self._nbytes -= sys.getsizeof(name)
+
+    def _set(self, path, snapshot):
+        node = self._make(self._split(path))
+        directories, count, nbytes = 1, len(snapshot), _sizeof(snapshot)
+        if node.snapshot is not None:
+            directories -= 1
+            count -= len(node.snapshot)
+            nbytes -= _sizeof(node.snapshot)
+            for name in node.snapshot.names:
+                self.release(name)
+        node.snapshot = snapshot
+        self._adjust(node, directories, count, nbytes)
+
+    def update(self, path, entries):
+        names = []
+        records = array("q")
+        intern = self.intern
+        fingerprint = self.width == 6
+        for name, stat in entries:
+            names.append(intern(name))
+            records.extend((
+                _signed(stat.st_ino),
+                stat.st_mtime_ns,
+                stat.st_ctime_ns,
+                stat.st_size,
+                stat.st_mode,
+            ))
+            if fingerprint:
+                records.append(getattr(stat, "st_fingerprint", 0))
+        self._set(path, DirectorySnapshot(tuple(names), records, self.width))
+
+    def discard(self, path):
+        """Forget the snapshot of ``path``, but not of the directories
+        below it."""
+
+        node = self._find(self._split(path))
+        if node is None or node.snapshot is None:
+            return
+        snapshot = node.snapshot
+        node.snapshot = None
+        self._adjust(node, -1, -len(snapshot), -_sizeof(snapshot))
+        for name in snapshot.names:
+            self.release(name)
+        self._prune(node)
+
+    def detach(self, path):
+        """Remove ``path`` and everything below it from the store and
+        return its node, or ``None`` if there is nothing there."""
+
+        node = self._find(self._split(path))
+        if node is None or node.parent is None:
+            return None
+        parent = node.parent
+        self._unlink(node)
+        self._release(node)
+        self._prune(parent)
+        return node
+
+    def attach(self, path, node):
+        """Put a node returned by :meth:`detach` back at ``path``,
+        replacing what was there."""
+
+        names = self._split(path)
+        parent = self._make(names[:-1])
+        name = self.intern(names[-1])
+        if parent.children is not None and name in parent.children:
+            replaced = parent.children[name]
+            self._unlink(replaced)
+            self._release(replaced)
+        node.name = name
+        self._acquire(node)
+        self._link(parent, node)
+
+    def subdirectories(self, path):
+        """Return the paths of the directories directly below ``path``
+        in the store."""
+
+        node = self._find(self._split(path))
+        if node is None or node.children is None:
+            return []
+        sep = "/" if isinstance(path, str) else b"/"
+        prefix = path.rstrip(sep) + sep
+        return [prefix + name for name in node.children]
+
+    # The cache file starts with a fixed header followed by sections of
+    # 64-bit words (native byte order), each padded to eight bytes:
+    # name offsets, path offsets, root offsets, per-directory entry
+    # counts, per-entry name indices, records and finally the string
+    # blobs for names, paths and roots.
+    header = struct.Struct("=8sIIqQQQQ")
+    magic = b"FSEVSNP1"
+    byteorder = 0x01020304
+
+    def save(self, filename, event_id, roots=()):
+        """Write the store to ``filename``, tagged with ``event_id``."""
+
+        name_index = {}
+        for index, name in enumerate(self.names):
+            name_index[name] = index
+        directories = list(self.items())
+        name_offsets, name_blob = _pack_strings(self.names)
+        path_offsets, path_blob = _pack_strings(
+            path for path, snapshot in directories
+        )
+        root_offsets, root_blob = _pack_strings(roots)
+
+        counts = array("Q")
+        indices = array("Q")
+        records = array("q")
+        for path, snapshot in directories:
+            counts.append(len(snapshot))
+            indices.extend(name_index[name] for name in snapshot.names)
+            records.extend(snapshot.records)
+
+        tmp = filename + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(
+                self.header.pack(
+                    self.magic,
+                    self.byteorder,
+                    self.width,
+                    event_id,
+                    len(self.names),
+                    len(directories),
+                    len(roots),
+                    len(indices),
+                )
+            )
+            sections = [
+                name_offsets,
+                path_offsets,
+                root_offsets,
+                counts,
+                indices,
+                records,
+            ]
+            for data in [section.tobytes() for section in sections] + [
+                name_blob,
+                path_blob,
+                root_blob,
+            ]:
+                f.write(data)
+                f.write(b"\0" * (-len(data) % 8))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a store written by :meth:`save`.
+
+        Returns a tuple of the store, the event ID and the roots; raises
+        ``ValueError`` if the file is not a snapshot cache of this
+        layout.
+        """
+
+        with open(filename, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            view = memoryview(buf)
+            try:
+                return cls._load(view)
+            finally:
+                view.release()
+        finally:
+            buf.close()
+
+    @classmethod
+    def _load(cls, view):
+        header = cls.header
+        if len(view) < header.size:
+            raise ValueError("Truncated snapshot cache.")
+        (
+            magic,
+            byteorder,
+            width,
+            event_id,
+            nnames,
+            ndirs,
+            nroots,
+            nentries,
+        ) = header.unpack_from(view)
+        if magic != cls.magic or byteorder != cls.byteorder:
+            raise ValueError("Incompatible snapshot cache.")
+
+        offset = [header.size]
+
+        def read(size):
+            start = offset[0]
+            end = start + size
+            if end > len(view):
+                raise ValueError("Truncated snapshot cache.")
+            offset[0] = end + (-end % 8)
+            return view[start:end]
+
+        def section(typecode, count):
+            result = array(typecode)
+            result.frombytes(read(count * result.itemsize))
+            return result
+
+        name_offsets = section("Q", nnames + 1)
+        path_offsets = section("Q", ndirs + 1)
+        root_offsets = section("Q", nroots + 1)
+        counts = section("Q", ndirs)
+        indices = section("Q", nentries)
+        records = section("q", nentries * width)
+        names = _unpack_strings(name_offsets, read(name_offsets[-1]))
+        paths = _unpack_strings(path_offsets, read(path_offsets[-1]))
+        roots = _unpack_strings(root_offsets, read(root_offsets[-1]))
+
+        store = cls(width)
+        intern = store.intern
+        start = 0
+        for path, count in zip(paths, counts):
+            end = start + count
+            store._set(path, DirectorySnapshot(
+                tuple(intern(names[index]) for index in indices[start:end]),
+                records[start * width:end * width],
+                width,
+            ))
+            start = end
+        return store, event_id, roots
+
+    def entries(self):
+        return self.count
+
+    def memory_usage(self):
+        """Return an approximate breakdown of the memory held, in bytes."""
+
+        getsizeof = sys.getsizeof
+        nodes = 0
+        paths = 0
+        records = 0
+        for path, node in self.root.walk(self._top()):
+            nodes += 1
+            paths += getsizeof(node)
+            if node.children is not None:
+                paths += getsizeof(node.children)
+            if node.snapshot is not None:
+                records += _sizeof(node.snapshot)
+        names = (
+            getsizeof(self.names)
+            + getsizeof(self.refs)
+            + sum(map(getsizeof, self.names))
+        )
+        return {
+            "directories": len(self),
+            "nodes": nodes,
+            "entries": self.entries(),
+            "names": len(self.names),
+            "paths_bytes": paths,
+            "records_bytes": records,
+            "names_bytes": names,
+            "total_bytes": paths + records + names,
+        }
+
+
+class MtimeComparator(object):
+    """Report ``IN_MODIFY`` if the modification time advanced, else
+    ``IN_ATTRIB`` if the change time did (the default)."""
+
+    width = 5
+
+    def prepare(self, directory, entries):
+        return entries
+
+    def __call__(self, old, new):
+        if new.st_mtime_ns > old.st_mtime_ns:
+            return IN_MODIFY
+        if new.st_ctime_ns > old.st_ctime_ns:
+            return IN_ATTRIB
+        return 0
+
+
+class MtimeSizeComparator(MtimeComparator):
+    """Report ``IN_MODIFY`` on any difference in modification time or
+    size, which also catches a time set backwards."""
+
+    def __call__(self, old, new):
+        if (
+            new.st_mtime_ns != old.st_mtime_ns
+            or new.st_size != old.st_size
+        ):
+            return IN_MODIFY
+        if new.st_ctime_ns != old.st_ctime_ns:
+            return IN_ATTRIB
+        return 0
+
+
+class InodeCtimeComparator(MtimeComparator):
+    """Detect changes by inode and change time only.
+
+    The change time cannot be set from user space, so this catches
+    writes that preserve the modification time; a new inode under the
+    same name (an atomic replace) is a modification.
+    """
+
+    def __call__(self, old, new):
+        if new.st_ino != old.st_ino:
+            return IN_MODIFY
+        if new.st_ctime_ns != old.st_ctime_ns:
+            if new.st_mtime_ns != old.st_mtime_ns:
+                return IN_MODIFY
+            return IN_ATTRIB
+        return 0
+
+
+class FingerprintComparator(MtimeSizeComparator):
+    """Compare a hash of the contents of regular files up to
+    ``max_size`` bytes; larger files are compared by modification time
+    and size.
+
+    A file that was touched or rewritten with the same contents is
+    reported as ``IN_ATTRIB`` rather than ``IN_MODIFY``. The snapshot
+    reads every such file, so this is the most expensive strategy.
+    """
+
+    width = 6
+
+    def __init__(self, max_size=65536):
+        self.max_size = max_size
+
+    def fingerprint(self, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read(self.max_size + 1)
+        except OSError:
+            return 0
+        if len(data) > self.max_size:
+            return 0
+        digest = hashlib.blake2b(data, digest_size=8).digest()
+        # Zero is reserved for "no fingerprint".
+        return int.from_bytes(digest, sys.byteorder, signed=True) or 1
+
+    def prepare(self, directory, entries):
+        result = []
+        for name, stat in entries:
+            fingerprint = 0
+            if _stat.S_ISREG(stat.st_mode) and stat.st_size <= self.max_size:
+                fingerprint = self.fingerprint(os.path.join(directory, name))
+            result.append((name, StatRecord(
+                stat.st_ino,
+                stat.st_mtime_ns,
+                stat.st_ctime_ns,
+                stat.st_size,
+                stat.st_mode,
+                fingerprint,
+            )))
+        return result
+
+    def __call__(self, old, new):
+        if not (old.st_fingerprint and new.st_fingerprint):
+            return MtimeSizeComparator.__call__(self, old, new)
+        if old.st_fingerprint != new.st_fingerprint:
+            return IN_MODIFY
+        if (
+            new.st_mtime_ns != old.st_mtime_ns
+            or new.st_ctime_ns != old.st_ctime_ns
+        ):
+            return IN_ATTRIB
+        return 0
+
+
+comparators = {
+    "mtime": MtimeComparator,
+    "mtime_size": MtimeSizeComparator,
+    "inode_ctime": InodeCtimeComparator,
+    "fingerprint": FingerprintComparator,
+}
+
+
+def _translate_glob(pattern):
+    # Like ``fnmatch.translate``, except that wildcards do not match a
+    # path separator; ``**`` matches anything.
+    result = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            if pattern[i:i + 1] == "*":
+                i += 1
+                result.append(".*")
+            else:
+                result.append("[^/]*")
+        elif c == "?":
+            result.append("[^/]")
+        elif c == "[":
+            j = i
+            if pattern[j:j + 1] == "!":
+                j += 1
+            if pattern[j:j + 1] == "]":
+                j += 1
+            j = pattern.find("]", j)
+            if j < 0:
+                result.append("\\[")
+                continue
+            chars = pattern[i:j].replace("\\", "\\\\")
+            if chars.startswith("!"):
+                chars = "^/" + chars[1:]
+            result.append("[" + chars + "]")
+            i = j + 1
+        else:
+            result.append(re.escape(c))
+    return "".join(result)
+
+
+class PathFilter(object):
+    """Compiled include and exclude patterns.
+
+    A pattern starting with ``/`` is a path prefix: it matches that
+    path and everything below it. Any other pattern is a glob (``*``,
+    ``?`` and ``[...]`` do not match ``/``, ``**`` does) matched
+    against the trailing components of a path: ``node_modules`` matches
+    any directory of that name, ``build/*.o`` object files in any
+    ``build`` directory. A path below a matching path matches too.
+
+    Excluded paths are skipped, whether files or directories. If there
+    are include patterns, files (but not directories) must also match
+    one of them. All prefixes go into a trie of path components and all
+    globs into a single regular expression, compiled for both ``str``
+    and ``bytes`` paths.
+    """
+
+    def __init__(self, include=(), exclude=()):
+        self.include = _PatternSet(include) if include else None
+        self.exclude = _PatternSet(exclude)
+
+    def excludes(self, path):
+        return self.exclude.match(path)
+
+    def includes(self, path, is_dir=False):
+        """Return true unless ``path`` is excluded or fails to match an
+        include pattern."""
+
+        if self.exclude.match(path):
+            return False
+        return is_dir or self.include is None or self.include.match(path)
+
+
+class _PatternSet(object):
+    def __init__(self, patterns):
+        self.trie = {}
+        self.btrie = {}
+        globs = []
+        for pattern in patterns:
+            if pattern.startswith("/"):
+                self._add(self.trie, pattern.rstrip("/").split("/")[1:])
+                self._add(
+                    self.btrie,
+                    pattern.encode("utf-8").rstrip(b"/").split(b"/")[1:],
+                )
+            else:
+                globs.append(_translate_glob(pattern.rstrip("/")))
+        if globs:
+            regex = "(?:^|/)(?:%s)(?:/|$)" % "|".join(globs)
+            self.regex = re.compile(regex, re.S)
+            self.bregex = re.compile(regex.encode("utf-8"), re.S)
+        else:
+            self.regex = self.bregex = None
+
+    @staticmethod
+    def _add(trie, components):
+        node = trie
+        for component in components:
+            node = node.setdefault(component, {})
+        node[None] = True
+
+    def match(self, path):
+        if isinstance(path, bytes):
+            trie, regex, sep = self.btrie, self.bregex, b"/"
+        else:
+            trie, regex, sep = self.trie, self.regex, "/"
+        if trie:
+            node = trie
+            for component in path.split(sep)[1:]:
+                node = node.get(component)
+                if node is None:
+                    break
+                if None in node:
+                    return True
+        return regex is not None and regex.search(path) is not None
+
+
+class MoveIndex(object):
+    """Removals and creations left unpaired by a batch, held back for
+    ``window`` seconds to be paired up as a move with a creation or
+    removal of the same inode (and file type) in a later batch.
+
+    A move can be split over two batches when the source and target
+    directories are reported separately, for instance if they are
+    below different roots of the stream.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.removed = {}
+        self.created = {}
+        self.released = []
+
+    def __len__(self):
+        return len(self.removed) + len(self.created)
+
+    def pair(self, key, event, now, related=()):
+        """Return the held event of the opposite kind for ``key``, or
+        hold ``event`` (an ``IN_DELETE`` or ``IN_CREATE``) and return
+        ``None``.
+
+        The ``related`` events (the removal of the contents of a
+        removed directory) are delivered before ``event`` if it is
+        not paired up, and dropped otherwise.
+        """
+
+        if event.mask == IN_DELETE:
+            held, other = self.removed, self.created
+        else:
+            held, other = self.created, self.removed
+        item = other.pop(key, None)
+        if item is not None:
+            return item[1]
+        item = held.pop(key, None)
+        if item is not None:
+            # The inode was reused; the earlier event stands alone.
+            self.released.append(item)
+        held[key] = (now + self.window, event, related)
+        return None
+
+    def deadline(self):
+        """Return when the next held event is due, or ``None``."""
+
+        deadlines = [
+            next(iter(held.values()))[0]
+            for held in (self.removed, self.created)
+            if held
+        ]
+        if self.released:
+            deadlines.append(0.0)
+        return min(deadlines) if deadlines else None
+
+    def release(self, names):
+        """Return the held events for any of the paths ``names`` or
+        their parent directories, in the order they were held, to be
+        delivered ahead of later events for the same paths."""
+
+        if not len(self):
+            return []
+        paths = set()
+        for name in names:
+            while name not in paths:
+                paths.add(name)
+                name = os.path.dirname(name)
+        due = []
+        for held in (self.removed, self.created):
+            for key, item in list(held.items()):
+                if item[1].name in paths:
+                    del held[key]
+                    due.append(item)
+        return self._events(due)
+
+    def expire(self, now=None):
+        """Return the events due at ``now`` (all if ``None``), in the
+        order they were held."""
+
+        due = self.released
+        self.released = []
+        for held in (self.removed, self.created):
+            # Held in order of their deadlines.
+            for key, item in list(held.items()):
+                if now is not None and item[0] > now:
+                    break
+                del held[key]
+                due.append(item)
+        return self._events(due)
+
+    def _events(self, due):
+        due.sort(key=lambda item: item[0])
+        result = []
+        for deadline, event, related in due:
+            result.extend(related)
+            result.append(event)
+        return result
+
+
+# Flags of an event telling that changes below its path may have been
+# missed.
+RESCAN_FLAGS = (
+    FS_FLAGMUSTSCANSUBDIRS | FS_FLAGUSERDROPPED | FS_FLAGKERNELDROPPED
+)
+
+
+class RescanScheduler(object):
+    """Recursive rescans of the subtrees of a :class:`FileEventCallback`.
+
+    Requested when events may have been dropped. Each directory of a
+    subtree is diffed with its snapshot in turn, on a separate thread,
+    so that events keep being processed meanwhile; a request for a
+    path that is queued or below a queued path is merged into it, and
+    a directory is queued at most once. The ``listdir`` and ``lstat``
+    calls are limited to ``budget`` per second (``None`` for no limit).
+
+    If set, ``drained`` is called after a rescan that leaves none
+    pending.
+    """
+
+    def __init__(self, owner, budget=10000):
+        self.owner = owner
+        self.budget = budget
+        self.drained = None
+        self.condition = threading.Condition()
+        self.queue = deque()
+        self.queued = set()
+        self.tokens = budget or 0
+        self.refilled = time.monotonic()
+        self.thread = None
+        self.closed = False
+        self.requests = 0
+        self.merged = 0
+        self.busy = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def idle(self):
+        with self.condition:
+            return not self.queue and not self.busy
+
+    def request(self, path):
+        """Queue a recursive rescan of ``path``."""
+
+        with self.condition:
+            if self.closed:
+                return
+            self.requests += 1
+            parent = path
+            while True:
+                if parent in self.queued:
+                    # Reached from the queued directory.
+                    self.merged += 1
+                    return
+                parent, name = os.path.split(parent)
+                if not name:
+                    break
+            self.queue.append(path)
+            self.queued.add(path)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        queue = self.queue
+        while True:
+            with self.condition:
+                while not queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                if self.budget:
+                    now = time.monotonic()
+                    self.tokens = min(
+                        self.budget,
+                        self.tokens + (now - self.refilled) * self.budget,
+                    )
+                    self.refilled = now
+                    if self.tokens <= 0:
+                        self.condition.wait(-self.tokens / self.budget)
+                        continue
+                # Depth first, which keeps the queue short.
+                path = queue.pop()
+                self.queued.discard(path)
+                self.busy += 1
+            directories, calls = [], 0
+            try:
+                directories, calls = self.owner.rescan(path)
+            except Exception:
+                # Keep rescanning; there is no caller to raise to.
+                sys.excepthook(*sys.exc_info())
+            with self.condition:
+                self.busy -= 1
+                self.tokens -= calls
+                for directory in directories:
+                    if directory not in self.queued:
+                        queue.append(directory)
+                        self.queued.add(directory)
+                drained = not queue and not self.busy
+            if drained and self.drained is not None:
+                try:
+                    self.drained()
+                except Exception:
+                    sys.excepthook(*sys.exc_info())
+
+    def close(self):
+        """Stop rescanning; pending rescans are dropped."""
+
+        with self.condition:
+            self.closed = True
+            self.queue.clear()
+            self.queued.clear()
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class FileEventCallback(object):
+    def __init__(
+        self,
+        callback,
+        paths,
+        workers=1,
+        background=False,
+        cache=None,
+        compare="mtime",
+        batch=False,
+        filter=None,
+        event_id=None,
+        tracer=None,
+        move_window=None,
+        rescan_budget=10000,
+    ):
+        if not callable(compare):
+            compare = comparators[compare]()
+        self.compare = compare
+        self.snapshots = SnapshotStore(compare.width)
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.callback = callback
+        self.batch = batch
+        self.filter = filter
+        self.tracer = tracer
+        self.cookie = 0
+        self.rescans = 0
+        self.listdirs = 0
+        self.lstats = 0
+        self.moves = None
+        if move_window is not None:
+            self.moves = MoveIndex(move_window)
+        self.delivery = threading.Lock()
+        self.timer = None
+        # Called once held events or rescans have been delivered.
+        self.drained = None
+        self.scheduler = RescanScheduler(self, rescan_budget)
+        self.scheduler.drained = self._drained
+        check_path_string_type(*paths)
+        roots = self.roots = [os.path.realpath(path) for path in paths]
+
+        if cache is not None:
+            try:
+                store, event_id, cached = SnapshotStore.load(cache)
+            except (OSError, ValueError):
+                pass
+            else:
+                if cached == roots and store.width == compare.width:
+                    self.snapshots = store
+                    self.event_id = event_id
+                    self.ready.set()
+                    return
+
+        # Events from here on are newer than the snapshot.
+        if event_id is None:
+            event_id = current_event_id()
+        self.event_id = event_id
+        if background:
+            thread = threading.Thread(
+                target=self._walk_background, args=(roots, workers)
+            )
+            thread.daemon = True
+            thread.start()
+        else:
+            self.walk(roots, workers)
+            self.ready.set()
+
+    def __call__(self, paths, masks, ids):
+        # Changes below these paths may have gone unreported.
+        for path, mask in zip(paths, masks):
+            if mask & RESCAN_FLAGS:
+                self.scheduler.request(self.normalize(path))
+
+        with self.delivery:
+            with self.lock:
+                events = self.process(paths)
+                if ids:
+                    self.event_id = max(self.event_id, max(ids))
+                if self.moves is not None:
+                    self._arm()
+            self.deliver(events)
+
+    def deliver(self, events):
+        if not events:
+            return
+        tracer = self.tracer
+        if tracer is not None:
+            span = tracer.start("callback")
+        if self.batch:
+            self.callback(events)
+        else:
+            for event in events:
+                self.callback(event)
+        if tracer is not None:
+            tracer.end("callback", span, len(events))
+
+    def process(self, paths):
+        events = []
+        deleted = {}
+        created = {}
+        subtrees = {}
+        scan = self._scan
+        compare = self.compare
+        tracer = self.tracer
+        if self.filter is not None:
+            if tracer is not None:
+                span = tracer.start("filter")
+            excludes = self.filter.excludes
+            paths = [path for path in paths if not excludes(path)]
+            if tracer is not None:
+                tracer.end("filter", span, len(paths))
+
+        if tracer is not None:
+            span = tracer.start("normalize")
+        paths = [self.normalize(path) for path in sorted(paths)]
+        if tracer is not None:
+            tracer.end("normalize", span, len(paths))
+
+        for path in paths:
+            snapshot = self.snapshots.get(path)
+            if snapshot is None:
+                if self.ready.is_set():
+                    self.walk([path])
+                    continue
+                try:
+                    entries = scan(path)[0]
+                except OSError:
+                    continue
+                self.listdirs += 1
+                self.lstats += len(entries)
+                self.snapshots.update(path, entries)
+                events.append(FileEvent(IN_INITIAL, None, path))
+                continue
+
+            try:
+                current = dict(scan(path)[0])
+            except OSError:
+                # recursive delete causes problems with path being non-existent
+                current = {}
+            self.rescans += 1
+            self.listdirs += 1
+            self.lstats += len(current)
+            if tracer is not None:
+                span = tracer.start("diff")
+            observed = set(current)
+
+            for name, snap_stat in snapshot.items():
+                if name in observed:
+                    stat = current[name]
+                    mask = compare(snap_stat, stat)
+                    if mask:
+                        filename = os.path.join(path, name)
+                        if _stat.S_ISDIR(snap_stat.st_mode) and not (
+                            _stat.S_ISDIR(stat.st_mode)
+                        ):
+                            # A directory was replaced by a file.
+                            events.extend(self.removed(
+                                filename, self.snapshots.detach(filename)
+                            ))
+                        events.append(FileEvent(mask, None, filename))
+                    observed.discard(name)
+                else:
+                    filename = os.path.join(path, name)
+                    subtree = None
+                    if _stat.S_ISDIR(snap_stat.st_mode):
+                        subtree = self.snapshots.detach(filename)
+                    event = created.get(
+                        (snap_stat.st_ino, _stat.S_IFMT(snap_stat.st_mode))
+                    )
+                    if event is not None:
+                        self.cookie += 1
+                        event.mask = IN_MOVED_FROM
+                        event.cookie = self.cookie
+                        tmp_filename = event.name
+                        event.name = filename
+                        events.append(
+                            FileEvent(IN_MOVED_TO, self.cookie, tmp_filename)
+                        )
+                    else:
+                        event = FileEvent(IN_DELETE, None, filename)
+                        deleted[
+                            snap_stat.st_ino, _stat.S_IFMT(snap_stat.st_mode)
+                        ] = event
+                        events.append(event)
+                        if subtree is not None:
+                            subtrees[id(event)] = subtree
+
+            for name in observed:
+                stat = current[name]
+                filename = os.path.join(path, name)
+
+                key = stat.st_ino, _stat.S_IFMT(stat.st_mode)
+                event = deleted.get(key)
+                subtree = None
+                if event is not None:
+                    self.cookie += 1
+                    event.mask = IN_MOVED_FROM
+                    event.cookie = self.cookie
+                    subtree = subtrees.pop(id(event), None)
+                    event = FileEvent(IN_MOVED_TO, self.cookie, filename)
+                else:
+                    event = FileEvent(IN_CREATE, None, filename)
+                    created[key] = event
+
+                if subtree is not None:
+                    # Moved along with everything below it.
+                    self.snapshots.attach(filename, subtree)
+                elif _stat.S_ISDIR(stat.st_mode):
+                    self.walk([filename])
+                events.append(event)
+
+            self.snapshots.update(path, current.items())
+            if tracer is not None:
+                tracer.end("diff", span, len(snapshot) + len(observed))
+
+        # The contents of removed directories are reported as removed
+        # before the directory itself.
+        contents = {}
+        for event in deleted.values():
+            subtree = subtrees.get(id(event))
+            if subtree is not None and event.mask == IN_DELETE:
+                contents[id(event)] = self.removed(event.name, subtree)
+
+        if self.moves is not None:
+            return self._correlate(events, deleted, created, contents)
+        if not contents:
+            return events
+        result = []
+        for event in events:
+            result.extend(contents.get(id(event), ()))
+            result.append(event)
+        return result
+
+    def removed(self, path, subtree):
+        """Return ``IN_DELETE`` events for the contents of a directory
+        at ``path``, given its detached :class:`SnapshotNode`; entries
+        of subdirectories come before the subdirectory."""
+
+        events = []
+        if subtree is None:
+            return events
+        for directory, node in reversed(list(subtree.walk(path))):
+            if node.snapshot is not None:
+                for name in node.snapshot:
+                    events.append(
+                        FileEvent(
+                            IN_DELETE, None, os.path.join(directory, name)
+                        )
+                    )
+        return events
+
+    def _correlate(self, events, deleted, created, contents):
+        # Pair the removals and creations left unpaired in this batch
+        # with those held back from earlier ones; hold back the rest.
+        moves = self.moves
+        now = time.monotonic()
+        # A held event goes out before later events for its path.
+        result = moves.release(set(event.name for event in events))
+        pairs = {}
+        held = set()
+        for mask, unpaired in ((IN_DELETE, deleted), (IN_CREATE, created)):
+            for key, event in unpaired.items():
+                if event.mask != mask:
+                    continue
+                other = moves.pair(
+                    key, event, now, contents.get(id(event), ())
+                )
+                if other is None:
+                    held.add(id(event))
+                    continue
+                self.cookie += 1
+                if mask == IN_DELETE:
+                    source, target = event, other
+                else:
+                    source, target = other, event
+                pairs[id(event)] = (
+                    FileEvent(IN_MOVED_FROM, self.cookie, source.name),
+                    FileEvent(IN_MOVED_TO, self.cookie, target.name),
+                )
+
+        for event in events:
+            if id(event) in pairs:
+                result.extend(pairs[id(event)])
+            elif id(event) not in held:
+                result.append(event)
+        return result + moves.expire(now)
+
+    def _arm(self):
+        # Must be called with the lock held.
+        deadline = self.moves.deadline()
+        if self.timer is not None or deadline is None:
+            return
+        self.timer = threading.Timer(
+            max(0.0, deadline - time.monotonic()), self._expire
+        )
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _expire(self):
+        with self.delivery:
+            with self.lock:
+                self.timer = None
+                events = self.moves.expire(time.monotonic())
+                self._arm()
+            self.deliver(events)
+        self._drained()
+
+    def _drained(self):
+        if self.drained is not None:
+            self.drained()
+
+    def idle(self):
+        """Return true unless events are held back or rescans are
+        pending."""
+
+        with self.lock:
+            if self.moves is not None and len(self.moves):
+                return False
+        return self.scheduler.idle()
+
+    def rescan(self, path):
+        """Diff ``path`` with its snapshot and deliver the changes, as
+        for an event on ``path``. Returns the subdirectories of
+        ``path`` and the number of ``listdir`` and ``lstat`` calls
+        made."""
+
+        with self.delivery:
+            with self.lock:
+                calls = self.listdirs + self.lstats
+                events = self.process([path])
+                directories = self.snapshots.subdirectories(path)
+                calls = self.listdirs + self.lstats - calls
+                if self.moves is not None:
+                    self._arm()
+            self.deliver(events)
+        return directories, calls
+
+    def close(self):
+        """Stop rescanning, and deliver the removals and creations held
+        back for pairing with a later batch."""
+
+        self.scheduler.close()
+        if self.moves is None:
+            return
+        with self.delivery:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                events = self.moves.expire()
+            self.deliver(events)
+
+    @staticmethod
+    def normalize(path):
+        # supports UTF-8-MAC(NFD)
+        if not isinstance(path, unicode):
+            path = path.decode("utf-8")
+        path = unicodedata.normalize("NFD", path).encode("utf-8")
+
+        if sys.version_info[0] >= 3:
+            path = path.decode("utf-8")
+
+        return path.rstrip("/")
+
+    def counters(self):
+        """Return the directories rescanned after an event, the
+        directory listings and ``lstat`` calls made (an ``lstat`` per
+        entry listed), the size of the snapshot and the number of
+        directories waiting for a recursive rescan."""
+
+        snapshots = self.snapshots
+        return {
+            "rescans": self.rescans,
+            "listdir": self.listdirs,
+            "lstat": self.lstats,
+            "snapshot_entries": snapshots.count,
+            "snapshot_bytes": snapshots.nbytes,
+            "rescans_pending": len(self.scheduler),
+        }
+
+    def save(self, filename):
+        """Write the snapshot to ``filename``, tagged with the ID of the
+        last event processed; see the ``snapshot_cache`` stream option.
+        """
+
+        self.ready.wait()
+        with self.lock:
+            self.snapshots.save(filename, self.event_id, self.roots)
+
+    def snapshot(self, path, workers=1):
+        self.walk([os.path.realpath(path)], workers)
+
+    def walk(self, roots, workers=1, update=None):
+        """Snapshot the trees under ``roots``.
+
+        With more than one worker, directories are scanned on a thread
+        pool (``os.scandir`` releases the GIL); the store itself is
+        only updated from the calling thread, so the result is the same
+        as for a serial walk.
+        """
+
+        if update is None:
+            update = self.snapshots.update
+        if workers > 1:
+            return self._walk_parallel(roots, workers, update)
+
+        scan = self._scan
+        stack = list(roots)
+        while stack:
+            root = stack.pop()
+            try:
+                entries, directories = scan(root)
+            except OSError:
+                continue
+            self.listdirs += 1
+            self.lstats += len(entries)
+            update(root, entries)
+            stack.extend(directories)
+
+    def _walk_parallel(self, roots, workers, update):
+        scan = self._scan
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {executor.submit(scan, root): root for root in roots}
+            while pending:
+                done = wait(pending, return_when=FIRST_COMPLETED)[0]
+                for future in done:
+                    root = pending.pop(future)
+                    try:
+                        entries, directories = future.result()
+                    except OSError:
+                        continue
+                    self.listdirs += 1
+                    self.lstats += len(entries)
+                    update(root, entries)
+                    for directory in directories:
+                        pending[executor.submit(scan, directory)] = directory
+
+    def _walk_background(self, roots, workers):
+        snapshots = self.snapshots
+        lock = self.lock
+
+        def update(path, entries):
+            # Directories already scanned by the event handler are
+            # more recent than ours.
+            with lock:
+                if path not in snapshots:
+                    snapshots.update(path, entries)
+
+        try:
+            self.walk(roots, workers, update)
+        finally:
+            self.ready.set()
+
+    def _scan(self, path):
+        tracer = self.tracer
+        entries, directories = self.scan(path, self.filter, tracer)
+        if tracer is None:
+            return self.compare.prepare(path, entries), directories
+        span = tracer.start("prepare")
+        entries = self.compare.prepare(path, entries)
+        tracer.end("prepare", span, len(entries))
+        return entries, directories
+
+    @staticmethod
+    def scan(path, filter=None, tracer=None):
+        """Return the entries of ``path`` and the paths of its
+        subdirectories (symlinks are not followed).
+
+        The entry stat comes from the ``DirEntry``, which saves the path
+        join and issues at most one ``lstat`` per entry. Entries not
+        included by ``filter`` (a :class:`PathFilter`) are skipped
+        before they are stat'ed. With a ``tracer``, the listing and
+        the ``lstat`` calls are reported as separate spans.
+        """
+
+        if tracer is not None:
+            span = tracer.start("listdir")
+        with os.scandir(path) as it:
+            if filter is None:
+                listed = list(it)
+            else:
+                listed = [
+                    entry
+                    for entry in it
+                    if filter.includes(
+                        entry.path, entry.is_dir(follow_symlinks=False)
+                    )
+                ]
+        if tracer is not None:
+            tracer.end("listdir", span, len(listed))
+            span = tracer.start("lstat")
+
+        entries = []
+        directories = []
+        for entry in listed:
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            entries.append((entry.name, stat))
+            if _stat.S_ISDIR(stat.st_mode):
+                directories.append(entry.path)
+        if tracer is not None:
+            tracer.end("lstat", span, len(entries))
+        return entries, directories
+
+
+class Coalescer(object):
+    """Merge file events per path into their net result and deliver
+    them once the path has been quiet for ``window`` seconds.
+
+    Takes and delivers lists of :class:`FileEvent` objects; the
+    ``callback`` is called from a separate thread. For example, a
+    create followed by a delete cancels out, and a create followed by
+    modifications is delivered as the create. A move is delivered as a
+    ``IN_MOVED_FROM``/``IN_MOVED_TO`` pair in the same list, followed
+    by a single ``IN_MODIFY`` (or ``IN_ATTRIB``) at the target if the
+    file changed before or after the move.
+
+    If set, ``drained`` is called after a delivery that leaves nothing
+    pending.
+    """
+
+    def __init__(self, callback, window):
+        self.callback = callback
+        self.window = window
+        self.drained = None
+        self.pending = {}
+        self.moves = {}
+        self.targets = {}
+        self.aliases = {}
+        self.created = set()
+        # The change to a moved file, by cookie, to be delivered at
+        # the target.
+        self.modified = {}
+        self.condition = threading.Condition()
+        self.closed = False
+        self.busy = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __call__(self, events):
+        deadline = time.monotonic() + self.window
+        with self.condition:
+            for event in events:
+                self.add(event, deadline)
+            self.condition.notify()
+
+    def add(self, event, deadline):
+        changed = None
+        if event.mask == IN_MOVED_TO:
+            cookie = self.aliases.pop(event.cookie, event.cookie)
+            changed = self.modified.pop(cookie, None)
+            if cookie in self.created:
+                # The source was created within the window.
+                self.created.discard(cookie)
+                event = FileEvent(IN_CREATE, None, event.name)
+            else:
+                event.cookie = cookie
+
+        entry = self.pending.get(event.name)
+        events = self.merge(entry[1] if entry else [], event)
+        if events:
+            self.pending[event.name] = (deadline, events)
+        elif entry is not None:
+            del self.pending[event.name]
+        if changed is not None:
+            self.add(FileEvent(changed, None, event.name), deadline)
+
+    def merge(self, events, event):
+        mask = event.mask
+        if not events:
+            if mask == IN_MOVED_FROM:
+                self.moves[event.cookie] = event
+            elif mask == IN_MOVED_TO:
+                self.targets[event.cookie] = event
+            return [event]
+
+        last = events[-1]
+        previous = last.mask
+        if previous in (IN_MODIFY, IN_ATTRIB):
+            if mask in (IN_MOVED_FROM, IN_DELETE):
+                if mask == IN_MOVED_FROM:
+                    # Delivered at the target, after the move.
+                    self.modified[event.cookie] = previous
+                events = events[:-1]
+                if not events:
+                    return self.merge(events, event)
+                last = events[-1]
+                previous = last.mask
+
+        if mask == IN_MOVED_FROM:
+            if previous == IN_CREATE:
+                self.modified.pop(event.cookie, None)
+                self.created.add(event.cookie)
+                return events[:-1]
+            if previous == IN_MOVED_TO:
+                # Moved on; the next move target pairs with the source.
+                del self.targets[last.cookie]
+                self.aliases[event.cookie] = last.cookie
+                if event.cookie in self.modified:
+                    self.modified[last.cookie] = self.modified.pop(
+                        event.cookie
+                    )
+                return events[:-1]
+            self.moves[event.cookie] = event
+            return events + [event]
+
+        if mask == IN_MOVED_TO:
+            if previous == IN_MOVED_FROM and last.cookie == event.cookie:
+                # Moved back to where it came from.
+                del self.moves[event.cookie]
+                return events[:-1]
+            if previous in (IN_MODIFY, IN_ATTRIB, IN_DELETE):
+                events = events[:-1]
+            self.targets[event.cookie] = event
+            return events + [event]
+
+        if mask in (IN_MODIFY, IN_ATTRIB):
+            if previous in (IN_CREATE, IN_MODIFY):
+                return events
+            if previous == IN_ATTRIB:
+                return events[:-1] + [event]
+        elif mask == IN_DELETE:
+            if previous == IN_CREATE:
+                return events[:-1]
+            if previous == IN_MOVED_TO:
+                del self.targets[last.cookie]
+                source = self.moves.pop(last.cookie, None)
+                if source is not None:
+                    source.mask = IN_DELETE
+                    source.cookie = None
+                    return events[:-1]
+        elif mask == IN_CREATE:
+            if previous == IN_DELETE:
+                return events[:-1] + [FileEvent(IN_MODIFY, None, event.name)]
+            if previous == IN_CREATE:
+                return events
+
+        return events + [event]
+
+    def flush(self, force=False):
+        """Deliver the events for paths that have been quiet for the
+        window (or all of them, if ``force`` is set)."""
+
+        with self.condition:
+            events = self._due(None if force else time.monotonic())
+            self.busy += 1
+        try:
+            if events:
+                self.callback(events)
+        finally:
+            with self.condition:
+                self.busy -= 1
+                drained = not self.pending and not self.busy
+        if events and drained and self.drained is not None:
+            self.drained()
+
+    def idle(self):
+        """Return true if all events passed in have been delivered."""
+
+        with self.condition:
+            return not self.pending and not self.busy
+
+    def _due(self, now):
+        pending = self.pending
+        due = set(
+            name
+            for name, (deadline, events) in pending.items()
+            if now is None or deadline <= now
+        )
+
+        # Both ends of a move go out together.
+        for name in list(due):
+            for event in pending[name][1]:
+                if event.mask == IN_MOVED_FROM:
+                    other = self.targets.get(event.cookie)
+                elif event.mask == IN_MOVED_TO:
+                    other = self.moves.get(event.cookie)
+                else:
+                    continue
+                if other is not None and other.name in pending:
+                    due.add(other.name)
+
+        result = []
+        emitted = set()
+        for name in [name for name in pending if name in due]:
+            for event in pending.pop(name)[1]:
+                if event.mask == IN_MOVED_TO:
+                    self.targets.pop(event.cookie, None)
+                    source = self.moves.pop(event.cookie, None)
+                    if source is not None and id(source) not in emitted:
+                        result.append(source)
+                        emitted.add(id(source))
+                elif event.mask == IN_MOVED_FROM:
+                    self.moves.pop(event.cookie, None)
+                    self.modified.pop(event.cookie, None)
+                if id(event) not in emitted:
+                    result.append(event)
+                    emitted.add(id(event))
+        return result
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.closed:
+                    return
+                if self.pending:
+                    timeout = max(
+                        0,
+                        min(deadline for deadline, _ in self.pending.values())
+                        - time.monotonic(),
+                    )
+                else:
+                    timeout = None
+                self.condition.wait(timeout)
+                if self.closed:
+                    return
+            self.flush()
+
+    def close(self):
+        """Stop the flushing thread and deliver what is pending."""
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.flush(force=True)
+
+
+class Dispatcher(object):
+    """Deliver events from a pool of ``workers`` threads, so that a slow
+    callback does not hold up the observer thread.
+
+    At most ``maxsize`` deliveries are queued. When the queue is full,
+    the ``overflow`` policy applies:
+
+    ``"block"``
+       The observer thread waits for room in the queue.
+
+    ``"drop_oldest"``
+       The oldest queued delivery is dropped.
+
+    ``"rescan"``
+       All queued deliveries are dropped, along with the new one, and
+       replaced by a single marker telling the callback to rescan:
+       ``IN_Q_OVERFLOW`` file events or ``FS_FLAGMUSTSCANSUBDIRS``
+       path events for the paths of the stream.
+
+    With more than one worker, deliveries may be handled out of order;
+    see :class:`ShardedDispatcher`.
+
+    If set, ``drained`` is called from a worker after a delivery that
+    leaves the queues empty and no other delivery in progress.
+    """
+
+    policies = ("block", "drop_oldest", "rescan")
+
+    def __init__(self, workers=1, maxsize=1024, overflow="block"):
+        if overflow not in self.policies:
+            raise ValueError("Invalid overflow policy: %r." % overflow)
+        self.workers = workers
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.condition = threading.Condition()
+        self.queues = [deque() for i in range(self.shards())]
+        self.lags = [0.0] * len(self.queues)
+        self.threads = []
+        self.callback = None
+        self.drained = None
+        self.marker = None
+        self.closed = True
+        self.busy = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.overflows = 0
+
+    def shards(self):
+        return 1
+
+    def start(self, callback, overflow_events=list):
+        with self.condition:
+            if not self.closed:
+                raise ValueError("Dispatcher already started.")
+            self.closed = False
+        self.callback = callback
+        self.overflow_events = overflow_events
+        self.threads = [
+            threading.Thread(target=self.run, args=(i % len(self.queues),))
+            for i in range(self.workers)
+        ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def __call__(self, events):
+        with self.condition:
+            if self.put(0, events):
+                return
+        self.deliver(events)
+
+    def put(self, shard, events):
+        # Must be called with the condition held. Returns false if the
+        # dispatcher is closed, for the caller to deliver ``events``
+        # once it has released the condition.
+        if self.closed:
+            if self.callback is None:
+                raise ValueError("Dispatcher not started.")
+            return False
+        queue = self.queues[shard]
+        if len(queue) >= self.maxsize:
+            self.overflows += 1
+            if self.overflow == "block":
+                while len(queue) >= self.maxsize and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    self.dropped += len(events)
+                    return True
+            elif self.overflow == "drop_oldest":
+                self.dropped += len(queue.popleft()[1])
+            else:
+                if queue and queue[-1][1] is self.marker:
+                    self.dropped += len(events)
+                    return True
+                self.dropped += len(events) + sum(
+                    len(queued) for _, queued in queue
+                    if queued is not self.marker
+                )
+                queue.clear()
+                events = self.marker = self.overflow_events()
+        queue.append((time.monotonic(), events))
+        self.queued += len(events)
+        self.max_queued = max(self.max_queued, len(queue))
+        self.condition.notify_all()
+        return True
+
+    def deliver(self, events):
+        # The workers have exited; deliver on the calling thread.
+        self.callback(events)
+        with self.condition:
+            self.delivered += len(events)
+
+    def run(self, shard):
+        queue = self.queues[shard]
+        while True:
+            with self.condition:
+                while not queue:
+                    if self.closed:
+                        return
+                    self.condition.wait()
+                enqueued, events = queue.popleft()
+                self.lags[shard] = time.monotonic() - enqueued
+                self.busy += 1
+                self.condition.notify_all()
+            try:
+                self.callback(events)
+            except Exception:
+                # Keep the worker alive; there is no caller to raise to.
+                sys.excepthook(*sys.exc_info())
+            finally:
+                with self.condition:
+                    self.busy -= 1
+                    self.delivered += len(events)
+                    self.settle(shard)
+                    drained = not self.busy and not any(self.queues)
+            if drained and self.drained is not None:
+                try:
+                    self.drained()
+                except Exception:
+                    sys.excepthook(*sys.exc_info())
+
+    def settle(self, shard):
+        # Called with the condition held after a delivery from ``shard``.
+        pass
+
+    def idle(self):
+        """Return true if all events passed in have been delivered."""
+
+        with self.condition:
+            return not self.busy and not any(self.queues)
+
+    def counters(self):
+        """Return a snapshot of the queue depth and event counters.
+
+        ``lag`` is how long the last delivery taken off the queue had
+        been waiting, in seconds.
+        """
+
+        with self.condition:
+            return {
+                "depth": sum(map(len, self.queues)),
+                "max_depth": self.max_queued,
+                "busy": self.busy,
+                "queued": self.queued,
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+                "overflows": self.overflows,
+                "lag": max(self.lags),
+            }
+
+    def close(self):
+        """Deliver what is queued and stop the workers."""
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class ShardedDispatcher(Dispatcher):
+    """Deliver events from ``workers`` threads, keeping the order of
+    the events in each directory.
+
+    Events are sharded by their directory (the parent directory of a
+    file event, the path of a path event) over one queue and worker
+    each. Both ends of a move go to the same shard, in one delivery;
+    the directories of a move stay pinned to that shard until it has
+    drained, and the move waits for earlier deliveries of the target
+    directory on another shard. Each shard has its own queue of
+    ``maxsize`` deliveries; the ``overflow`` policy applies per shard.
+    The counters include the depth and lag of each shard.
+    """
+
+    def __init__(self, *args, **kwargs):
+        Dispatcher.__init__(self, *args, **kwargs)
+        # The shard of each directory with deliveries queued or in
+        # progress, and the directories of each shard.
+        self.routes = {}
+        self.routed = [set() for queue in self.queues]
+
+    def shards(self):
+        return self.workers
+
+    def __call__(self, events):
+        routes = self.routes
+        count = len(self.queues)
+        shards = {}
+        cookies = {}
+        late = []
+        with self.condition:
+            for event in events:
+                if isinstance(event, FileEvent):
+                    directory = os.path.dirname(event.name)
+                    cookie = event.cookie
+                else:
+                    directory = event[0].rstrip("/")
+                    cookie = None
+                shard = routes.get(directory)
+                if cookie in cookies:
+                    # The other end of a move.
+                    if shard is not None and shard != cookies[cookie]:
+                        self.reroute(
+                            directory, cookies[cookie], shards, late
+                        )
+                    shard = cookies[cookie]
+                elif shard is None:
+                    shard = hash(directory) % count
+                if cookie is not None:
+                    cookies[cookie] = shard
+                self.route(directory, shard)
+                queued, directories = shards.setdefault(shard, ([], set()))
+                queued.append(event)
+                directories.add(directory)
+
+            for shard in list(shards):
+                self.hand_over(shard, shards.pop(shard), late)
+        for events in late:
+            self.deliver(events)
+
+    def route(self, directory, shard):
+        self.routes[directory] = shard
+        self.routed[shard].add(directory)
+
+    def hand_over(self, shard, routed, late):
+        events, directories = routed
+        if not self.put(shard, events):
+            late.append(events)
+            return
+        # The shard may have drained while waiting for room.
+        for directory in directories:
+            self.route(directory, shard)
+
+    def reroute(self, directory, shard, shards, late):
+        # Must be called with the condition held. Hand over what is
+        # routed, except to ``shard``, which holds the start of the
+        # move, and wait for ``directory`` to drain.
+        for other in list(shards):
+            if other != shard:
+                self.hand_over(other, shards.pop(other), late)
+        while self.routes.get(directory, shard) != shard:
+            if self.closed:
+                return
+            self.condition.wait()
+
+    def settle(self, shard):
+        if not self.queues[shard]:
+            for directory in self.routed[shard]:
+                del self.routes[directory]
+            self.routed[shard].clear()
+            self.condition.notify_all()
+
+    def counters(self):
+        """As for :class:`Dispatcher`, with a list of ``shards`` giving
+        the ``depth``, ``lag`` and the age of the ``oldest`` queued
+        delivery of each."""
+
+        counters = Dispatcher.counters(self)
+        now = time.monotonic()
+        with self.condition:
+            counters["shards"] = [
+                {
+                    "depth": len(queue),
+                    "lag": lag,
+                    "oldest": now - queue[0][0] if queue else 0.0,
+                }
+                for queue, lag in zip(self.queues, self.lags)
+            ]
+        return counters
+
+
+class AsyncEventIterator(object):
+    """Deliver the events of a stream to an ``asyncio`` event loop.
+
+    Each delivery is handed over to the loop in a single
+    ``call_soon_threadsafe`` call. At most ``maxsize`` events are
+    buffered; beyond that, delivery blocks the observer thread until
+    the consumer catches up (a single delivery larger than ``maxsize``
+    is let through when the buffer is empty). The iterator yields
+    events one by one, or lists of events if ``batch`` is set, and
+    stops when the stream is unscheduled.
+
+    Without ``loop``, it must be created on the thread of a running
+    loop, which it is bound to; otherwise ``RuntimeError`` is raised.
+    """
+
+    def __init__(self, maxsize=1024, batch=False, loop=None):
+        if loop is None:
+            loop = asyncio.get_running_loop()
+        self.loop = loop
+        self.maxsize = maxsize
+        self.batch = batch
+        self.size = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.batches = deque()
+        self.current = iter(())
+        self.waiter = None
+
+    def __call__(self, events):
+        with self.condition:
+            while (
+                self.size
+                and self.size + len(events) > self.maxsize
+                and not self.closed
+            ):
+                self.condition.wait()
+            if self.closed:
+                return
+            self.size += len(events)
+        self.loop.call_soon_threadsafe(self._put, events)
+
+    def _put(self, events):
+        self.batches.append(events)
+        self._wake()
+
+    def _wake(self):
+        waiter = self.waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.batch:
+            for event in self.current:
+                return event
+        while not self.batches:
+            if self.closed:
+                raise StopAsyncIteration
+            self.waiter = self.loop.create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+
+        events = self.batches.popleft()
+        with self.condition:
+            self.size -= len(events)
+            self.condition.notify()
+        if self.batch:
+            return events
+        self.current = iter(events)
+        return next(self.current)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        try:
+            self.loop.call_soon_threadsafe(self._wake)
+        except RuntimeError:
+            # the loop is closed
+            pass
+
+
+def _log_segments(directory):
+    """Return the base offsets and file names of the segments of an
+    event log, oldest first."""
+
+    segments = []
+    for name in os.listdir(directory):
+        base, ext = os.path.splitext(name)
+        if ext == ".seg" and base.isdigit():
+            segments.append((int(base), os.path.join(directory, name)))
+    segments.sort()
+    return segments
+
+
+class EventLog(object):
+    """Sink writing the delivered events to an append-only log.
+
+    The log is a directory of segment files of about ``segment_size``
+    bytes each. Every event is written as a record tagged with its
+    offset in the log (the number of bytes written before it), and a
+    delivery is appended with a single ``write`` call. Use
+    :class:`EventLogReader` to read the log from any number of
+    processes.
+
+    When a segment is full, the next one is started and the full one
+    is sealed. The oldest sealed segments are deleted while the log
+    is larger than ``retention_bytes`` or the segments are older than
+    ``retention_age`` seconds. With ``compact``, a sealed segment is
+    rewritten to keep only the last event per path (both ends of a
+    move are kept); the offsets of the events are unchanged.
+
+    Only one writer may use the log at a time. On opening, a record
+    left incomplete by a crash is cut off the end of the log.
+    """
+
+    magic = b"FSEVLOG1"
+    # Magic, base offset, end offset (zero until sealed) and flags.
+    header = struct.Struct("=8sQQQ")
+    # Size, checksum, kind, mask, length of the path, cookie, event ID
+    # and offset, followed by the path.
+    record = struct.Struct("=IIIIIQQQ")
+
+    PATH, PATH_ID, FILE, BYTES = 0, 1, 2, 4
+    COMPACTED = 1
+
+    def __init__(
+        self,
+        directory,
+        segment_size=64 << 20,
+        retention_bytes=None,
+        retention_age=None,
+        compact=False,
+        sync=False,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retention_bytes = retention_bytes
+        self.retention_age = retention_age
+        self.compact = compact
+        self.sync = sync
+        self.lock = threading.Lock()
+        self.fd = None
+        self.records = 0
+        self.segments_rolled = 0
+        self.segments_deleted = 0
+        self.segments_compacted = 0
+
+        segments = _log_segments(directory)
+        for (base, filename), (end, _) in zip(segments, segments[1:]):
+            self._seal(filename, end)
+        if segments:
+            self._recover(*segments[-1])
+        else:
+            self._create(0)
+
+    def _create(self, base):
+        filename = os.path.join(self.directory, "%020d.seg" % base)
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.write(fd, self.header.pack(self.magic, base, 0, 0))
+        self.fd = fd
+        self.base = base
+        self.position = self.header.size
+
+    def _seal(self, filename, end):
+        # Left unsealed if the writer stopped while rolling over.
+        with open(filename, "r+b") as f:
+            header = f.read(self.header.size)
+            if len(header) == self.header.size:
+                if not self.header.unpack(header)[2]:
+                    os.pwrite(f.fileno(), struct.pack("=Q", end), 16)
+
+    def _recover(self, base, filename):
+        fd = os.open(filename, os.O_RDWR)
+        size = os.fstat(fd).st_size
+        if size < self.header.size:
+            os.close(fd)
+            self._create(base)
+            return
+        with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as buf:
+            magic, base, end, flags = self.header.unpack_from(buf)
+            if magic != self.magic:
+                os.close(fd)
+                raise ValueError("Not an event log segment: %s" % filename)
+            position = self.header.size
+            while True:
+                record = self._parse(buf, position)
+                if record is None:
+                    break
+                position += record[0]
+        if end:
+            # Sealed; start the next segment.
+            os.close(fd)
+            self._create(end)
+            return
+        if position < size:
+            os.ftruncate(fd, position)
+        os.lseek(fd, position, os.SEEK_SET)
+        self.fd = fd
+        self.base = base
+        self.position = position
+
+    @classmethod
+    def _parse(cls, buf, position):
+        """Return the size, kind, mask, cookie, event ID, offset and
+        path of the record at ``position``, or ``None`` if there is no
+        complete record there."""
+
+        record = cls.record
+        if position + record.size > len(buf):
+            return None
+        (
+            size,
+            checksum,
+            kind,
+            mask,
+            length,
+            cookie,
+            event_id,
+            offset,
+        ) = record.unpack_from(buf, position)
+        end = position + record.size + length
+        if size < record.size + length or position + size > len(buf):
+            return None
+        if zlib.crc32(buf[position + 8:end]) != checksum:
+            return None
+        path = bytes(buf[position + record.size:end])
+        return size, kind, mask, cookie, event_id, offset, path
+
+    @classmethod
+    def _fields(cls, event):
+        """Return the kind, mask, cookie, event ID and encoded path of
+        an event."""
+
+        if isinstance(event, FileEvent):
+            kind = cls.FILE
+            path, mask, cookie, event_id = event.name, event.mask, 0, 0
+            if event.cookie is not None:
+                cookie = event.cookie
+        else:
+            kind = cls.PATH if len(event) == 2 else cls.PATH_ID
+            path, mask = event[0], event[1]
+            cookie = 0
+            event_id = event[2] if len(event) > 2 else 0
+        if isinstance(path, bytes):
+            kind |= cls.BYTES
+        else:
+            path = path.encode("utf-8", "surrogateescape")
+        return kind, mask, cookie, event_id, path
+
+    def _encode(self, event, offset):
+        kind, mask, cookie, event_id, path = self._fields(event)
+        record = self.record
+        length = len(path)
+        end = record.size + length
+        data = bytearray((end + 7) & ~7)
+        record.pack_into(
+            data, 0, len(data), 0, kind, mask, length, cookie, event_id, offset
+        )
+        data[record.size:end] = path
+        struct.pack_into("=I", data, 4, zlib.crc32(memoryview(data)[8:end]))
+        return data
+
+    @classmethod
+    def _decode(cls, kind, mask, cookie, event_id, path):
+        if not kind & cls.BYTES:
+            path = path.decode("utf-8", "surrogateescape")
+        kind &= ~cls.BYTES
+        if kind == cls.FILE:
+            return FileEvent(mask, cookie or None, path)
+        if kind == cls.PATH_ID:
+            return path, mask, event_id
+        return path, mask
+
+    @property
+    def offset(self):
+        """The offset of the next event written."""
+
+        return self.base + self.position - self.header.size
+
+    def __call__(self, events):
+        with self.lock:
+            if self.fd is None:
+                return
+            if self.position >= self.segment_size:
+                self._roll()
+            chunks = []
+            offset = self.offset
+            for event in events:
+                chunk = self._encode(event, offset)
+                chunks.append(chunk)
+                offset += len(chunk)
+            data = b"".join(chunks)
+            os.write(self.fd, data)
+            self.position += len(data)
+            self.records += len(chunks)
+            if self.sync:
+                os.fsync(self.fd)
+
+    def _roll(self):
+        fd = self.fd
+        end = self.offset
+        os.fsync(fd)
+        self._create(end)
+        # Seal the full segment once the next one exists, so a reader
+        # that finds it sealed can move on.
+        os.pwrite(fd, struct.pack("=Q", end), 16)
+        os.close(fd)
+        self.segments_rolled += 1
+
+        segments = _log_segments(self.directory)[:-1]
+        if self.compact:
+            for base, filename in segments:
+                self._compact(filename)
+        self._retain(segments)
+
+    def _compact(self, filename):
+        with open(filename, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                magic, base, end, flags = self.header.unpack_from(buf)
+                if flags & self.COMPACTED or not end:
+                    return
+                records = []
+                position = self.header.size
+                while True:
+                    record = self._parse(buf, position)
+                    if record is None:
+                        break
+                    records.append(
+                        (record, bytes(buf[position:position + record[0]]))
+                    )
+                    position += record[0]
+
+        # Keep the last event per path, and both ends of every move.
+        last = {}
+        moves = set()
+        for index, (record, data) in enumerate(records):
+            size, kind, mask, cookie, event_id, offset, path = record
+            if kind & ~self.BYTES == self.FILE and cookie:
+                moves.add(index)
+            else:
+                last[path] = index
+        keep = moves.union(last.values())
+        tmp = filename + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.header.pack(magic, base, end, self.COMPACTED))
+            for index, (record, data) in enumerate(records):
+                if index in keep:
+                    f.write(data)
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+        # Readers keep the mapping of the segment they are reading.
+        os.replace(tmp, filename)
+        self.segments_compacted += 1
+
+    def _retain(self, segments):
+        now = time.time()
+        total = sum(os.path.getsize(filename) for base, filename in segments)
+        total += self.position
+        for base, filename in segments:
+            expired = (
+                self.retention_age is not None
+                and now - os.path.getmtime(filename) > self.retention_age
+            )
+            if not expired and (
+                self.retention_bytes is None or total <= self.retention_bytes
+            ):
+                break
+            total -= os.path.getsize(filename)
+            os.unlink(filename)
+            self.segments_deleted += 1
+
+    def flush(self):
+        """Sync the current segment to disk."""
+
+        with self.lock:
+            if self.fd is not None:
+                os.fsync(self.fd)
+
+    def counters(self):
+        """Return the ``offset`` of the next event, the number of
+        ``records`` written and of segments ``rolled``, ``deleted``
+        and ``compacted``."""
+
+        with self.lock:
+            return {
+                "offset": self.offset,
+                "records": self.records,
+                "rolled": self.segments_rolled,
+                "deleted": self.segments_deleted,
+                "compacted": self.segments_compacted,
+            }
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.fsync(self.fd)
+                os.close(self.fd)
+                self.fd = None
+
+
+class EventLogReader(object):
+    """Tail an :class:`EventLog` from ``offset`` (by default, the
+    oldest event retained).
+
+    Segments are memory-mapped and read without locking; any number
+    of readers, in any process, can follow the log independently.
+    :meth:`read` returns the events written since the last call along
+    with their offsets; ``offset`` is where reading continues, which
+    a consumer can store to resume from. If the log no longer has the
+    events at the offset (they were deleted by retention), reading
+    skips ahead and the number of bytes skipped is added to ``lost``.
+    """
+
+    def __init__(self, directory, offset=None):
+        self.directory = directory
+        self.offset = offset
+        self.lost = 0
+        self.file = None
+        self.buf = None
+        self.base = None
+        self.position = 0
+
+    def _open(self):
+        """Map the segment holding ``offset``; return false if there
+        is none yet."""
+
+        segments = _log_segments(self.directory)
+        if not segments:
+            return False
+        if self.offset is None:
+            self.offset = segments[0][0]
+        found = None
+        for base, filename in segments:
+            if base > self.offset:
+                if found is None:
+                    self.lost += base - self.offset
+                    self.offset = base
+                    found = base, filename
+                break
+            found = base, filename
+        base, filename = found
+        try:
+            f = open(filename, "rb")
+        except FileNotFoundError:
+            # Deleted by retention in the meantime.
+            return self._open()
+        self._close()
+        self.file = f
+        self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.base = base
+        self.position = EventLog.header.size
+        if self.offset > base:
+            flags = EventLog.header.unpack_from(self.buf)[3]
+            if not flags & EventLog.COMPACTED:
+                self.position += self.offset - base
+            else:
+                self._seek()
+        return True
+
+    def _seek(self):
+        while True:
+            record = EventLog._parse(self.buf, self.position)
+            if record is None or record[5] >= self.offset:
+                return
+            self.position += record[0]
+
+    def _remap(self):
+        """Map the segment again if it has grown; return true if so."""
+
+        size = os.fstat(self.file.fileno()).st_size
+        if size <= len(self.buf):
+            return False
+        self.buf.close()
+        self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return True
+
+    def read(self, limit=None):
+        """Return a list of ``(offset, event)`` tuples for the events
+        written since the last call, up to ``limit`` of them."""
+
+        events = []
+        if self.buf is None and not self._open():
+            return events
+        while limit is None or len(events) < limit:
+            record = EventLog._parse(self.buf, self.position)
+            if record is None:
+                # The segment is sealed after its last event is written,
+                # so check for that before checking for more events.
+                end = EventLog.header.unpack_from(self.buf)[2]
+                if self._remap():
+                    continue
+                if not end:
+                    break
+                # Continue with the next segment.
+                self.offset = end
+                if not self._open() or self.base < end:
+                    break
+                continue
+            size, kind, mask, cookie, event_id, offset, path = record
+            events.append(
+                (offset, EventLog._decode(kind, mask, cookie, event_id, path))
+            )
+            self.position += size
+            self.offset = offset + size
+        return events
+
+    def _close(self):
+        if self.buf is not None:
+            self.buf.close()
+            self.buf = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_u64 = struct.Struct("=Q")
+
+
+def _attach_shared_memory(name):
+    """Map the shared memory block ``name``; return the mapping and a
+    memoryview of it.
+
+    The block is not registered with the resource tracker, which would
+    unlink it when this process exits.
+    """
+
+    try:
+        mapping = shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Before Python 3.13.
+        if os.name == "nt":
+            mapping = shared_memory.SharedMemory(name)
+        else:
+            import _posixshmem
+
+            fd = _posixshmem.shm_open("/" + name, os.O_RDWR, mode=0o600)
+            try:
+                mapping = mmap.mmap(fd, os.fstat(fd).st_size)
+            finally:
+                os.close(fd)
+            return mapping, memoryview(mapping)
+    return mapping, mapping.buf
+
+
+class SharedRing(object):
+    """Sink passing the delivered events to worker processes through a
+    ring buffer in shared memory.
+
+    The ring holds ``capacity`` fixed-size records, and the paths in a
+    separate area of ``path_bytes`` bytes (by default 64 per record);
+    events are written in place, without pickling or pipes. Up to
+    ``consumers`` :class:`SharedRingReader` instances, attached by the
+    ``name`` of the ring and their index from any process, each read
+    every event at their own cursor.
+
+    By default delivery never waits for a consumer: the oldest records
+    are overwritten, and a consumer which falls behind skips ahead and
+    counts the events missed in ``lost``. With ``block``, delivery
+    instead waits until every attached consumer has read what is about
+    to be overwritten.
+    """
+
+    magic = b"FSEVRNG1"
+    # Magic, capacity, consumers, size of the path area, sequence
+    # number of the last event published, end of the paths written and
+    # closed flag.
+    header = struct.Struct("=8sIIQQQQ")
+    HEAD, PATHS, CLOSED = 24, 32, 40
+    # Next sequence number to read (zero if detached) and events lost,
+    # per consumer.
+    cursor = struct.Struct("=QQ")
+    # Sequence number (zero while being written), kind, mask, length of
+    # the path, cookie, event ID and position of the path.
+    record = struct.Struct("=QIIIxxxxQQQ")
+
+    def __init__(
+        self, capacity=65536, consumers=4, path_bytes=None, block=False
+    ):
+        if path_bytes is None:
+            path_bytes = capacity * 64
+        self.capacity = capacity
+        self.consumers = consumers
+        self.path_bytes = path_bytes
+        self.block = block
+        self.records, self.paths = self.layout(capacity, consumers)
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=self.paths + path_bytes
+        )
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.buf[:self.records] = bytes(self.records)
+        self.header.pack_into(
+            self.buf, 0, self.magic, capacity, consumers, path_bytes, 0, 0, 0
+        )
+        self.lock = threading.Lock()
+        self.head = 0
+        self.path_head = 0
+        self.waits = 0
+
+    @classmethod
+    def layout(cls, capacity, consumers):
+        """Return the offsets of the records and of the path area."""
+
+        records = cls.header.size + consumers * cls.cursor.size
+        return records, records + capacity * cls.record.size
+
+    def __call__(self, events):
+        with self.lock:
+            if self.buf is None:
+                return
+            # Events are published in chunks of up to half the ring, so
+            # that consumers can read one while the next is written.
+            limit = self.capacity // 2 or 1
+            path_limit = self.path_bytes // 2
+            fields = EventLog._fields
+            chunk = []
+            size = 0
+            for event in events:
+                item = fields(event)
+                length = len(item[-1])
+                if length > path_limit:
+                    raise ValueError(
+                        "Path does not fit in the ring: %r" % item[-1]
+                    )
+                if len(chunk) == limit or size + length > path_limit:
+                    self._put(chunk)
+                    chunk = []
+                    size = 0
+                chunk.append(item)
+                size += length
+            if chunk:
+                self._put(chunk)
+
+    def _put(self, chunk):
+        record = self.record
+        path_bytes = self.path_bytes
+        first = self.head + 1
+        records = []
+        paths = []
+        start = position = self.path_head
+        for seq, (kind, mask, cookie, event_id, path) in enumerate(
+            chunk, first
+        ):
+            length = len(path)
+            if position % path_bytes + length > path_bytes:
+                # Paths are not wrapped around the end of the area.
+                gap = path_bytes - position % path_bytes
+                paths.append(bytes(gap))
+                position += gap
+            records.append(
+                record.pack(
+                    seq, kind, mask, length, cookie, event_id, position
+                )
+            )
+            paths.append(path)
+            position += length
+        last = first + len(chunk) - 1
+        if self.block:
+            self._wait(last, position)
+
+        # Readers check that the slot of the oldest record they have
+        # read still has its sequence number, and its path is within
+        # the end of the paths, after they are done reading.
+        self.path_head = position
+        _u64.pack_into(self.buf, self.PATHS, position)
+        data = b"".join(records)
+        area = self.capacity * record.size
+        index = (first - 1) % self.capacity * record.size
+        self._copy(self.records, area, index, bytes(len(data)))
+        self._copy(self.paths, path_bytes, start % path_bytes, b"".join(paths))
+        self._copy(self.records, area, index, data)
+        self.head = last
+        _u64.pack_into(self.buf, self.HEAD, last)
+
+    def _copy(self, offset, size, start, data):
+        # Copy to the area of ``size`` bytes at ``offset``, from
+        # ``start`` and wrapping around its end.
+        count = min(len(data), size - start)
+        self.buf[offset + start:offset + start + count] = data[:count]
+        if count < len(data):
+            self.buf[offset:offset + len(data) - count] = data[count:]
+
+    def _cursors(self):
+        for consumer in range(self.consumers):
+            yield self.cursor.unpack_from(
+                self.buf, self.header.size + consumer * self.cursor.size
+            )
+
+    def _wait(self, seq, path_end):
+        # Wait for the record with sequence number ``seq`` and the path
+        # area up to ``path_end`` to be free.
+        delay = 0.00005
+        while True:
+            oldest = min(
+                (cursor for cursor, lost in self._cursors() if cursor),
+                default=None,
+            )
+            if oldest is None or oldest > self.head:
+                return
+            if seq - oldest < self.capacity:
+                slot = (oldest - 1) % self.capacity * self.record.size
+                position = self.record.unpack_from(
+                    self.buf, self.records + slot
+                )[-1]
+                if path_end - self.path_bytes <= position:
+                    return
+            self.waits += 1
+            time.sleep(delay)
+            delay = min(delay * 2, 0.001)
+
+    def counters(self):
+        """Return the ``head`` (the sequence number of the last event),
+        the number of ``waits`` for consumers and a list of the
+        ``lag`` and ``lost`` events of each consumer (``None`` for
+        consumers which are not attached)."""
+
+        with self.lock:
+            if self.buf is None:
+                return {"head": self.head, "waits": self.waits}
+            return {
+                "head": self.head,
+                "waits": self.waits,
+                "consumers": [
+                    {"lag": self.head + 1 - cursor, "lost": lost}
+                    if cursor
+                    else None
+                    for cursor, lost in self._cursors()
+                ],
+            }
+
+    def close(self):
+        """Tell the consumers that no more events follow and unlink the
+        shared memory; attached consumers can read what is left."""
+
+        with self.lock:
+            if self.buf is None:
+                return
+            _u64.pack_into(self.buf, self.CLOSED, 1)
+            self.buf = None
+            self.shm.close()
+            self.shm.unlink()
+
+
+class SharedRingReader(object):
+    """Read the events of the :class:`SharedRing` ``name`` as its
+    consumer number ``consumer``.
+
+    The cursor of a consumer is kept in the ring, so a restarted worker
+    continues where the previous one stopped; a consumer which was not
+    attached starts with the next event. Close the reader with
+    ``detach`` to release the cursor (a blocking ring otherwise waits
+    for it).
+    """
+
+    def __init__(self, name, consumer):
+        self.mapping, self.buf = _attach_shared_memory(name)
+        (
+            magic,
+            self.capacity,
+            consumers,
+            self.path_bytes,
+            head,
+            paths,
+            closed,
+        ) = SharedRing.header.unpack_from(self.buf)
+        if magic != SharedRing.magic:
+            self.close()
+            raise ValueError("Not an event ring: %s" % name)
+        if not 0 <= consumer < consumers:
+            self.close()
+            raise ValueError("No consumer %d in the ring." % consumer)
+        self.records, self.paths = SharedRing.layout(self.capacity, consumers)
+        self.offset = (
+            SharedRing.header.size + consumer * SharedRing.cursor.size
+        )
+        self.next, self.lost = SharedRing.cursor.unpack_from(
+            self.buf, self.offset
+        )
+        if not self.next:
+            self.next = head + 1
+            SharedRing.cursor.pack_into(
+                self.buf, self.offset, self.next, self.lost
+            )
+
+    @property
+    def closed(self):
+        """Whether the ring has been closed by the writer."""
+
+        return bool(_u64.unpack_from(self.buf, SharedRing.CLOSED)[0])
+
+    def read(self, limit=None):
+        """Return the events published since the last call, up to
+        ``limit`` of them."""
+
+        buf = self.buf
+        record = SharedRing.record
+        capacity = self.capacity
+        path_bytes = self.path_bytes
+        seq = self.next
+        head = _u64.unpack_from(buf, SharedRing.HEAD)[0]
+        if seq > head:
+            return []
+        if head - seq >= capacity:
+            self.lost += head - capacity + 1 - seq
+            seq = head - capacity + 1
+        last = head if limit is None else min(head, seq + limit - 1)
+
+        # Copy the records and paths, then check which of them were not
+        # overwritten meanwhile; as the ring is written in order, they
+        # are the newest ones.
+        index = (seq - 1) % capacity
+        count = last - seq + 1
+        data = bytes(
+            buf[
+                self.records + index * record.size:
+                self.records + min(index + count, capacity) * record.size
+            ]
+        )
+        if index + count > capacity:
+            data += bytes(
+                buf[
+                    self.records:
+                    self.records + (index + count - capacity) * record.size
+                ]
+            )
+        records = list(record.iter_unpack(data))
+
+        def intact(i):
+            # Whether the slot of record ``i`` still holds it (slots are
+            # cleared before they are written again), and its path has
+            # not been written over.
+            slot = self.records + (index + i) % capacity * record.size
+            end = _u64.unpack_from(buf, SharedRing.PATHS)[0]
+            return (
+                _u64.unpack_from(buf, slot)[0] == seq + i
+                and records[i][6] >= end - path_bytes
+            )
+
+        def first_intact(low):
+            high = count
+            while low < high:
+                middle = (low + high) // 2
+                if intact(middle):
+                    high = middle
+                else:
+                    low = middle + 1
+            return low
+
+        # The paths of the intact records are copied in one piece (two
+        # if they wrap around), then checked again.
+        low = 0 if intact(0) else first_intact(1)
+        paths = []
+        while low < count:
+            stop = records[-1][6] + records[-1][3]
+            base = records[low][6]
+            start = self.paths + base % path_bytes
+            blob = bytes(
+                buf[start:min(start + stop - base, self.paths + path_bytes)]
+            )
+            if len(blob) < stop - base:
+                blob += bytes(
+                    buf[self.paths:self.paths + stop - base - len(blob)]
+                )
+            if intact(low):
+                paths = [
+                    blob[position - base:position - base + length]
+                    for s, kind, mask, length, cookie, event_id, position in (
+                        records[low:]
+                    )
+                ]
+                break
+            low = first_intact(low + 1)
+        self.lost += low
+        decode = EventLog._decode
+        events = []
+        append = events.append
+        for (s, kind, mask, length, cookie, event_id, position), path in zip(
+            records[low:], paths
+        ):
+            if kind == EventLog.FILE:
+                path = path.decode("utf-8", "surrogateescape")
+                append(FileEvent(mask, cookie or None, path))
+            else:
+                append(decode(kind, mask, cookie, event_id, path))
+        self.next = last + 1
+        SharedRing.cursor.pack_into(buf, self.offset, self.next, self.lost)
+        return events
+
+    def wait(self, timeout=None):
+        """Wait for an event to be published or the ring to be closed;
+        return false on timeout.
+
+        Shared memory has no means of notification, so this polls,
+        backing off from 50 microseconds to 1 ms.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.00005
+        while _u64.unpack_from(self.buf, SharedRing.HEAD)[0] < self.next:
+            if self.closed:
+                break
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.001)
+        return True
+
+    def __iter__(self):
+        """Yield the events until the ring is closed."""
+
+        while True:
+            closed = self.closed
+            events = self.read()
+            if events:
+                yield from events
+            elif closed:
+                return
+            else:
+                self.wait()
+
+    def close(self, detach=False):
+        if self.buf is None:
+            return
+        if detach:
+            SharedRing.cursor.pack_into(self.buf, self.offset, 0, self.lost)
+        self.buf.release()
+        self.buf = None
+        self.mapping.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 
 __all__ = (
@@ -1,4 +1,5 @@
 import os
+import sys
 
 from setuptools import setup
 from setuptools.command.build_ext import build_ext
@@ -10,18 +11,21 @@ def read(fname):
         return f.read()
 
 
-ext_modules = [
-    Extension(
-        name="_fsevents",
-        sources=["_fsevents.c", "compat.c"],
-        extra_link_args=[
-            "-framework",
-            "CoreFoundation",
-            "-framework",
-            "CoreServices",
-        ],
-    ),
-]
+# Elsewhere, the inotify implementation in ``_inotify.py`` is used.
+ext_modules = []
+if sys.platform == "darwin":
+    ext_modules.append(
+        Extension(
+            name="_fsevents",
+            sources=["_fsevents.c", "compat.c"],
+            extra_link_args=[
+                "-framework",
+                "CoreFoundation",
+                "-framework",
+                "CoreServices",
+            ],
+        )
+    )
 
 setup(
     name="MacFSEvents",
@@ -37,12 +41,13 @@ setup(
     url="https://github.com/malthe/macfsevents",
     cmdclass=dict(build_ext=build_ext),
     ext_modules=ext_modules,
-    platforms=["Mac OS X"],
+    platforms=["Mac OS X", "Linux"],
     classifiers=[
         "Development Status :: 4 - Beta",
         "Intended Audience :: Developers",
         "License :: OSI Approved :: BSD License",
         "Operating System :: MacOS :: MacOS X",
+        "Operating System :: POSIX :: Linux",
         "Programming Language :: C",
         "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: 3.9",
@@ -54,5 +59,5 @@ setup(
     ],
     zip_safe=False,
     test_suite="tests",
-    py_modules=["fsevents"],
+    py_modules=["fsevents", "_inotify", "_polling"],
 )
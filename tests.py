@@ -1,5 +1,15 @@
+import sys
 import unittest
 
+from _synthetic import SyntheticBackend
+
+# FSEvents reports the item flags a path has accumulated recently
+# (e.g. a file created just before the stream started); the inotify
+# backend only reports what happened while observing.
+fsevents_flags = unittest.skipUnless(
+    sys.platform == "darwin", "FSEvents item flags"
+)
+
 
 class BaseTestCase(unittest.TestCase):
     def setUp(self):
@@ -54,6 +64,7 @@ class PathObservationTestCase(BaseTestCase):
             + fsevents.FS_ITEMISFILE
         )
 
+    @fsevents_flags
     def test_single_file_added(self):
         events = []
 
@@ -87,6 +98,7 @@ class PathObservationTestCase(BaseTestCase):
 
         self.assertEqual(events, [(path, self.create_and_remove_mask)])
 
+    @fsevents_flags
     def test_multiple_files_added(self):
         events = []
 
@@ -148,6 +160,7 @@ class PathObservationTestCase(BaseTestCase):
             observer.unschedule(stream)
             observer.join()
 
+    @fsevents_flags
     def test_single_file_added_multiple_streams(self):
         events = []
 
@@ -225,6 +238,7 @@ class PathObservationTestCase(BaseTestCase):
 
         self.assertEqual(events, [])
 
+    @fsevents_flags
     def test_single_file_added_with_observer_rescheduled(self):
         events = []
 
@@ -310,6 +324,7 @@ class PathObservationTestCase(BaseTestCase):
             os.rmdir(subdirectory)
             os.rmdir(directory)
 
+    @fsevents_flags
     def test_single_file_added_unschedule_then_stop(self):
         events = []
 
@@ -343,6 +358,7 @@ class PathObservationTestCase(BaseTestCase):
 
         self.assertEqual(events, [(path, self.create_and_remove_mask)])
 
+    @fsevents_flags
     def test_start_then_watch(self):
         events = []
 
@@ -405,6 +421,7 @@ class PathObservationTestCase(BaseTestCase):
         self.assertEqual(events, [])
 
     # new cflags and since field tests
+    @fsevents_flags
     def test_since_stream(self):
         events = []
 
@@ -465,6 +482,7 @@ class PathObservationTestCase(BaseTestCase):
         self.assertEqual(events[1], (path1, self.create_and_remove_mask))
         self.assertEqual(events[0], (path1[:-1], FS_FLAGHISTORYDONE))
 
+    @fsevents_flags
     def test_fileevent_stream(self):
         events = []
 
@@ -515,6 +533,49 @@ class PathObservationTestCase(BaseTestCase):
             ],
         )
 
+    @fsevents_flags
+    def test_batch(self):
+        batches = []
+
+        def callback(*args):
+            batches.append(args)
+
+        import os
+
+        path = os.path.realpath(self._make_tempdir()) + "/"
+        f = self._make_temporary(path)[0]
+        g = self._make_temporary(path)[0]
+
+        from fsevents import FS_CFLAGFILEEVENTS, Observer, Stream
+
+        stream = Stream(
+            callback, path, flags=FS_CFLAGFILEEVENTS, ids=True, batch=True
+        )
+        observer = Observer()
+        observer.schedule(stream)
+        observer.start()
+
+        import time
+
+        while not observer.is_alive():
+            time.sleep(0.1)
+        del batches[:]
+        f.close()
+        g.close()
+        time.sleep(0.2)
+
+        observer.stop()
+        observer.unschedule(stream)
+        observer.join()
+        os.rmdir(path)
+
+        self.assertEqual(len(batches), 1)
+        (events,) = batches[0]
+        self.assertEqual(
+            [event[0] for event in events], [path[:-1], f.name, g.name]
+        )
+        self.assertEqual(len(events[0]), 3)
+
 
 class FileObservationTestCase(BaseTestCase):
     def test_single_file_created(self):
@@ -835,3 +896,2285 @@ class FileObservationTestCase(BaseTestCase):
         finally:
             os.rmdir(new1)
             os.rmdir(new2)
+
+    def test_batch(self):
+        import os
+
+        from fsevents import IN_CREATE, FileEventCallback
+
+        batches = []
+        callback = FileEventCallback(
+            batches.append, [self.tempdir], batch=True
+        )
+        root = os.path.realpath(self.tempdir)
+        callback([root.encode("utf-8")], [0], [0])
+        self.assertEqual(batches, [])
+
+        names = [os.path.join(root, name) for name in ("a", "b")]
+        for name in names:
+            open(name, "w").close()
+        try:
+            callback([root.encode("utf-8")], [0], [0])
+        finally:
+            for name in names:
+                os.unlink(name)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(
+            [event.mask for event in batches[0]], [IN_CREATE, IN_CREATE]
+        )
+        self.assertEqual(sorted(event.name for event in batches[0]), names)
+
+
+class EventBatchTestCase(unittest.TestCase):
+    def test_from_buffers(self):
+        from array import array
+
+        from fsevents import FS_ITEMCREATED, FS_ITEMREMOVED, EventBatch
+
+        masks = array("I", [FS_ITEMCREATED, FS_ITEMREMOVED, FS_ITEMREMOVED])
+        ids = array("Q", [1, 2, 2 ** 40])
+        batch = EventBatch.from_buffers(
+            b"/a\0/b/c\0/\xc3\xa9\0", masks.tobytes(), ids.tobytes()
+        )
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(batch.paths(), [b"/a", b"/b/c", b"/\xc3\xa9"])
+        self.assertEqual(batch.decode(), ["/a", "/b/c", "/\xe9"])
+        self.assertEqual(batch.path(1), b"/b/c")
+        self.assertEqual(list(batch.offsets), [0, 3, 8, 12])
+        self.assertEqual(list(batch.ids), [1, 2, 2 ** 40])
+        self.assertEqual(list(batch.where(FS_ITEMREMOVED)), [1, 2])
+        self.assertEqual(
+            list(batch.select([0, 2])),
+            [
+                (b"/a", FS_ITEMCREATED, 1),
+                (b"/\xc3\xa9", FS_ITEMREMOVED, 2 ** 40),
+            ],
+        )
+
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "inotify backend")
+class InotifyTestCase(BaseTestCase):
+    def _observe(self, change, **options):
+        import time
+
+        from fsevents import FS_CFLAGFILEEVENTS, Observer, Stream
+
+        events = []
+        options.setdefault("flags", FS_CFLAGFILEEVENTS)
+        stream = Stream(
+            lambda *args: events.append(args), self.tempdir, **options
+        )
+        observer = Observer()
+        observer.schedule(stream)
+        observer.start()
+        try:
+            change()
+            time.sleep(0.2)
+        finally:
+            observer.stop()
+            observer.unschedule(stream)
+            observer.join()
+        return events
+
+    def test_new_directories_are_watched(self):
+        import os
+        import shutil
+
+        from fsevents import (
+            FS_ITEMCREATED,
+            FS_ITEMISDIR,
+            FS_ITEMISFILE,
+            FS_ITEMMODIFIED
+        )
+
+        root = os.path.realpath(self.tempdir)
+        directory = os.path.join(root, "a")
+        filename = os.path.join(directory, "b", "test")
+
+        def change():
+            import time
+
+            os.makedirs(os.path.dirname(filename))
+            time.sleep(0.1)
+            with open(filename, "w") as f:
+                f.write("abc")
+
+        try:
+            events = self._observe(change)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(
+            events,
+            [
+                (directory, FS_ITEMCREATED | FS_ITEMISDIR),
+                (os.path.dirname(filename), FS_ITEMCREATED | FS_ITEMISDIR),
+                (filename, FS_ITEMCREATED | FS_ITEMMODIFIED | FS_ITEMISFILE),
+            ],
+        )
+
+    def test_renamed_directory(self):
+        import os
+        import shutil
+
+        from fsevents import FS_ITEMCREATED, FS_ITEMISFILE
+
+        root = os.path.realpath(self.tempdir)
+        os.mkdir(os.path.join(root, "a"))
+        target = os.path.join(root, "b")
+
+        def change():
+            import time
+
+            os.rename(os.path.join(root, "a"), target)
+            time.sleep(0.1)
+            open(os.path.join(target, "test"), "w").close()
+
+        try:
+            events = self._observe(change)
+        finally:
+            shutil.rmtree(target)
+        self.assertEqual(
+            events[-1],
+            (os.path.join(target, "test"), FS_ITEMCREATED | FS_ITEMISFILE),
+        )
+
+    def test_since(self):
+        import os
+
+        from fsevents import FS_FLAGHISTORYDONE, FS_ITEMISDIR, current_event_id
+
+        root = os.path.realpath(self.tempdir)
+        since = current_event_id()
+        filename = os.path.join(root, "test")
+        open(filename, "w").close()
+        try:
+            events = self._observe(lambda: None, since=since, flags=0)
+        finally:
+            os.unlink(filename)
+        self.assertEqual(
+            events, [(root + "/", FS_ITEMISDIR), (root, FS_FLAGHISTORYDONE)]
+        )
+
+
+class PollingTestCase(BaseTestCase):
+    def test_polling_observer(self):
+        import os
+        import time
+
+        from _polling import PollingBackend
+        from fsevents import (
+            FS_CFLAGFILEEVENTS,
+            FS_ITEMCREATED,
+            FS_ITEMISFILE,
+            FS_ITEMMODIFIED,
+            FS_ITEMREMOVED,
+            Observer,
+            Stream
+        )
+
+        events = []
+        stream = Stream(
+            lambda *args: events.append(args),
+            self.tempdir,
+            flags=FS_CFLAGFILEEVENTS,
+        )
+        observer = Observer(
+            backend=PollingBackend(interval=0.01, max_interval=0.02)
+        )
+        observer.schedule(stream)
+        observer.start()
+        filename = os.path.join(os.path.realpath(self.tempdir), "test")
+        try:
+            with open(filename, "w") as f:
+                f.write("abc")
+            time.sleep(0.2)
+            with open(filename, "w") as f:
+                f.write("abcdef")
+            time.sleep(0.2)
+            os.unlink(filename)
+            time.sleep(0.2)
+        finally:
+            observer.stop()
+            observer.unschedule(stream)
+            observer.join()
+        self.assertEqual(
+            events,
+            [
+                (filename, FS_ITEMCREATED | FS_ITEMISFILE),
+                (filename, FS_ITEMMODIFIED | FS_ITEMISFILE),
+                (filename, FS_ITEMREMOVED | FS_ITEMISFILE),
+            ],
+        )
+
+    def test_unchanged_directory_is_not_listed(self):
+        import os
+
+        from _polling import Poller, PollingBackend, RunLoop
+
+        root = os.path.realpath(self.tempdir).encode("utf-8")
+        names = [os.path.join(root, b"a"), os.path.join(root, b"b")]
+        for name in names:
+            open(name, "w").close()
+        os.utime(root, ns=(0, 0))
+        try:
+            backend = PollingBackend(interval=1, max_interval=4)
+            poller = Poller(backend, RunLoop(), None, [root], -1, 0, 0)
+            poller.calls = 0
+            self.assertFalse(poller.poll(root))
+            # One ``lstat`` for the directory and one per file.
+            self.assertEqual(poller.calls, 3)
+
+            with open(names[0], "w") as f:
+                f.write("abc")
+            self.assertTrue(poller.poll(root))
+            self.assertEqual(list(poller.pending), [root + b"/"])
+        finally:
+            for name in names:
+                os.unlink(name)
+
+    def test_budget_shared_across_threads(self):
+        import os
+
+        from _polling import PollingBackend
+        from fsevents import FS_EVENTIDSINCENOW
+
+        root = os.path.realpath(self.tempdir).encode("utf-8")
+        filename = os.path.join(root, b"a")
+        open(filename, "w").close()
+        backend = PollingBackend(budget=1)
+        streams = [object(), object()]
+        for thread, stream in enumerate(streams):
+            backend.schedule(
+                thread, stream, None, [root], FS_EVENTIDSINCENOW, 0, 0
+            )
+        try:
+            # Both walks were charged to the budget of the backend: an
+            # ``lstat`` and a listing for the directory, and an
+            # ``lstat`` for the file.
+            self.assertLess(backend.refill(), -5)
+        finally:
+            for stream in streams:
+                backend.unschedule(stream)
+            os.unlink(filename)
+
+    def test_schedule_during_poll(self):
+        import os
+        import threading
+
+        from _polling import PollingBackend
+        from fsevents import FS_EVENTIDSINCENOW
+
+        root = os.path.realpath(self.tempdir).encode("utf-8")
+        backend = PollingBackend(interval=0.01)
+        streams = [object(), object()]
+        backend.schedule(
+            "loop", streams[0], None, [root], FS_EVENTIDSINCENOW, 0, 0
+        )
+        runloop, poller = backend.streams[streams[0]]
+        scheduled = []
+        polled = threading.Event()
+
+        def poll(path, poll=poller.poll):
+            if not polled.is_set():
+                thread = threading.Thread(
+                    target=backend.schedule,
+                    args=("loop", streams[1], None, [root]),
+                    kwargs=dict(
+                        since=FS_EVENTIDSINCENOW, latency=0, cflags=0
+                    ),
+                )
+                thread.start()
+                thread.join(1)
+                scheduled.append(not thread.is_alive())
+                polled.set()
+            return poll(path)
+
+        poller.poll = poll
+        thread = threading.Thread(target=backend.loop, args=("loop",))
+        thread.start()
+        try:
+            self.assertTrue(polled.wait(5))
+        finally:
+            backend.stop("loop")
+            thread.join()
+            for stream in streams:
+                backend.unschedule(stream)
+        self.assertEqual(scheduled, [True])
+
+
+class SnapshotStoreTestCase(BaseTestCase):
+    def test_snapshot_records(self):
+        import os
+
+        from fsevents import FileEventCallback
+
+        filename = os.path.join(self.tempdir, "test")
+        with open(filename, "w") as f:
+            f.write("abc")
+        try:
+            callback = FileEventCallback(lambda event: None, [self.tempdir])
+            root = os.path.realpath(self.tempdir)
+            snapshot = callback.snapshots[root]
+            self.assertEqual(list(snapshot), ["test"])
+
+            name, record = next(snapshot.items())
+            stat = os.lstat(filename)
+            self.assertEqual(record.st_ino, stat.st_ino)
+            self.assertEqual(record.st_mtime_ns, stat.st_mtime_ns)
+            self.assertEqual(record.st_ctime_ns, stat.st_ctime_ns)
+            self.assertEqual(record.st_size, 3)
+            self.assertEqual(record.st_mode, stat.st_mode)
+        finally:
+            os.unlink(filename)
+
+    def test_memory_usage(self):
+        import os
+
+        from fsevents import SnapshotStore
+
+        store = SnapshotStore()
+        stat = os.lstat(self.tempdir)
+        store.update("/a", [("x", stat), ("y", stat)])
+        store.update("/b", [("x", stat)])
+
+        usage = store.memory_usage()
+        self.assertEqual(usage["directories"], 2)
+        self.assertEqual(usage["entries"], 3)
+        # the entry names and the path components
+        self.assertEqual(usage["names"], 4)
+        self.assertEqual(usage["nodes"], 3)
+        self.assertEqual(
+            usage["total_bytes"],
+            usage["paths_bytes"]
+            + usage["records_bytes"]
+            + usage["names_bytes"],
+        )
+        self.assertIs(store["/a"].names[0], store["/b"].names[0])
+
+    def test_subtrees(self):
+        import os
+
+        from fsevents import SnapshotStore
+
+        store = SnapshotStore()
+        stat = os.lstat(self.tempdir)
+        store.update("/a", [("b", stat)])
+        store.update("/a/b", [("c", stat)])
+        store.update("/a/b/c", [("x", stat), ("y", stat)])
+        self.assertEqual(sorted(store), ["/a", "/a/b", "/a/b/c"])
+        self.assertEqual(store.count, 4)
+        nbytes = store.nbytes
+
+        node = store.detach("/a/b")
+        self.assertEqual(list(store), ["/a"])
+        self.assertEqual(store.count, 1)
+        self.assertIsNone(store.get("/a/b/c"))
+
+        store.attach("/d/e", node)
+        self.assertEqual(sorted(store), ["/a", "/d/e", "/d/e/c"])
+        self.assertEqual(list(store["/d/e/c"]), ["x", "y"])
+        self.assertEqual(store.count, 4)
+        self.assertEqual(
+            store.nbytes, store.memory_usage()["total_bytes"]
+        )
+
+        store.detach("/d")
+        store.discard("/a")
+        self.assertEqual(len(store), 0)
+        self.assertIsNone(store.root.children)
+        self.assertTrue(store.nbytes < nbytes)
+        self.assertEqual(store.names, {})
+
+    def test_path_types(self):
+        import os
+
+        from fsevents import SnapshotStore
+
+        stat = os.lstat(self.tempdir)
+        store = SnapshotStore()
+        store.update("/a", [("x", stat)])
+        store.update("/a/b", [])
+        # Looking up a bytes path doesn't change the paths returned.
+        self.assertNotIn(b"/a", store)
+        self.assertIsNone(store.get(b"/a/b"))
+        self.assertEqual([path for path, _ in store.items()], ["/a", "/a/b"])
+        self.assertEqual(store.subdirectories("/a"), ["/a/b"])
+        self.assertEqual(store.memory_usage()["directories"], 2)
+
+        store = SnapshotStore()
+        store.update(b"/", [(b"x", stat)])
+        store.update(b"/a", [])
+        self.assertEqual(sorted(store), [b"/", b"/a"])
+        self.assertEqual(store.subdirectories(b"/"), [b"/a"])
+
+    def test_names_released(self):
+        import os
+
+        from fsevents import FileEventCallback, SnapshotStore
+
+        store = SnapshotStore()
+        stat = os.lstat(self.tempdir)
+        for i in range(100):
+            store.update("/a", [("x%d" % i, stat), ("y", stat)])
+        self.assertEqual(sorted(store.names), ["a", "x99", "y"])
+        store.update("/a/b", [("y", stat)])
+        node = store.detach("/a/b")
+        store.attach("/c", node)
+        self.assertEqual(store.refs, {"a": 1, "c": 1, "x99": 1, "y": 2})
+        store.update("/a", [])
+        store.discard("/a")
+        store.detach("/c")
+        self.assertEqual(store.names, {})
+        self.assertEqual(store.refs, {})
+
+        # Files coming and going leave no names behind.
+        root = os.path.realpath(self.tempdir)
+        callback = FileEventCallback(lambda event: None, [root])
+        try:
+            for i in range(50):
+                filename = os.path.join(root, "file%d" % i)
+                open(filename, "w").close()
+                callback([root.encode("utf-8")], [0], [0])
+                os.unlink(filename)
+                callback([root.encode("utf-8")], [0], [0])
+        finally:
+            callback.close()
+        self.assertEqual(
+            len(callback.snapshots.names), len(root.split("/")) - 1
+        )
+
+    def test_directory_removed_and_moved(self):
+        import os
+        import shutil
+
+        from fsevents import (
+            IN_CREATE,
+            IN_DELETE,
+            IN_MOVED_FROM,
+            IN_MOVED_TO,
+            FileEventCallback
+        )
+
+        root = os.path.realpath(self.tempdir)
+        directory = os.path.join(root, "a")
+        os.makedirs(os.path.join(directory, "b"))
+        open(os.path.join(directory, "b", "test"), "w").close()
+        events = []
+        callback = FileEventCallback(events.extend, [root], batch=True)
+        try:
+            target = os.path.join(root, "c")
+            os.rename(directory, target)
+            callback([root.encode("utf-8")], [0], [0])
+            self.assertEqual(
+                [(event.mask, event.name) for event in events],
+                [(IN_MOVED_FROM, directory), (IN_MOVED_TO, target)],
+            )
+            self.assertEqual(
+                sorted(callback.snapshots),
+                [root, target, os.path.join(target, "b")],
+            )
+
+            del events[:]
+            shutil.rmtree(target)
+            open(os.path.join(root, "d"), "w").close()
+            callback([root.encode("utf-8")], [0], [0])
+            self.assertEqual(
+                [(event.mask, event.name) for event in events],
+                [
+                    (IN_DELETE, os.path.join(target, "b", "test")),
+                    (IN_DELETE, os.path.join(target, "b")),
+                    (IN_DELETE, target),
+                    (IN_CREATE, os.path.join(root, "d")),
+                ],
+            )
+            self.assertEqual(list(callback.snapshots), [root])
+        finally:
+            os.unlink(os.path.join(root, "d"))
+
+    def test_scan_does_not_follow_symlinks(self):
+        import os
+
+        from fsevents import FileEventCallback
+
+        subdir = os.path.join(self.tempdir, "subdir")
+        link = os.path.join(self.tempdir, "link")
+        os.mkdir(subdir)
+        os.symlink(subdir, link)
+        try:
+            entries, directories = FileEventCallback.scan(self.tempdir)
+            self.assertEqual(sorted(dict(entries)), ["link", "subdir"])
+            self.assertEqual(directories, [subdir])
+
+            callback = FileEventCallback(lambda event: None, [self.tempdir])
+            root = os.path.realpath(self.tempdir)
+            self.assertEqual(
+                sorted(callback.snapshots),
+                [root, os.path.join(root, "subdir")],
+            )
+        finally:
+            os.unlink(link)
+            os.rmdir(subdir)
+
+    def test_parallel_snapshot_matches_serial(self):
+        import os
+        import shutil
+
+        from fsevents import FileEventCallback
+
+        for i in range(3):
+            directory = os.path.join(self.tempdir, "dir%d" % i)
+            os.makedirs(os.path.join(directory, "sub"))
+            for j in range(5):
+                open(os.path.join(directory, "sub", "file%d" % j), "w").close()
+
+        def dump(callback):
+            store = callback.snapshots
+            return {
+                path: sorted(map(repr, store[path].items())) for path in store
+            }
+
+        try:
+            serial = FileEventCallback(lambda event: None, [self.tempdir])
+            parallel = FileEventCallback(
+                lambda event: None, [self.tempdir], workers=4
+            )
+            self.assertEqual(len(parallel.snapshots), 7)
+            self.assertEqual(dump(serial), dump(parallel))
+        finally:
+            for i in range(3):
+                shutil.rmtree(os.path.join(self.tempdir, "dir%d" % i))
+
+    def test_background_snapshot(self):
+        import os
+
+        from fsevents import IN_CREATE, IN_INITIAL, FileEventCallback
+
+        subdir = os.path.join(os.path.realpath(self.tempdir), "subdir")
+        os.mkdir(subdir)
+        filename = os.path.join(subdir, "test")
+        events = []
+        try:
+            callback = FileEventCallback(
+                events.append, [self.tempdir], background=True
+            )
+            self.assertTrue(callback.ready.wait(5))
+            self.assertEqual(len(callback.snapshots), 2)
+
+            # pretend the background walk has not yet reached the
+            # subdirectory
+            callback.ready.clear()
+            callback.snapshots.discard(subdir)
+            open(filename, "w").close()
+            callback([subdir.encode("utf-8") + b"/"], [0], [0])
+            self.assertEqual(len(events), 1)
+            self.assertEqual(events[0].mask, IN_INITIAL)
+            self.assertEqual(events[0].name, subdir)
+
+            # from here on, the directory is diffed as usual
+            callback.ready.set()
+            open(filename + ".new", "w").close()
+            callback([subdir.encode("utf-8")], [0], [0])
+            self.assertEqual(len(events), 2)
+            self.assertEqual(events[1].mask, IN_CREATE)
+            self.assertEqual(events[1].name, filename + ".new")
+        finally:
+            for name in os.listdir(subdir):
+                os.unlink(os.path.join(subdir, name))
+            os.rmdir(subdir)
+
+    def test_snapshot_cache(self):
+        import os
+
+        from fsevents import IN_CREATE, FileEventCallback
+
+        root = os.path.realpath(self.tempdir)
+        subdir = os.path.join(root, "subdir")
+        os.mkdir(subdir)
+        open(os.path.join(subdir, "test"), "w").close()
+        cache = os.path.join(root, "cache")
+        events = []
+        try:
+            callback = FileEventCallback(None, [root])
+            event_id = callback.event_id + 42
+            callback([root.encode("utf-8")], [0], [event_id])
+            callback.save(cache)
+
+            # changes made while not observing
+            open(os.path.join(subdir, "new"), "w").close()
+
+            callback = FileEventCallback(events.append, [root], cache=cache)
+            self.assertEqual(callback.event_id, event_id)
+            self.assertEqual(sorted(callback.snapshots[subdir]), ["test"])
+            callback([subdir.encode("utf-8")], [0], [event_id + 1])
+            self.assertEqual(len(events), 1)
+            self.assertEqual(events[0].mask, IN_CREATE)
+            self.assertEqual(events[0].name, os.path.join(subdir, "new"))
+
+            # a cache for other roots is ignored
+            callback = FileEventCallback(None, [subdir], cache=cache)
+            self.assertEqual(
+                sorted(callback.snapshots[subdir]), ["new", "test"]
+            )
+        finally:
+            for name in os.listdir(subdir):
+                os.unlink(os.path.join(subdir, name))
+            os.rmdir(subdir)
+            if os.path.exists(cache):
+                os.unlink(cache)
+
+
+class ComparatorTestCase(BaseTestCase):
+    def setUp(self):
+        import os
+
+        BaseTestCase.setUp(self)
+        self.filename = os.path.join(self.tempdir, "test")
+        with open(self.filename, "w") as f:
+            f.write("abc")
+        self.stat = os.stat(self.filename)
+
+    def tearDown(self):
+        import os
+
+        os.unlink(self.filename)
+        BaseTestCase.tearDown(self)
+
+    def _observe(self, compare, change):
+        import os
+
+        from fsevents import FileEventCallback
+
+        events = []
+        callback = FileEventCallback(
+            events.append, [self.tempdir], compare=compare
+        )
+        change()
+        callback([os.path.realpath(self.tempdir).encode("utf-8")], [0], [0])
+        return [event.mask for event in events]
+
+    def _rewrite(self, data):
+        import os
+
+        with open(self.filename, "w") as f:
+            f.write(data)
+        os.utime(
+            self.filename, ns=(self.stat.st_atime_ns, self.stat.st_mtime_ns)
+        )
+
+    def test_mtime_size(self):
+        from fsevents import IN_ATTRIB, IN_MODIFY
+
+        self.assertEqual(
+            self._observe("mtime", lambda: self._rewrite("abcd")),
+            [IN_ATTRIB],
+        )
+        self.assertEqual(
+            self._observe("mtime_size", lambda: self._rewrite("abcde")),
+            [IN_MODIFY],
+        )
+
+    def test_inode_ctime(self):
+        import os
+
+        from fsevents import IN_MODIFY
+
+        def change():
+            with open(self.filename + ".tmp", "w") as f:
+                f.write("abc")
+            os.utime(
+                self.filename + ".tmp",
+                ns=(self.stat.st_atime_ns, self.stat.st_mtime_ns),
+            )
+            os.rename(self.filename + ".tmp", self.filename)
+
+        self.assertEqual(self._observe("inode_ctime", change), [IN_MODIFY])
+
+    def test_fingerprint(self):
+        import os
+
+        from fsevents import IN_ATTRIB, IN_MODIFY, FingerprintComparator
+
+        def touch():
+            os.utime(self.filename)
+
+        def change():
+            self._rewrite("xyz")
+
+        self.assertEqual(self._observe("fingerprint", touch), [IN_ATTRIB])
+        self.assertEqual(self._observe("fingerprint", change), [IN_MODIFY])
+
+        # too large to fingerprint; falls back to size and time
+        compare = FingerprintComparator(max_size=2)
+        self.assertEqual(self._observe(compare, change), [IN_ATTRIB])
+
+
+class PathFilterTestCase(BaseTestCase):
+    def test_patterns(self):
+        from fsevents import PathFilter
+
+        f = PathFilter(
+            include=["*.py", "/src/docs"],
+            exclude=["node_modules", "build/*.o", "/src/tmp"],
+        )
+        for path in ("/src/node_modules", "/a/node_modules/b/c.py"):
+            self.assertTrue(f.excludes(path))
+            self.assertTrue(f.excludes(path.encode("utf-8")))
+        self.assertTrue(f.excludes("/x/build/a.o"))
+        self.assertFalse(f.excludes("/x/build/sub/a.o"))
+        self.assertTrue(f.excludes(b"/src/tmp/a/"))
+        self.assertFalse(f.excludes("/src/tmpfile"))
+        self.assertFalse(f.excludes("/src/my_node_modules"))
+
+        self.assertTrue(f.includes("/src/a.py"))
+        self.assertFalse(f.includes("/src/a.pyc"))
+        self.assertTrue(f.includes("/src/docs/index.rst"))
+        self.assertTrue(f.includes("/src/lib", is_dir=True))
+        self.assertFalse(f.includes("/src/node_modules", is_dir=True))
+
+    def test_filtered_walk(self):
+        import os
+        import shutil
+
+        from fsevents import IN_CREATE, FileEventCallback, PathFilter
+
+        root = os.path.realpath(self.tempdir)
+        excluded = os.path.join(root, "node_modules")
+        os.mkdir(excluded)
+        try:
+            open(os.path.join(excluded, "a"), "w").close()
+            events = []
+            callback = FileEventCallback(
+                events.append,
+                [self.tempdir],
+                filter=PathFilter(exclude=["node_modules"]),
+            )
+            self.assertEqual(list(callback.snapshots[root]), [])
+            self.assertNotIn(excluded, callback.snapshots)
+
+            open(os.path.join(excluded, "b"), "w").close()
+            open(os.path.join(root, "c"), "w").close()
+            callback(
+                [excluded.encode("utf-8"), root.encode("utf-8")],
+                [0, 0],
+                [0, 0],
+            )
+            self.assertEqual(
+                [(event.mask, event.name) for event in events],
+                [(IN_CREATE, os.path.join(root, "c"))],
+            )
+        finally:
+            shutil.rmtree(excluded)
+            os.unlink(os.path.join(root, "c"))
+
+    def test_filtered_path_events(self):
+        from fsevents import FS_ITEMISFILE, Observer, Stream
+
+        backend = SyntheticBackend()
+        events = []
+        stream = Stream(
+            events.extend,
+            self.tempdir,
+            batch=True,
+            exclude=["node_modules"],
+            include=["*.py"],
+        )
+        observer = Observer(backend=backend)
+        observer.schedule(stream)
+        observer.start()
+        try:
+            paths = ["/a/", "/a/b.py", "/a/c.txt", "/node_modules/d.py"]
+            backend.feed(
+                backend.pack(
+                    [path.encode("utf-8") for path in paths],
+                    [0, FS_ITEMISFILE, FS_ITEMISFILE, FS_ITEMISFILE],
+                )
+            )
+        finally:
+            observer.stop()
+            observer.unschedule(stream)
+            observer.join()
+        self.assertEqual([path for path, mask in events], ["/a/", "/a/b.py"])
+
+
+class CoalescerTestCase(unittest.TestCase):
+    def _coalesce(self, *batches):
+        from fsevents import Coalescer, FileEvent
+
+        delivered = []
+        coalescer = Coalescer(delivered.append, 60)
+        try:
+            for batch in batches:
+                coalescer([FileEvent(*event) for event in batch])
+            self.assertEqual(delivered, [])
+            coalescer.flush(force=True)
+        finally:
+            coalescer.close()
+        self.assertTrue(len(delivered) <= 1)
+        return [
+            (event.mask, event.cookie, event.name)
+            for batch in delivered
+            for event in batch
+        ]
+
+    def test_create_and_delete(self):
+        from fsevents import IN_CREATE, IN_DELETE
+
+        self.assertEqual(
+            self._coalesce(
+                [(IN_CREATE, None, "/a")], [(IN_DELETE, None, "/a")]
+            ),
+            [],
+        )
+
+    def test_create_and_modify(self):
+        from fsevents import IN_ATTRIB, IN_CREATE, IN_MODIFY
+
+        self.assertEqual(
+            self._coalesce(
+                [(IN_CREATE, None, "/a"), (IN_MODIFY, None, "/b")],
+                [(IN_MODIFY, None, "/a"), (IN_ATTRIB, None, "/a")],
+                [(IN_ATTRIB, None, "/b"), (IN_MODIFY, None, "/b")],
+            ),
+            [(IN_CREATE, None, "/a"), (IN_MODIFY, None, "/b")],
+        )
+
+    def test_delete_and_create(self):
+        from fsevents import IN_CREATE, IN_DELETE, IN_MODIFY
+
+        self.assertEqual(
+            self._coalesce(
+                [(IN_DELETE, None, "/a")], [(IN_CREATE, None, "/a")]
+            ),
+            [(IN_MODIFY, None, "/a")],
+        )
+
+    def test_moves(self):
+        from fsevents import (
+            IN_CREATE,
+            IN_DELETE,
+            IN_MODIFY,
+            IN_MOVED_FROM,
+            IN_MOVED_TO
+        )
+
+        self.assertEqual(
+            self._coalesce(
+                # moved twice
+                [(IN_MOVED_FROM, 1, "/a"), (IN_MOVED_TO, 1, "/b")],
+                [(IN_MODIFY, None, "/b")],
+                [(IN_MOVED_FROM, 2, "/b"), (IN_MOVED_TO, 2, "/c")],
+                # created, then moved
+                [(IN_CREATE, None, "/d")],
+                [(IN_MOVED_FROM, 3, "/d"), (IN_MOVED_TO, 3, "/e")],
+                # moved, then deleted
+                [(IN_MOVED_FROM, 4, "/f"), (IN_MOVED_TO, 4, "/g")],
+                [(IN_DELETE, None, "/g")],
+                # moved back
+                [(IN_MOVED_FROM, 5, "/h"), (IN_MOVED_TO, 5, "/i")],
+                [(IN_MOVED_FROM, 6, "/i"), (IN_MOVED_TO, 6, "/h")],
+            ),
+            [
+                (IN_MOVED_FROM, 1, "/a"),
+                (IN_MOVED_TO, 1, "/c"),
+                (IN_MODIFY, None, "/c"),
+                (IN_CREATE, None, "/e"),
+                (IN_DELETE, None, "/f"),
+            ],
+        )
+
+    def test_modified_and_moved(self):
+        from fsevents import IN_ATTRIB, IN_MODIFY, IN_MOVED_FROM, IN_MOVED_TO
+
+        self.assertEqual(
+            self._coalesce(
+                [(IN_MODIFY, None, "/a"), (IN_ATTRIB, None, "/b")],
+                [(IN_MOVED_FROM, 1, "/a"), (IN_MOVED_TO, 1, "/c")],
+                [(IN_MOVED_FROM, 2, "/b"), (IN_MOVED_TO, 2, "/d")],
+            ),
+            [
+                (IN_MOVED_FROM, 1, "/a"),
+                (IN_MOVED_FROM, 2, "/b"),
+                (IN_MOVED_TO, 1, "/c"),
+                (IN_MODIFY, None, "/c"),
+                (IN_MOVED_TO, 2, "/d"),
+                (IN_ATTRIB, None, "/d"),
+            ],
+        )
+
+    def test_moved_and_modified(self):
+        from fsevents import IN_ATTRIB, IN_MODIFY, IN_MOVED_FROM, IN_MOVED_TO
+
+        self.assertEqual(
+            self._coalesce(
+                [(IN_MOVED_FROM, 1, "/a"), (IN_MOVED_TO, 1, "/b")],
+                [(IN_ATTRIB, None, "/b"), (IN_MODIFY, None, "/b")],
+                [(IN_ATTRIB, None, "/b")],
+            ),
+            [
+                (IN_MOVED_FROM, 1, "/a"),
+                (IN_MOVED_TO, 1, "/b"),
+                (IN_MODIFY, None, "/b"),
+            ],
+        )
+
+    def test_quiet_window(self):
+        import time
+
+        from fsevents import IN_CREATE, IN_MODIFY, Coalescer, FileEvent
+
+        delivered = []
+        coalescer = Coalescer(delivered.append, 0.2)
+        try:
+            coalescer([FileEvent(IN_CREATE, None, "/a")])
+            time.sleep(0.1)
+            coalescer([FileEvent(IN_MODIFY, None, "/a")])
+            time.sleep(0.15)
+            self.assertEqual(delivered, [])
+            time.sleep(0.3)
+        finally:
+            coalescer.close()
+        self.assertEqual(len(delivered), 1)
+        self.assertEqual(
+            [(event.mask, event.name) for event in delivered[0]],
+            [(IN_CREATE, "/a")],
+        )
+
+
+class AsyncIteratorTestCase(unittest.TestCase):
+    def test_aiter(self):
+        import asyncio
+        import threading
+
+        from fsevents import Stream
+
+        stream = Stream(None, "/", ids=True)
+        delivered = []
+
+        def produce():
+            for i in range(3):
+                stream.deliver([("/a", i, 2 * i), ("/b", i, 2 * i + 1)])
+                delivered.append(i)
+            stream.close()
+
+        async def consume():
+            iterator = stream.aiter(maxsize=2)
+            thread = threading.Thread(target=produce)
+            thread.start()
+            events = []
+            try:
+                async for event in iterator:
+                    if not events:
+                        await asyncio.sleep(0.1)
+                        # one delivery taken, one buffered, the third
+                        # is held back by the bounded buffer
+                        self.assertEqual(delivered, [0, 1])
+                    events.append(event)
+            finally:
+                iterator.close()
+                thread.join()
+            return events
+
+        events = asyncio.run(consume())
+        self.assertEqual([event[2] for event in events], list(range(6)))
+
+    def test_aiter_batch(self):
+        import asyncio
+
+        from fsevents import FileEvent, Stream
+
+        stream = Stream(None, "/", file_events=True)
+
+        async def consume():
+            iterator = stream.aiter(batch=True)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                None, stream.deliver, [FileEvent(0, None, "/a")]
+            )
+            stream.close()
+            return [batch async for batch in iterator]
+
+        batches = asyncio.run(consume())
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(batches[0][0].name, "/a")
+
+    def test_aiter_loop(self):
+        import asyncio
+
+        from fsevents import FileEvent, Stream
+
+        stream = Stream(None, "/", file_events=True)
+        # Without a running loop, one must be passed.
+        self.assertRaises(RuntimeError, stream.aiter)
+        loop = asyncio.new_event_loop()
+        try:
+            iterator = stream.aiter(loop=loop)
+            stream.deliver([FileEvent(0, None, "/a")])
+            stream.close()
+
+            async def consume():
+                return [event.name async for event in iterator]
+
+            self.assertEqual(loop.run_until_complete(consume()), ["/a"])
+        finally:
+            loop.close()
+
+
+class DispatcherTestCase(unittest.TestCase):
+    def _dispatch(self, overflow, batches):
+        import threading
+
+        from fsevents import Dispatcher, Stream
+
+        stream = Stream(None, "/a", "/b")
+        delivered = []
+        release = threading.Event()
+
+        def callback(events):
+            release.wait()
+            delivered.append(events)
+
+        dispatcher = Dispatcher(workers=1, maxsize=2, overflow=overflow)
+        dispatcher.start(callback, stream.overflow_events)
+        for batch in batches:
+            dispatcher(batch)
+        counters = dispatcher.counters()
+        release.set()
+        dispatcher.close()
+        return delivered, counters
+
+    def test_put_after_close(self):
+        from fsevents import Dispatcher
+
+        delivered = []
+        dispatcher = Dispatcher()
+        self.assertRaises(ValueError, dispatcher, [("/a", 1)])
+        dispatcher.start(delivered.append)
+        dispatcher.close()
+        dispatcher([("/a", 1)])
+        self.assertEqual(delivered, [[("/a", 1)]])
+        self.assertEqual(dispatcher.counters()["delivered"], 1)
+
+    def test_put_after_close_releases_condition(self):
+        import threading
+
+        from fsevents import Dispatcher, ShardedDispatcher
+
+        for dispatcher in (Dispatcher(), ShardedDispatcher(workers=2)):
+            acquired = []
+
+            def callback(events, dispatcher=dispatcher):
+                # Another thread must be able to take the condition.
+                thread = threading.Thread(
+                    target=lambda: acquired.append(
+                        dispatcher.condition.acquire(timeout=1)
+                        and dispatcher.condition.release() is None
+                    )
+                )
+                thread.start()
+                thread.join()
+
+            dispatcher.start(callback)
+            dispatcher.close()
+            dispatcher([("/a", 1), ("/b", 1)])
+            self.assertTrue(acquired)
+            self.assertTrue(all(acquired))
+            self.assertEqual(dispatcher.counters()["delivered"], 2)
+
+    def test_unschedule_delivers_coalesced_events(self):
+        import os
+        import shutil
+        import tempfile
+
+        from fsevents import IN_CREATE, Dispatcher, Observer, Stream
+
+        tempdir = os.path.realpath(tempfile.mkdtemp())
+        try:
+            delivered = []
+            backend = SyntheticBackend()
+            stream = Stream(
+                lambda event: delivered.append((event.mask, event.name)),
+                tempdir,
+                file_events=True,
+                coalesce=60,
+                dispatcher=Dispatcher(),
+            )
+            observer = Observer(backend=backend)
+            observer.schedule(stream)
+            observer.start()
+            try:
+                filename = os.path.join(tempdir, "a")
+                open(filename, "w").close()
+                backend.feed(backend.pack([tempdir.encode() + b"/"], [0]))
+            finally:
+                observer.stop()
+                observer.unschedule(stream)
+                observer.join()
+            self.assertEqual(delivered, [(IN_CREATE, filename)])
+            self.assertFalse(any(stream.dispatcher.queues))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def _wait_for_worker(self, batches):
+        # Hold the first batch until the worker has picked it up, so
+        # that the queue fills up deterministically.
+        import time
+
+        for batch in batches:
+            yield batch
+            if batch is batches[0]:
+                time.sleep(0.1)
+
+    def test_drop_oldest(self):
+        batches = [[(str(i), i)] for i in range(5)]
+        delivered, counters = self._dispatch(
+            "drop_oldest", self._wait_for_worker(batches)
+        )
+        self.assertEqual(delivered, [batches[0], batches[3], batches[4]])
+        self.assertEqual(counters["depth"], 2)
+        self.assertEqual(counters["dropped"], 2)
+        self.assertEqual(counters["overflows"], 2)
+
+    def test_rescan(self):
+        from fsevents import FS_FLAGMUSTSCANSUBDIRS, FS_FLAGUSERDROPPED
+
+        batches = [[(str(i), i)] for i in range(5)]
+        delivered, counters = self._dispatch(
+            "rescan", self._wait_for_worker(batches)
+        )
+        mask = FS_FLAGMUSTSCANSUBDIRS | FS_FLAGUSERDROPPED
+        self.assertEqual(
+            delivered,
+            [batches[0], [("/a", mask), ("/b", mask)], batches[4]],
+        )
+        self.assertEqual(counters["dropped"], 3)
+
+    def test_block(self):
+        import threading
+        import time
+
+        from fsevents import Dispatcher
+
+        delivered = []
+        release = threading.Event()
+
+        def callback(events):
+            release.wait()
+            delivered.append(events)
+
+        dispatcher = Dispatcher(workers=1, maxsize=1, overflow="block")
+        dispatcher.start(callback)
+        batches = [[(str(i), i)] for i in range(3)]
+        thread = threading.Thread(
+            target=lambda: [dispatcher(batch) for batch in batches]
+        )
+        thread.start()
+        time.sleep(0.2)
+        try:
+            # the producer is waiting for room in the queue
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(dispatcher.counters()["depth"], 1)
+        finally:
+            release.set()
+            thread.join()
+            dispatcher.close()
+        self.assertEqual(delivered, batches)
+        self.assertEqual(dispatcher.counters()["dropped"], 0)
+
+    def test_sharded(self):
+        import random
+        import threading
+        import time
+
+        from fsevents import (
+            IN_CREATE,
+            IN_MODIFY,
+            IN_MOVED_FROM,
+            IN_MOVED_TO,
+            FileEvent,
+            ShardedDispatcher
+        )
+
+        delivered = []
+        lock = threading.Lock()
+
+        def callback(events):
+            time.sleep(random.random() * 0.01)
+            with lock:
+                delivered.append(events)
+
+        dispatcher = ShardedDispatcher(workers=4)
+        dispatcher.start(callback)
+        for i in range(20):
+            dispatcher(
+                [
+                    FileEvent(IN_MODIFY, None, "/dir%d/file%d" % (j, i))
+                    for j in range(8)
+                ]
+                + [
+                    FileEvent(IN_MOVED_FROM, i, "/dir0/moved%d" % i),
+                    FileEvent(IN_MOVED_TO, i, "/dir5/moved%d" % i),
+                    FileEvent(IN_CREATE, None, "/dir5/new%d" % i),
+                ]
+            )
+        dispatcher.close()
+
+        counters = dispatcher.counters()
+        self.assertEqual(counters["delivered"], 20 * 11)
+        self.assertEqual(len(counters["shards"]), 4)
+
+        order = {}
+        for events in delivered:
+            for event in events:
+                directory, name = event.name.rsplit("/", 1)
+                order.setdefault(directory, []).append(name)
+            for i, event in enumerate(events):
+                if event.mask == IN_MOVED_FROM:
+                    self.assertEqual(events[i + 1].mask, IN_MOVED_TO)
+                    self.assertEqual(events[i + 1].cookie, event.cookie)
+
+        expected = {}
+        for i in range(20):
+            for j in range(8):
+                expected.setdefault("/dir%d" % j, []).append("file%d" % i)
+            expected["/dir0"].append("moved%d" % i)
+            expected["/dir5"] += ["moved%d" % i, "new%d" % i]
+        self.assertEqual(order, expected)
+
+
+class StatisticsTestCase(BaseTestCase):
+    def test_empty_batch(self):
+        from fsevents import Statistics
+
+        statistics = Statistics()
+        statistics.handled(statistics.received(0, 0), 0)
+        statistics.handled(statistics.received(3, 5), 5)
+        stats = statistics.snapshot()
+        self.assertEqual(stats["batches"], 2)
+        self.assertEqual(stats["batch_sizes"], {4: 1})
+        self.assertTrue(stats["handling_time"]["max"] >= 0)
+
+    def test_lag(self):
+        import time
+
+        import _inotify
+        import _polling
+        from fsevents import FS_ITEMISFILE, Observer, Stream
+
+        for backend in (_inotify, _polling._backend):
+            now = time.time()
+            event_time = backend.event_time(backend.current_event_id())
+            self.assertTrue(now - 1 < event_time < time.time() + 1)
+
+        class Backend(SyntheticBackend):
+            def event_time(self, event_id):
+                # Events happened ten seconds ago, and a second apart.
+                return start + event_id - 10
+
+        backend = Backend()
+        stream = Stream(lambda *args: None, self.tempdir)
+        observer = Observer(backend=backend)
+        observer.schedule(stream)
+        observer.start()
+        start = time.time()
+        try:
+            backend.feed(backend.pack([b"/a", b"/b"], [FS_ITEMISFILE] * 2))
+            stats = observer.stats()
+        finally:
+            observer.stop()
+            observer.unschedule(stream)
+            observer.join()
+        # From the oldest event of the batch.
+        lag = stats["streams"][0]["lag"]
+        self.assertTrue(9 <= lag["p50"] == lag["max"] < 10)
+        self.assertEqual(stats["lag"], lag["max"])
+
+    def test_stream_stats(self):
+        import os
+
+        from fsevents import FS_ITEMISFILE, Observer, Stream
+
+        root = os.path.realpath(self.tempdir)
+        filename = os.path.join(root, "test")
+        open(filename, "w").close()
+        backend = SyntheticBackend()
+        events = []
+        file_events = []
+        stream = Stream(lambda *args: events.append(args), root)
+        file_stream = Stream(file_events.append, root, file_events=True)
+        observer = Observer(backend=backend)
+        observer.schedule(stream)
+        observer.schedule(file_stream)
+        observer.start()
+        try:
+            for count in (1, 3, 3):
+                paths = [root.encode("utf-8") + b"/"] * count
+                backend.feed(backend.pack(paths, [FS_ITEMISFILE] * count))
+            stats = observer.stats()
+        finally:
+            observer.stop()
+            observer.unschedule(stream)
+            observer.unschedule(file_stream)
+            observer.join()
+            os.unlink(filename)
+
+        self.assertEqual(len(events), 7)
+        self.assertEqual(stats["events"], 14)
+        self.assertEqual(stats["batches"], 6)
+        self.assertEqual(stats["batch_sizes"], {1: 2, 4: 4})
+
+        path_stats = stream.stats()
+        self.assertEqual(path_stats["deliveries"], 3)
+        self.assertEqual(path_stats["delivered_events"], 7)
+        self.assertEqual(path_stats["event_id"], 7)
+        self.assertEqual(path_stats["delivered_id"], 7)
+        self.assertEqual(path_stats["age"], 0.0)
+        self.assertTrue(path_stats["handling_time"]["max"] >= 0)
+        # The event IDs of the backend are not timestamps.
+        self.assertIsNone(path_stats["lag"])
+        self.assertIsNone(stats["lag"])
+        self.assertNotIn("rescans", path_stats)
+
+        file_stats = file_stream.stats()
+        self.assertEqual(file_stats["event_id"], 7)
+        self.assertEqual(file_stats["rescans"], 7)
+        # the initial walk, and one listing per rescan
+        self.assertEqual(file_stats["listdir"], 8)
+        self.assertEqual(file_stats["lstat"], 8)
+        self.assertEqual(file_stats["snapshot_entries"], 1)
+        self.assertTrue(file_stats["snapshot_bytes"] > 0)
+        self.assertEqual(file_stats["deliveries"], 0)
+
+    def test_snapshot_accounting(self):
+        import os
+
+        from fsevents import SnapshotStore
+
+        store = SnapshotStore()
+        stat = os.lstat(self.tempdir)
+        store.update("/a", [("x", stat), ("y", stat)])
+        store.update("/b", [("x", stat)])
+        self.assertEqual(store.count, 3)
+        store.update("/a", [("z", stat)])
+        store.discard("/b")
+        self.assertEqual(store.count, 1)
+        self.assertEqual(store.entries(), 1)
+        self.assertEqual(
+            store.nbytes, store.memory_usage()["total_bytes"]
+        )
+
+    def test_stage_profiler(self):
+        import os
+
+        from fsevents import FileEventCallback, PathFilter, StageProfiler
+
+        root = os.path.realpath(self.tempdir)
+        profiler = StageProfiler()
+        events = []
+        callback = FileEventCallback(
+            events.append, [root], filter=PathFilter(exclude=["*.o"])
+        )
+        callback.tracer = profiler
+        names = [os.path.join(root, name) for name in ("a", "b")]
+        for name in names:
+            open(name, "w").close()
+        try:
+            callback(
+                [root.encode("utf-8"), root.encode("utf-8") + b"/x.o"],
+                [0, 0],
+                [0, 0],
+            )
+        finally:
+            for name in names:
+                os.unlink(name)
+        self.assertEqual(len(events), 2)
+
+        counters = profiler.counters()
+        self.assertEqual(
+            sorted(counters),
+            [
+                "callback",
+                "diff",
+                "filter",
+                "listdir",
+                "lstat",
+                "normalize",
+                "prepare",
+            ],
+        )
+        self.assertEqual(counters["filter"]["count"], 1)
+        self.assertEqual(counters["listdir"]["count"], 2)
+        self.assertEqual(counters["callback"]["count"], 2)
+        self.assertTrue(
+            all(stage["calls"] == 1 for stage in counters.values())
+        )
+
+
+class MoveIndexTestCase(BaseTestCase):
+    def setUp(self):
+        import os
+
+        BaseTestCase.setUp(self)
+        self.root = os.path.realpath(self.tempdir)
+        self.dirs = [os.path.join(self.root, name) for name in "ab"]
+        for directory in self.dirs:
+            os.mkdir(directory)
+
+    def tearDown(self):
+        import shutil
+
+        for directory in self.dirs:
+            shutil.rmtree(directory)
+        BaseTestCase.tearDown(self)
+
+    def _events(self, events):
+        return [(event.mask, event.cookie, event.name) for event in events]
+
+    def test_move_split_over_batches(self):
+        import os
+
+        from fsevents import IN_MOVED_FROM, IN_MOVED_TO, FileEventCallback
+
+        source = os.path.join(self.dirs[0], "test")
+        target = os.path.join(self.dirs[1], "test")
+        open(source, "w").close()
+        events = []
+        callback = FileEventCallback(
+            events.extend, self.dirs, batch=True, move_window=60
+        )
+        try:
+            for i in range(2):
+                os.rename(source, target)
+                source, target = target, source
+                for directory in self.dirs:
+                    callback([directory.encode("utf-8")], [0], [0])
+                self.assertEqual(len(callback.moves), 0)
+        finally:
+            callback.close()
+        # moved to the second directory, then back; the directory
+        # moved to is rescanned first the second time
+        self.assertEqual(
+            self._events(events),
+            [
+                (IN_MOVED_FROM, 1, source),
+                (IN_MOVED_TO, 1, target),
+                (IN_MOVED_FROM, 2, target),
+                (IN_MOVED_TO, 2, source),
+            ],
+        )
+
+    def test_unpaired_events_expire(self):
+        import os
+        import time
+
+        from fsevents import IN_CREATE, IN_DELETE, FileEventCallback
+
+        filename = os.path.join(self.dirs[0], "test")
+        open(filename, "w").close()
+        events = []
+        callback = FileEventCallback(
+            events.extend, [self.root], batch=True, move_window=0.1
+        )
+        try:
+            os.unlink(filename)
+            callback([self.dirs[0].encode("utf-8")], [0], [0])
+            self.assertEqual(events, [])
+            time.sleep(0.3)
+            self.assertEqual(
+                self._events(events), [(IN_DELETE, None, filename)]
+            )
+
+            open(filename, "w").close()
+            callback([self.dirs[0].encode("utf-8")], [0], [0])
+        finally:
+            callback.close()
+        self.assertEqual(
+            self._events(events)[1:], [(IN_CREATE, None, filename)]
+        )
+
+    def test_held_event_precedes_later_events(self):
+        import os
+
+        from fsevents import IN_CREATE, IN_MODIFY, FileEventCallback
+
+        filename = os.path.join(self.dirs[0], "test")
+        events = []
+        callback = FileEventCallback(
+            events.extend, [self.root], batch=True, move_window=60
+        )
+        try:
+            open(filename, "w").close()
+            callback([self.dirs[0].encode("utf-8")], [0], [0])
+            self.assertEqual(events, [])
+            with open(filename, "w") as f:
+                f.write("test")
+            callback([self.dirs[0].encode("utf-8")], [0], [0])
+            self.assertEqual(len(callback.moves), 0)
+        finally:
+            callback.close()
+        self.assertEqual(
+            self._events(events),
+            [(IN_CREATE, None, filename), (IN_MODIFY, None, filename)],
+        )
+
+    def test_held_directory_precedes_contents(self):
+        import os
+
+        from fsevents import IN_CREATE, IN_MODIFY, FileEventCallback
+
+        directory = os.path.join(self.dirs[0], "new")
+        filename = os.path.join(directory, "test")
+        events = []
+        callback = FileEventCallback(
+            events.extend, [self.root], batch=True, move_window=60
+        )
+        try:
+            os.mkdir(directory)
+            callback([self.dirs[0].encode("utf-8")], [0], [0])
+            self.assertEqual(events, [])
+            open(filename, "w").close()
+            callback([directory.encode("utf-8")], [0], [0])
+            with open(filename, "w") as f:
+                f.write("test")
+            callback([directory.encode("utf-8")], [0], [0])
+            self.assertEqual(len(callback.moves), 0)
+        finally:
+            callback.close()
+            os.unlink(filename)
+            os.rmdir(directory)
+        self.assertEqual(
+            self._events(events),
+            [
+                (IN_CREATE, None, directory),
+                (IN_CREATE, None, filename),
+                (IN_MODIFY, None, filename),
+            ],
+        )
+
+
+class RescanSchedulerTestCase(BaseTestCase):
+    def test_dropped_events_rescan_subtree(self):
+        import os
+        import shutil
+        import time
+
+        from fsevents import (
+            FS_FLAGKERNELDROPPED,
+            FS_FLAGMUSTSCANSUBDIRS,
+            IN_CREATE,
+            IN_MODIFY,
+            FileEventCallback
+        )
+
+        root = os.path.realpath(self.tempdir)
+        directory = os.path.join(root, "a", "b")
+        os.makedirs(directory)
+        filename = os.path.join(directory, "test")
+        open(filename, "w").close()
+        events = []
+        callback = FileEventCallback(events.extend, [root], batch=True)
+        try:
+            time.sleep(0.01)
+            with open(filename, "w") as f:
+                f.write("abc")
+            open(os.path.join(root, "a", "new"), "w").close()
+
+            # Only the root is reported, with the events below dropped.
+            callback(
+                [root.encode("utf-8")],
+                [FS_FLAGMUSTSCANSUBDIRS | FS_FLAGKERNELDROPPED],
+                [0],
+            )
+            for i in range(50):
+                if len(events) == 3 and not callback.scheduler.queue:
+                    break
+                time.sleep(0.01)
+        finally:
+            callback.close()
+            shutil.rmtree(os.path.join(root, "a"))
+        self.assertEqual(
+            [(event.mask, event.name) for event in events],
+            [
+                (IN_MODIFY, os.path.join(root, "a")),
+                (IN_CREATE, os.path.join(root, "a", "new")),
+                (IN_MODIFY, filename),
+            ],
+        )
+        # the root twice: for the event, and when rescanning
+        self.assertEqual(callback.rescans, 4)
+
+    def test_requests_are_merged(self):
+        import threading
+        import time
+
+        from fsevents import RescanScheduler
+
+        started = threading.Event()
+        release = threading.Event()
+        rescanned = []
+
+        class Owner(object):
+            def rescan(self, path):
+                rescanned.append(path)
+                started.set()
+                release.wait()
+                if path == "/x":
+                    return ["/x/y", "/x/z"], 3
+                return [], 1
+
+        scheduler = RescanScheduler(Owner(), budget=None)
+        try:
+            scheduler.request("/a/b")
+            self.assertTrue(started.wait(5))
+            scheduler.request("/a/b/c")
+            scheduler.request("/x/y")
+            scheduler.request("/x")
+            scheduler.request("/x/y/z")
+            scheduler.request("/a/b/c/d")
+            self.assertEqual(list(scheduler.queue), ["/a/b/c", "/x/y", "/x"])
+            self.assertEqual(scheduler.merged, 2)
+            release.set()
+            for i in range(50):
+                if len(rescanned) == 5:
+                    break
+                time.sleep(0.01)
+        finally:
+            scheduler.close()
+        # "/x/y" is queued once, though also found below "/x"
+        self.assertEqual(
+            rescanned, ["/a/b", "/x", "/x/z", "/x/y", "/a/b/c"]
+        )
+
+
+class CheckpointTestCase(BaseTestCase):
+    def tearDown(self):
+        import os
+
+        for name in os.listdir(self.tempdir):
+            os.unlink(os.path.join(self.tempdir, name))
+        BaseTestCase.tearDown(self)
+
+    def test_group_commit(self):
+        import os
+        import time
+
+        from fsevents import CheckpointStore
+
+        filename = os.path.join(self.tempdir, "checkpoint")
+        store = CheckpointStore(filename, interval=0.1)
+        for event_id in range(1, 101):
+            store.advance("a", event_id)
+        store.advance("b", 5)
+        store.advance("a", 50)
+        self.assertEqual(store.get("a"), 100)
+        self.assertFalse(os.path.exists(filename))
+        time.sleep(0.3)
+        self.assertEqual(store.commits, 1)
+        self.assertEqual(CheckpointStore(filename).ids, {"a": 100, "b": 5})
+
+        store.advance("b", 6)
+        store.close()
+        self.assertEqual(store.commits, 2)
+        self.assertEqual(CheckpointStore(filename).get("b"), 6)
+
+    def test_checkpoint_must_be_store(self):
+        import os
+
+        from fsevents import Stream
+
+        filename = os.path.join(self.tempdir, "checkpoint")
+        self.assertRaises(
+            TypeError, Stream, None, self.tempdir, checkpoint=filename
+        )
+
+    def test_stream_resumes_from_checkpoint(self):
+        import os
+        import threading
+
+        from fsevents import (
+            FS_EVENTIDSINCENOW,
+            FS_ITEMISFILE,
+            CheckpointStore,
+            Dispatcher,
+            Observer,
+            Stream
+        )
+
+        filename = os.path.join(self.tempdir, "checkpoint")
+        since = []
+        release = threading.Event()
+
+        class Backend(SyntheticBackend):
+            def schedule(self, thread, stream, callback, paths, *args):
+                since.append(args[0])
+                SyntheticBackend.schedule(self, thread, stream, callback)
+
+        def observe(event_id, count, **options):
+            backend = Backend()
+            backend.event_id = event_id
+            store = CheckpointStore(filename, interval=60)
+            stream = Stream(
+                lambda *args: release.wait(),
+                self.tempdir,
+                checkpoint=store,
+                **options,
+            )
+            observer = Observer(backend=backend)
+            observer.schedule(stream)
+            observer.start()
+            try:
+                for i in range(count):
+                    backend.feed(backend.pack([b"/a"], [FS_ITEMISFILE]))
+                checkpointed = store.get(stream.checkpoint_key)
+            finally:
+                release.set()
+                observer.stop()
+                observer.unschedule(stream)
+                observer.join()
+            # unscheduling writes out the last ID
+            self.assertEqual(store.commits, 1)
+            return checkpointed, store.get(stream.checkpoint_key)
+
+        release.set()
+        self.assertEqual(observe(10, 3), (13, 13))
+
+        # Held up in the dispatcher, so not checkpointed until drained.
+        release.clear()
+        self.assertEqual(observe(20, 2, dispatcher=Dispatcher()), (13, 22))
+        self.assertEqual(since, [FS_EVENTIDSINCENOW, 13])
+        self.assertEqual(list(CheckpointStore(filename).ids.values()), [22])
+
+    def test_advances_when_stages_drain(self):
+        from fsevents import Dispatcher
+
+        self._advances_once_delivered(coalesce=0.2, dispatcher=Dispatcher())
+
+    def test_advances_when_held_events_expire(self):
+        self._advances_once_delivered(move_window=0.2)
+
+    def test_advances_after_rescan(self):
+        from fsevents import FS_FLAGMUSTSCANSUBDIRS
+
+        self._advances_once_delivered(mask=FS_FLAGMUSTSCANSUBDIRS)
+
+    def _advances_once_delivered(self, mask=0, **options):
+        import os
+        import threading
+        import time
+
+        from fsevents import IN_CREATE, CheckpointStore, Observer, Stream
+
+        filename = os.path.join(self.tempdir, "checkpoint")
+        store = CheckpointStore(filename, interval=60)
+        events = []
+        delivered = threading.Event()
+
+        def callback(event):
+            events.append((event.mask, event.name))
+            delivered.set()
+
+        backend = SyntheticBackend()
+        backend.event_id = 10
+        stream = Stream(
+            callback,
+            self.tempdir,
+            file_events=True,
+            checkpoint=store,
+            **options,
+        )
+        observer = Observer(backend=backend)
+        observer.schedule(stream)
+        observer.start()
+        try:
+            tempdir = os.path.realpath(self.tempdir)
+            name = os.path.join(tempdir, "a")
+            open(name, "w").close()
+            backend.feed(backend.pack([tempdir.encode() + b"/"], [mask]))
+            if not mask:
+                # Still held back when the batch is handled.
+                self.assertIsNone(store.get(stream.checkpoint_key))
+            self.assertTrue(delivered.wait(5))
+            deadline = time.monotonic() + 5
+            while store.get(stream.checkpoint_key) is None:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+            self.assertEqual(store.get(stream.checkpoint_key), 11)
+            self.assertEqual(events, [(IN_CREATE, name)])
+        finally:
+            observer.stop()
+            observer.unschedule(stream)
+            observer.join()
+
+
+class EventLogTestCase(BaseTestCase):
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.tempdir)
+
+    def test_readers_tail_independently(self):
+        from fsevents import (
+            IN_CREATE,
+            IN_MOVED_FROM,
+            EventLog,
+            EventLogReader,
+            FileEvent
+        )
+
+        log = EventLog(self.tempdir, segment_size=256)
+        first = EventLogReader(self.tempdir)
+        second = EventLogReader(self.tempdir)
+        self.assertEqual(first.read(), [])
+
+        log([("/a/", 1), ("/b/", 2, 42)])
+        log([FileEvent(IN_CREATE, None, "/a/\udcff"), (b"/c/\xff", 3)])
+        events = first.read()
+        self.assertEqual(events[0][0], 0)
+        self.assertEqual(
+            [repr(event) for offset, event in events],
+            [
+                repr(("/a/", 1)),
+                repr(("/b/", 2, 42)),
+                repr((IN_CREATE, None, "/a/\udcff")),
+                repr((b"/c/\xff", 3)),
+            ],
+        )
+        self.assertEqual(first.offset, log.offset)
+
+        # Several segments later.
+        for i in range(20):
+            log([FileEvent(IN_MOVED_FROM, i + 1, "/d/%d" % i)])
+        self.assertGreater(log.counters()["rolled"], 2)
+        self.assertEqual(len(second.read(limit=3)), 3)
+        resumed = EventLogReader(self.tempdir, second.offset)
+        tail = [event.cookie for offset, event in first.read()]
+        self.assertEqual(tail, list(range(1, 21)))
+        self.assertEqual(
+            [repr(item) for item in resumed.read()],
+            [repr(item) for item in second.read()],
+        )
+        self.assertEqual(resumed.offset, log.offset)
+        self.assertEqual(first.lost, 0)
+        for reader in first, second, resumed:
+            reader.close()
+        log.close()
+
+    def test_retention_and_compaction(self):
+        from fsevents import (
+            IN_MODIFY,
+            IN_MOVED_FROM,
+            EventLog,
+            EventLogReader,
+            FileEvent
+        )
+
+        log = EventLog(
+            self.tempdir, segment_size=512, retention_bytes=400, compact=True
+        )
+        written = []
+        for i in range(60):
+            event = FileEvent(IN_MODIFY, None, "/a/%d" % (i % 2))
+            if i % 10 == 0:
+                event = FileEvent(IN_MOVED_FROM, i + 1, "/a/0")
+            offset = log.offset
+            log([event])
+            written.append((offset, event))
+        counters = log.counters()
+        self.assertGreater(counters["deleted"], 0)
+        self.assertGreater(counters["compacted"], 0)
+
+        reader = EventLogReader(self.tempdir, 0)
+        events = reader.read()
+        self.assertGreater(reader.lost, 0)
+        self.assertEqual(reader.offset, log.offset)
+        offsets = dict(written)
+        for offset, event in events:
+            self.assertEqual(offsets[offset].name, event.name)
+            self.assertEqual(offsets[offset].cookie, event.cookie)
+        # Compacted: fewer events than written since the first one read.
+        remaining = [item for item in written if item[0] >= events[0][0]]
+        self.assertLess(len(events), len(remaining))
+        self.assertEqual(
+            [event.cookie for offset, event in events if event.cookie],
+            [event.cookie for offset, event in remaining if event.cookie],
+        )
+        self.assertEqual(events[-1][0], written[-1][0])
+
+        # A reader started in the middle of a compacted segment.
+        middle = EventLogReader(self.tempdir, events[1][0] - 1)
+        self.assertEqual(
+            [repr(item) for item in middle.read()],
+            [repr(item) for item in events[1:]],
+        )
+        reader.close()
+        middle.close()
+        log.close()
+
+    def test_recovery(self):
+        import os
+
+        from fsevents import EventLog, EventLogReader
+
+        log = EventLog(self.tempdir)
+        log([("/a/", 1), ("/b/", 2)])
+        log.close()
+        (filename,) = os.listdir(self.tempdir)
+        filename = os.path.join(self.tempdir, filename)
+        size = os.path.getsize(filename)
+        with open(filename, "ab") as f:
+            f.write(b"\x38\0\0\0torn")
+
+        log = EventLog(self.tempdir)
+        self.assertEqual(os.path.getsize(filename), size)
+        log([("/c/", 3)])
+        with EventLogReader(self.tempdir) as reader:
+            self.assertEqual(
+                [event for offset, event in reader.read()],
+                [("/a/", 1), ("/b/", 2), ("/c/", 3)],
+            )
+        log.close()
+
+    def test_stream_sink(self):
+        import os
+
+        from fsevents import FS_ITEMISFILE, EventLogReader, Observer, Stream
+
+        directory = os.path.join(self.tempdir, "log")
+        backend = SyntheticBackend()
+        backend.event_id = 10
+        stream = Stream(None, self.tempdir, ids=True)
+        log = stream.event_log(directory)
+        observer = Observer(backend=backend)
+        observer.schedule(stream)
+        observer.start()
+        try:
+            backend.feed(backend.pack([b"/a", b"/b"], [FS_ITEMISFILE] * 2))
+        finally:
+            observer.stop()
+            observer.unschedule(stream)
+            observer.join()
+        self.assertIsNone(log.fd)
+        with EventLogReader(directory) as reader:
+            events = [event for offset, event in reader.read()]
+        self.assertEqual(
+            [(path, event_id) for path, mask, event_id in events],
+            [("/a", 11), ("/b", 12)],
+        )
+
+
+def _read_ring(name, consumer, queue):
+    from fsevents import SharedRingReader
+
+    with SharedRingReader(name, consumer) as reader:
+        queue.put("attached")
+        queue.put([event.name for event in reader])
+
+
+def _check_ring(name, queue):
+    from fsevents import SharedRingReader
+
+    count = bad = 0
+    previous = -1
+    with SharedRingReader(name, 0) as reader:
+        queue.put("attached")
+        for path, mask in reader:
+            count += 1
+            try:
+                empty, number, padding = path.split("/")
+                number = int(number)
+            except ValueError:
+                bad += 1
+                continue
+            if (
+                padding != "x" * (number % 37)
+                or mask != number % 997 + 1
+                or number <= previous
+            ):
+                bad += 1
+            previous = number
+        queue.put((count, bad, reader.lost))
+
+
+class SharedRingTestCase(unittest.TestCase):
+    def test_fan_out(self):
+        from fsevents import IN_CREATE, FileEvent, SharedRing, SharedRingReader
+
+        ring = SharedRing(capacity=8, consumers=3)
+        first = SharedRingReader(ring.name, 0)
+        second = SharedRingReader(ring.name, 2)
+        ring([("/a/", 1), (b"/b/\xff", 2, 42)])
+        ring([FileEvent(IN_CREATE, 7, "/c/\udcff")])
+        self.assertEqual(
+            [repr(event) for event in first.read()],
+            [
+                repr(("/a/", 1)),
+                repr((b"/b/\xff", 2, 42)),
+                repr((IN_CREATE, 7, "/c/\udcff")),
+            ],
+        )
+        self.assertEqual(first.read(), [])
+        self.assertEqual(second.read(limit=1), [("/a/", 1)])
+        counters = ring.counters()
+        self.assertEqual(counters["head"], 3)
+        self.assertEqual(
+            counters["consumers"],
+            [{"lag": 0, "lost": 0}, None, {"lag": 2, "lost": 0}],
+        )
+
+        # A reader of the same consumer resumes at its cursor.
+        second.close()
+        second = SharedRingReader(ring.name, 2)
+        self.assertEqual(len(second.read()), 2)
+        second.close(detach=True)
+        self.assertIsNone(ring.counters()["consumers"][2])
+        self.assertRaises(ValueError, SharedRingReader, ring.name, 3)
+
+        ring([("/d/", 4)])
+        ring.close()
+        self.assertTrue(first.closed)
+        self.assertEqual(list(first), [("/d/", 4)])
+        first.close()
+
+    def test_overrun(self):
+        from fsevents import SharedRing, SharedRingReader
+
+        ring = SharedRing(capacity=4, consumers=1)
+        reader = SharedRingReader(ring.name, 0)
+        ring([("/%d/" % i, 1) for i in range(10)])
+        self.assertEqual(
+            reader.read(), [("/%d/" % i, 1) for i in range(6, 10)]
+        )
+        self.assertEqual(reader.lost, 6)
+        self.assertEqual(ring.counters()["consumers"][0]["lost"], 6)
+        reader.close()
+        ring.close()
+
+        # The paths of records still in the ring are overwritten.
+        ring = SharedRing(capacity=4, consumers=1, path_bytes=32)
+        reader = SharedRingReader(ring.name, 0)
+        events = [("/a/", 1), ("/b/", 1), ("/%s/" % ("c" * 14), 1)]
+        ring(events + [("/%s/" % ("e" * 14), 1)])
+        self.assertEqual(reader.read(), [("/%s/" % ("e" * 14), 1)])
+        self.assertEqual(reader.lost, 3)
+        self.assertRaises(ValueError, ring, [("/%s/" % ("d" * 16), 1)])
+        reader.close()
+        ring.close()
+
+    def test_overrun_live_reader(self):
+        import multiprocessing
+
+        from fsevents import SharedRing
+
+        ring = SharedRing(capacity=256, consumers=1, path_bytes=4096)
+        queue = multiprocessing.Queue()
+        worker = multiprocessing.Process(
+            target=_check_ring, args=(ring.name, queue)
+        )
+        worker.start()
+        self.assertEqual(queue.get(timeout=10), "attached")
+        total = 200000
+        events = [
+            ("/%d/%s" % (i, "x" * (i % 37)), i % 997 + 1)
+            for i in range(total)
+        ]
+        for i in range(0, total, 64):
+            ring(events[i:i + 64])
+        ring.close()
+        count, bad, lost = queue.get(timeout=60)
+        worker.join()
+        self.assertEqual(bad, 0)
+        self.assertGreater(lost, 0)
+        self.assertEqual(count + lost, total)
+
+    def test_block(self):
+        import threading
+
+        from fsevents import SharedRing, SharedRingReader
+
+        ring = SharedRing(capacity=4, consumers=2, path_bytes=64, block=True)
+        reader = SharedRingReader(ring.name, 1)
+        events = [("/%d/" % i, 1) for i in range(50)]
+        thread = threading.Thread(target=ring, args=(events,))
+        thread.start()
+        received = []
+        while len(received) < len(events):
+            reader.wait(1)
+            received.extend(reader.read())
+        thread.join()
+        self.assertEqual(received, events)
+        self.assertEqual(reader.lost, 0)
+        self.assertGreater(ring.counters()["waits"], 0)
+        reader.close()
+        ring.close()
+
+    def test_worker_process(self):
+        import multiprocessing
+
+        from fsevents import IN_MODIFY, FileEvent, SharedRing
+
+        ring = SharedRing(capacity=16, consumers=2, block=True)
+        queue = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(
+                target=_read_ring, args=(ring.name, consumer, queue)
+            )
+            for consumer in range(2)
+        ]
+        for worker in workers:
+            worker.start()
+        attached = [queue.get(timeout=10) for i in range(2)]
+        self.assertEqual(attached, ["attached", "attached"])
+        names = ["/%d" % i for i in range(100)]
+        ring([FileEvent(IN_MODIFY, None, name) for name in names])
+        ring.close()
+        self.assertEqual(
+            [queue.get(timeout=10) for i in range(2)], [names, names]
+        )
+        for worker in workers:
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+
+
+class ObserverPoolTestCase(BaseTestCase):
+    def test_placement(self):
+        from fsevents import ObserverPool, Stream
+
+        pool = ObserverPool(threads=3, backend=SyntheticBackend())
+        streams = [Stream(None, self.tempdir) for i in range(6)]
+        for stream in streams:
+            pool.schedule(stream)
+        self.assertRaises(ValueError, pool.schedule, streams[0])
+        observers = pool.stats()["observers"]
+        self.assertEqual([o["streams"] for o in observers], [2, 2, 2])
+
+        # Emptying an observer moves a stream over to it.
+        first = pool.observers[0]
+        for stream, observer in list(pool.placement.items()):
+            if observer is first:
+                pool.unschedule(stream)
+        stats = pool.stats()
+        self.assertEqual(
+            sorted(observer["streams"] for observer in stats["observers"]),
+            [1, 1, 2],
+        )
+        self.assertEqual(stats["moves"], 1)
+        self.assertEqual(len(stats["streams"]), 4)
+
+    def test_moves_streams_off_busy_observer(self):
+        import time
+
+        from fsevents import (
+            FS_EVENTIDSINCENOW,
+            FS_FLAGHISTORYDONE,
+            FS_ITEMISFILE,
+            ObserverPool,
+            Stream
+        )
+
+        placed = {}
+
+        class Backend(SyntheticBackend):
+            def schedule(self, thread, stream, callback, paths, since, *a):
+                placed[stream] = thread, since
+                SyntheticBackend.schedule(self, thread, stream, callback)
+
+        backend = Backend()
+        received = []
+        busy = Stream(lambda *args: time.sleep(0.05), self.tempdir)
+        other = Stream(None, self.tempdir)
+        idle = Stream(lambda *args: received.append(args), self.tempdir)
+        pool = ObserverPool(threads=2, backend=backend)
+        pool.start()
+        try:
+            for stream in busy, other, idle:
+                pool.schedule(stream)
+            first, second = pool.observers
+            self.assertIs(placed[busy][0], first)
+            self.assertIs(placed[idle][0], first)
+            self.assertIs(placed[other][0], second)
+
+            backend.feed(backend.pack([b"/a", b"/b"], [FS_ITEMISFILE] * 2))
+            time.sleep(0.1)
+            pool.rebalance()
+            self.assertEqual(pool.moves, 1)
+            self.assertIs(placed[idle][0], second)
+            self.assertEqual(placed[idle][1], FS_EVENTIDSINCENOW)
+            stats = pool.stats()
+            self.assertGreater(
+                stats["observers"][0]["load"], stats["observers"][1]["load"]
+            )
+            self.assertGreater(stats["busy"], 0.09)
+
+            # Still delivered, from the new observer, without the
+            # events already handled.
+            backend.event_id = 1
+            backend.feed(
+                backend.pack(
+                    [b"/b", b"/", b"/c"],
+                    [FS_ITEMISFILE, FS_FLAGHISTORYDONE, FS_ITEMISFILE],
+                )
+            )
+            self.assertEqual(
+                [path for path, mask in received], ["/a", "/b", "/c"]
+            )
+
+            # New streams avoid the busy observer.
+            time.sleep(0.1)
+            late = Stream(None, self.tempdir)
+            pool.schedule(late)
+            self.assertIs(placed[late][0], second)
+            for stream in busy, other, idle, late:
+                pool.unschedule(stream)
+        finally:
+            pool.stop()
+            pool.join()
+        self.assertFalse(any(o.is_alive() for o in pool.observers))
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "inotify backend")
+    def test_moved_stream_is_not_replayed(self):
+        import os
+        import shutil
+        import time
+
+        from fsevents import FS_CFLAGFILEEVENTS, ObserverPool, Stream
+
+        root = os.path.realpath(self.tempdir)
+        dirs = [os.path.join(root, name) for name in "abc"]
+        events = dict((directory, []) for directory in dirs)
+        streams = {}
+        for directory in dirs:
+            os.mkdir(directory)
+            streams[directory] = Stream(
+                lambda *args, events=events[directory]: events.append(args),
+                directory,
+                flags=FS_CFLAGFILEEVENTS,
+            )
+        pool = ObserverPool(threads=2)
+        pool.start()
+        try:
+            for directory in dirs:
+                pool.schedule(streams[directory])
+            for directory in dirs:
+                open(os.path.join(directory, "first"), "w").close()
+            time.sleep(0.2)
+
+            # Moves a stream over to the emptied observer.
+            pool.unschedule(streams[dirs[1]])
+            self.assertEqual(pool.moves, 1)
+            for directory in dirs:
+                open(os.path.join(directory, "second"), "w").close()
+            time.sleep(0.2)
+            for directory in dirs[0], dirs[2]:
+                pool.unschedule(streams[directory])
+        finally:
+            pool.stop()
+            pool.join()
+            for directory in dirs:
+                shutil.rmtree(directory)
+        for directory in dirs[0], dirs[2]:
+            self.assertEqual(
+                [path for path, mask in events[directory]],
+                [
+                    os.path.join(directory, "first"),
+                    os.path.join(directory, "second"),
+                ],
+            )